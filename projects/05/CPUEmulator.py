@@ -0,0 +1,388 @@
+#!/bin/env python3
+"""
+Headless Hack CPU emulator
+
+Usage: python3 CPUEmulator.py program.hack|program.asm|image [-n cycles]
+       python3 CPUEmulator.py script.tst
+
+ROM words are decoded once into integer fields, then run by a single loop
+over array-backed RAM. .asm programs are assembled with projects/06 first.
+"""
+
+from pathlib import Path
+import sys
+import time
+import argparse
+import re
+from array import array
+
+from testscript import TestScript
+
+HERE = Path(__file__).resolve().parent
+PROJECTS = HERE.parent
+
+SCREEN = 16384
+KBD = 24576
+RAM_SIZE = 32768 # addressM is 15 bits wide
+ROM_SIZE = 32768
+
+# Destination bits
+DEST_M = 1
+DEST_D = 2
+DEST_A = 4
+
+# Jump bits
+JUMP_GT = 1
+JUMP_EQ = 2
+JUMP_LT = 4
+
+# ALU functions of (D, A, M) by the a/c1..c6 bits of a C-instruction.
+# Registers hold unsigned 16-bit values.
+ALU = {
+    0b0101010: lambda d, a, m: 0,
+    0b0111111: lambda d, a, m: 1,
+    0b0111010: lambda d, a, m: 0xFFFF,
+    0b0001100: lambda d, a, m: d,
+    0b0110000: lambda d, a, m: a,
+    0b0001101: lambda d, a, m: d ^ 0xFFFF,
+    0b0110001: lambda d, a, m: a ^ 0xFFFF,
+    0b0001111: lambda d, a, m: -d & 0xFFFF,
+    0b0110011: lambda d, a, m: -a & 0xFFFF,
+    0b0011111: lambda d, a, m: d + 1 & 0xFFFF,
+    0b0110111: lambda d, a, m: a + 1 & 0xFFFF,
+    0b0001110: lambda d, a, m: d - 1 & 0xFFFF,
+    0b0110010: lambda d, a, m: a - 1 & 0xFFFF,
+    0b0000010: lambda d, a, m: d + a & 0xFFFF,
+    0b0010011: lambda d, a, m: d - a & 0xFFFF,
+    0b0000111: lambda d, a, m: a - d & 0xFFFF,
+    0b0000000: lambda d, a, m: d & a,
+    0b0010101: lambda d, a, m: d | a,
+    0b1110000: lambda d, a, m: m,
+    0b1110001: lambda d, a, m: m ^ 0xFFFF,
+    0b1110011: lambda d, a, m: -m & 0xFFFF,
+    0b1110111: lambda d, a, m: m + 1 & 0xFFFF,
+    0b1110010: lambda d, a, m: m - 1 & 0xFFFF,
+    0b1000010: lambda d, a, m: d + m & 0xFFFF,
+    0b1010011: lambda d, a, m: d - m & 0xFFFF,
+    0b1000111: lambda d, a, m: m - d & 0xFFFF,
+    0b1000000: lambda d, a, m: d & m,
+    0b1010101: lambda d, a, m: d | m,
+}
+
+RE_PIN = re.compile(r'(?P<name>\w+)(?:\[(?P<index>\d*)\])?$')
+
+
+def decode(words):
+    """
+    Returns (values, ops): values[i] is the constant of an A-instruction or
+    -1, ops[i] is (alu, dest, jump) of a C-instruction or None
+    """
+    values = []
+    ops = []
+    for n, word in enumerate(words):
+        if word < 0x8000:
+            values.append(word)
+            ops.append(None)
+        else:
+            alu = ALU.get(word >> 6 & 0x7F)
+            if alu is None:
+                raise ValueError('Invalid instruction at ROM[{}]: {:016b}'.format(n, word))
+            values.append(-1)
+            ops.append((alu, word >> 3 & 7, word & 7))
+    return values, ops
+
+
+def jumps(jump, out):
+    return jump & (JUMP_LT if out & 0x8000 else JUMP_EQ if out == 0 else JUMP_GT)
+
+
+def import_assembler():
+    sys.path.insert(0, str(PROJECTS / '06'))
+    try:
+        import HackAssembler
+    finally:
+        sys.path.pop(0)
+    return HackAssembler
+
+
+def read_program(path):
+    """
+    Returns the ROM words of a .hack file, a packed binary image, or a .asm
+    file assembled with the projects/06 assembler
+    """
+    path = Path(path)
+    with open(str(path), 'rb') as f:
+        binary = f.read(4) == b'HACK'
+    if binary:
+        return import_assembler().load_binary(str(path))
+    with open(str(path), 'r') as f:
+        if path.suffix == '.asm':
+            return import_assembler().Assembler().assemble_stream(f)
+        return [int(line, 2) for line in (line.strip() for line in f) if line]
+
+
+class Computer:
+    """
+    The Hack computer: CPU, 32K ROM and RAM with the memory-mapped screen and
+    keyboard
+    """
+    def __init__(self, program=()):
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.load(program)
+        self.reset()
+
+    def load(self, words):
+        if len(words) > ROM_SIZE:
+            raise ValueError('Program too large: {} instructions'.format(len(words)))
+        self.rom = array('H', words)
+        self.rom.extend(bytes(2 * (ROM_SIZE - len(words))))
+        values, ops = decode(self.rom)
+        # Doubled so that running past the end of ROM needs no bounds check
+        self.values, self.ops = values * 2, ops * 2
+
+    def reset(self):
+        self.a = self.d = self.pc = 0
+        self.halted = False
+
+    @property
+    def keyboard(self):
+        return self.ram[KBD]
+
+    @keyboard.setter
+    def keyboard(self, key):
+        self.ram[KBD] = key
+
+    def run(self, cycles):
+        """
+        Runs up to `cycles` instructions and returns how many ran. Stops early
+        at a jump to itself or to the @ instruction right before it, the
+        (END) @END 0;JMP loop that Hack programs end with.
+        """
+        values, ops, ram = self.values, self.ops, self.ram
+        a, d, pc = self.a, self.d, self.pc
+        n = 0
+        for n in range(1, cycles + 1):
+            value = values[pc]
+            if value >= 0:
+                a = value
+                pc += 1
+                continue
+            alu, dest, jump = ops[pc]
+            out = alu(d, a, ram[a & 0x7FFF])
+            if jump and jump & (4 if out & 0x8000 else 2 if out == 0 else 1):
+                if not dest and (a == pc or a == pc - 1 and values[a] == a):
+                    pc = a
+                    self.halted = True
+                    break
+                target = a
+            else:
+                target = pc + 1
+            if dest:
+                if dest & 1:
+                    ram[a & 0x7FFF] = out
+                if dest & 4:
+                    a = out
+                if dest & 2:
+                    d = out
+            pc = target
+        self.a, self.d, self.pc = a, d, pc & 0x7FFF
+        return n
+
+
+class CPUChip:
+    """
+    CPU.hdl for test scripts. Like the hardware simulator, the registers take
+    their new values on tick but only show them on the outputs after tock.
+    """
+    INPUTS = ('inM', 'instruction', 'reset')
+
+    def __init__(self):
+        self.inputs = dict.fromkeys(self.INPUTS, 0)
+        self.a = self.d = self.pc = 0
+        self.next = (0, 0, 0)
+
+    def set(self, name, value):
+        if name not in self.inputs:
+            raise ValueError('Unknown CPU input: {}'.format(name))
+        self.inputs[name] = value
+
+    def alu(self):
+        ins = self.inputs['instruction']
+        if ins < 0x8000:
+            return 0, 0, 0
+        alu = ALU.get(ins >> 6 & 0x7F)
+        if alu is None:
+            raise ValueError('Invalid instruction: {:016b}'.format(ins))
+        return alu(self.d, self.a, self.inputs['inM']), ins >> 3 & 7, ins & 7
+
+    def get(self, name):
+        out, dest, jump = self.alu()
+        if name == 'outM':
+            return out
+        elif name == 'writeM':
+            return dest & DEST_M and 1
+        elif name == 'addressM':
+            return self.a & 0x7FFF
+        elif name == 'pc':
+            return self.pc
+        elif name in self.inputs:
+            return self.inputs[name]
+        registers = {'ARegister': 0, 'DRegister': 1, 'PC': 2}
+        match = RE_PIN.match(name)
+        if match and match.group('name') in registers:
+            return self.next[registers[match.group('name')]]
+        raise ValueError('Unknown CPU pin: {}'.format(name))
+
+    def eval(self):
+        pass
+
+    def tick(self):
+        ins = self.inputs['instruction']
+        out, dest, jump = self.alu()
+        a, d, pc = self.a, self.d, self.pc + 1
+        if ins < 0x8000:
+            a = ins
+        else:
+            if jump and jumps(jump, out):
+                pc = self.a
+            if dest & DEST_A:
+                a = out
+            if dest & DEST_D:
+                d = out
+        if self.inputs['reset']:
+            pc = 0
+        self.next = (a, d, pc & 0xFFFF)
+
+    def tock(self):
+        self.a, self.d, self.pc = self.next
+
+    def load(self, part, path):
+        raise ValueError('CPU has no part {}'.format(part))
+
+
+class ComputerChip:
+    """
+    Computer.hdl for test scripts, or a program loaded straight into the CPU
+    emulator (RAM[n], A, D and PC)
+    """
+    REGISTERS = {
+        'A': 'a', 'ARegister': 'a',
+        'D': 'd', 'DRegister': 'd',
+        'PC': 'pc',
+    }
+    MEMORY = {
+        'RAM': 'ram', 'RAM16K': 'ram', 'Memory': 'ram',
+        'ROM': 'rom', 'ROM32K': 'rom',
+    }
+
+    def __init__(self, program=()):
+        self.computer = Computer(program)
+        self.reset = 0
+
+    def locate(self, name):
+        match = RE_PIN.match(name)
+        if not match:
+            raise ValueError('Unknown pin: {}'.format(name))
+        name, index = match.group('name', 'index')
+        if index and name in self.MEMORY:
+            return getattr(self.computer, self.MEMORY[name]), int(index)
+        elif name in self.REGISTERS and index in (None, '', '0'):
+            return self.computer, self.REGISTERS[name]
+        raise ValueError('Unknown pin: {}'.format(name))
+
+    def set(self, name, value):
+        if name == 'reset':
+            self.reset = value
+            return
+        target, key = self.locate(name)
+        if target is self.computer.rom:
+            words = list(self.computer.rom)
+            words[key] = value
+            self.computer.load(words)
+        elif isinstance(key, int):
+            target[key] = value
+        else:
+            setattr(target, key, value)
+
+    def get(self, name):
+        if name == 'reset':
+            return self.reset
+        target, key = self.locate(name)
+        if isinstance(key, int):
+            return target[key]
+        return getattr(target, key)
+
+    def eval(self):
+        pass
+
+    def tick(self):
+        self.computer.run(1)
+        if self.reset:
+            self.computer.pc = 0
+
+    def tock(self):
+        pass
+
+    def ticktock(self, count):
+        if not self.reset:
+            self.computer.run(count)
+            return
+        for _ in range(count):
+            self.tick()
+
+    def load(self, part, path):
+        if part not in ('ROM32K', 'ROM'):
+            raise ValueError('Cannot load {} into {}'.format(path, part))
+        self.computer.load(read_program(path))
+
+
+def load_chip(path):
+    """
+    Chip for a test script `load` command
+    """
+    path = Path(path)
+    if path.name == 'CPU.hdl':
+        return CPUChip()
+    elif path.name == 'Computer.hdl':
+        return ComputerChip()
+    elif path.suffix in ('.hack', '.asm', '.bin'):
+        return ComputerChip(read_program(path))
+    raise ValueError('The CPU emulator cannot load {}'.format(path.name))
+
+
+def run_script(path):
+    """
+    Runs a test script and returns the number of the first output line that
+    differs from its compare-to file, or None
+    """
+    script = TestScript(path, load_chip)
+    script.run()
+    if script.compare_file:
+        return script.compare()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a Hack program or CPU test script')
+    parser.add_argument('path', help='.hack, .asm or packed binary program, or .tst test script')
+    parser.add_argument('-n', '--cycles', type=int, default=10 ** 7,
+                        help='maximum number of instructions to run (default: %(default)s)')
+    args = parser.parse_args()
+
+    path = Path(args.path)
+    if path.suffix == '.tst':
+        line = run_script(path)
+        if line:
+            print('Comparison failure at line {}'.format(line))
+            sys.exit(1)
+        print('End of script - Comparison ended successfully')
+        return
+
+    computer = Computer(read_program(path))
+    start = time.perf_counter()
+    n = computer.run(args.cycles)
+    elapsed = time.perf_counter() - start
+    print('{} instructions in {:.3f}s ({:,.0f} instructions/sec){}'.format(
+        n, elapsed, n / elapsed, ', halted at {}'.format(computer.pc) if computer.halted else ''))
+
+if __name__ == '__main__':
+    main()
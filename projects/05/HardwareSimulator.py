@@ -0,0 +1,1209 @@
+#!/bin/env python3
+"""
+Headless hardware simulator for the .hdl chips of projects/01-05
+
+Usage: python3 HardwareSimulator.py [-m [-g CHIP ...]] script.tst ...
+
+A chip is parsed and flattened down to built-in parts once, when it is
+loaded. The combinational parts are sorted so that each comes after the parts
+feeding it, and the sorted netlist is compiled into Python functions where a
+whole bus is one integer and each part is one integer operation.
+
+Like tools/HardwareSimulator.sh, a part is read from the .hdl file in the
+chip's directory if there is one, and is otherwise the built-in chip of the
+same name from tools/builtInChips. With --fast-memory, the memory chips
+RAM8..RAM16K, Screen, Keyboard and ROM32K are built-ins even where the
+directory has .hdl files for them, e.g. the projects/03 RAM chips copied next
+to Computer.hdl, so that each memory is one Python list instead of thousands
+of registers. --gate-level CHIP runs one of them from its .hdl file anyway.
+
+Parsed and flattened chips are cached in a .hdlcache directory next to the
+chip, keyed by the hashes of the .hdl files, so that a chip is only
+flattened again when its .hdl file or one of its parts' changes.
+
+BatchChip evaluates a combinational chip for many input vectors at once,
+e.g. to check an ALU against the built-in one over a million random inputs.
+"""
+
+from pathlib import Path
+import sys
+import argparse
+import hashlib
+import marshal
+import os
+import re
+from array import array
+
+from testscript import TestScript
+from CPUEmulator import read_program, RE_PIN
+
+HERE = Path(__file__).resolve().parent
+BUILTIN_CHIPS = HERE.parent.parent / 'tools' / 'builtInChips'
+
+RE_TOKEN = re.compile(r'\s*(?:(?P<comment>//[^\n]*|/\*.*?\*/)|(?P<token>\w+|\.\.|\S))', re.DOTALL)
+RE_ATOM = re.compile(r'(\w+|v\[\d+\])$')
+
+# Built-in chips. Outputs are Python expressions of the input pins, given
+# in the order they are computed.
+COMBINATIONAL = {
+    'Nand': {'out': '{a} & {b} ^ 1'},
+    'Not': {'out': '{in} ^ 1'},
+    'And': {'out': '{a} & {b}'},
+    'Or': {'out': '{a} | {b}'},
+    'Xor': {'out': '{a} ^ {b}'},
+    'Mux': {'out': '{b} if {sel} else {a}'},
+    'DMux': {'a': '0 if {sel} else {in}', 'b': '{in} if {sel} else 0'},
+    'Not16': {'out': '{in} ^ 0xFFFF'},
+    'And16': {'out': '{a} & {b}'},
+    'Or16': {'out': '{a} | {b}'},
+    'Mux16': {'out': '{b} if {sel} else {a}'},
+    'Or8Way': {'out': '1 if {in} else 0'},
+    'Mux4Way16': {'out': '({a}, {b}, {c}, {d})[{sel}]'},
+    'Mux8Way16': {'out': '({a}, {b}, {c}, {d}, {e}, {f}, {g}, {h})[{sel}]'},
+    'DMux4Way': {pin: '{{in}} if {{sel}} == {} else 0'.format(n) for n, pin in enumerate('abcd')},
+    'DMux8Way': {pin: '{{in}} if {{sel}} == {} else 0'.format(n)
+                 for n, pin in enumerate('abcdefgh')},
+    'HalfAdder': {'sum': '{a} ^ {b}', 'carry': '{a} & {b}'},
+    'FullAdder': {'sum': '{a} ^ {b} ^ {c}', 'carry': '{a} & {b} | {c} & ({a} ^ {b})'},
+    'Add16': {'out': '{a} + {b} & 0xFFFF'},
+    'Inc16': {'out': '{in} + 1 & 0xFFFF'},
+    'ALU': {
+        'out': 'alu({x}, {y}, {zx}, {nx}, {zy}, {ny}, {f}, {no})',
+        'zr': '0 if {out} else 1',
+        'ng': '{out} >> 15',
+    },
+}
+
+# Clocked chips with an `out` register: its next value, taken on tick and
+# shown on tock
+REGISTERS = {
+    'DFF': '{in}',
+    'Bit': '{in} if {load} else {state}',
+    'Register': '{in} if {load} else {state}',
+    'ARegister': '{in} if {load} else {state}',
+    'DRegister': '{in} if {load} else {state}',
+    'PC': '0 if {reset} else {in} if {load} else {state} + 1 & 0xFFFF if {inc} else {state}',
+}
+
+# Memories by number of words. Reads follow the address right away, writes
+# are made on tick and show on the outputs after tock.
+MEMORIES = {
+    'RAM8': 8,
+    'RAM64': 64,
+    'RAM512': 512,
+    'RAM4K': 4096,
+    'RAM16K': 16384,
+    'Screen': 8192,
+    'ROM32K': 32768,
+}
+READ_ONLY = {'ROM32K'}
+
+# Chips that a fast_memory library always takes from tools/builtInChips, so
+# they run as Python lists even if the chip directory has .hdl files for them
+FAST_MEMORIES = {'RAM8', 'RAM64', 'RAM512', 'RAM4K', 'RAM16K', 'Screen', 'Keyboard', 'ROM32K'}
+
+
+def alu(x, y, zx, nx, zy, ny, f, no):
+    if zx:
+        x = 0
+    if nx:
+        x ^= 0xFFFF
+    if zy:
+        y = 0
+    if ny:
+        y ^= 0xFFFF
+    out = x + y & 0xFFFF if f else x & y
+    return out ^ 0xFFFF if no else out
+
+
+def mask(width):
+    return (1 << width) - 1
+
+
+class ChipDef:
+    """
+    A parsed .hdl file. inputs and outputs map pin names to widths, parts is
+    a list of (chip name, connections) with connections of
+    (pin, pin bits, pin or true/false, bits), where bits are (lo, hi) or None.
+    """
+    def __init__(self, name, inputs, outputs, parts, builtin, path):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.parts = parts
+        self.builtin = builtin
+        self.path = path
+
+
+class HDLParser:
+    def __init__(self, path, data=None):
+        self.path = Path(path)
+        self.tokens = []
+        if data is None:
+            data = self.path.read_text(errors='replace')
+        pos, line = 0, 1
+        data = data.rstrip()
+        while pos < len(data):
+            match = RE_TOKEN.match(data, pos)
+            if match.group('token'):
+                line += data.count('\n', pos, match.start('token'))
+                self.tokens.append((match.group('token'), line))
+                line += data.count('\n', match.start('token'), match.end())
+            else:
+                line += data.count('\n', pos, match.end())
+            pos = match.end()
+        self.tokens.reverse()
+
+    def error(self, message):
+        line = self.tokens[-1][1] if self.tokens else 'end'
+        return SyntaxError('{}, line {}: {}'.format(self.path.name, line, message))
+
+    def peek(self):
+        return self.tokens[-1][0] if self.tokens else None
+
+    def next(self):
+        if not self.tokens:
+            raise self.error('Unexpected end of file')
+        return self.tokens.pop()[0]
+
+    def expect(self, value):
+        if self.peek() != value:
+            raise self.error('Expected {!r}, got {!r}'.format(value, self.peek()))
+        self.next()
+
+    def identifier(self):
+        if not self.peek() or not (self.peek()[0].isalpha() or self.peek()[0] == '_'):
+            raise self.error('Expected a name, got {!r}'.format(self.peek()))
+        return self.next()
+
+    def number(self):
+        if not self.peek() or not self.peek().isdigit():
+            raise self.error('Expected a number, got {!r}'.format(self.peek()))
+        return int(self.next())
+
+    def parse(self):
+        self.expect('CHIP')
+        name = self.identifier()
+        self.expect('{')
+        inputs, outputs, parts, builtin = {}, {}, [], None
+        while self.peek() != '}':
+            token = self.next()
+            if token == 'IN':
+                self.parse_pins(inputs)
+            elif token == 'OUT':
+                self.parse_pins(outputs)
+            elif token == 'PARTS':
+                self.expect(':')
+                parts = self.parse_parts()
+            elif token == 'BUILTIN':
+                builtin = self.identifier()
+                self.expect(';')
+            elif token == 'CLOCKED':
+                # Which chips are clocked is known from REGISTERS and MEMORIES
+                while self.next() != ';':
+                    pass
+            else:
+                raise SyntaxError('{}: unexpected {!r}'.format(self.path.name, token))
+        self.expect('}')
+        return ChipDef(name, inputs, outputs, parts, builtin, self.path)
+
+    def parse_pins(self, pins):
+        while True:
+            name = self.identifier()
+            width = 1
+            if self.peek() == '[':
+                self.next()
+                width = self.number()
+                self.expect(']')
+            pins[name] = width
+            if self.next() == ';':
+                return
+
+    def parse_parts(self):
+        parts = []
+        while self.peek() not in ('}', 'BUILTIN', 'CLOCKED'):
+            name = self.identifier()
+            self.expect('(')
+            connections = []
+            while True:
+                pin, bits = self.parse_bus()
+                self.expect('=')
+                connections.append((pin, bits) + self.parse_bus())
+                if self.next() == ')':
+                    break
+            self.expect(';')
+            parts.append((name, connections))
+        return parts
+
+    def parse_bus(self):
+        name = self.identifier()
+        if self.peek() != '[':
+            return name, None
+        self.next()
+        lo = hi = self.number()
+        if self.peek() == '..':
+            self.next()
+            hi = self.number()
+        self.expect(']')
+        if hi < lo:
+            raise self.error('Invalid sub bus {}[{}..{}]'.format(name, lo, hi))
+        return name, (lo, hi)
+
+
+def read_hdl(path):
+    return HDLParser(path).parse()
+
+
+class NetlistCache:
+    """
+    Parsed and flattened chips of a chip directory, kept in its .hdlcache
+    directory between runs. Parsed chips are kept together in one file, by
+    path with the hash of their .hdl file. Each flattened chip has a file of
+    its own, named for the chip and the hash of the .hdl files of the chip
+    and its parts, so that a run only reads the chips it uses. Only the last
+    VERSIONS used versions of a chip are kept, enough to switch between fast
+    and gate-level memories.
+    """
+    DIRECTORY = '.hdlcache'
+    VERSIONS = 4
+
+    def __init__(self, directory):
+        self.directory = Path(directory, self.DIRECTORY)
+        self.version = self.simulator_version()
+        self.chips = {}
+        self.changed = False
+        try:
+            with open(str(self.directory / 'chips'), 'rb') as f:
+                version, chips = marshal.loads(f.read())
+            # A different simulator may parse chips differently
+            if version == self.version:
+                self.chips = chips
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+
+    @staticmethod
+    def simulator_version():
+        return hashlib.sha1(Path(__file__).read_bytes()).hexdigest()
+
+    def chip(self, path, digest):
+        entry = self.chips.get(str(path))
+        if entry and entry[0] == digest:
+            return ChipDef(*entry[1], path=path)
+
+    def add_chip(self, path, digest, chip):
+        self.chips[str(path)] = (
+            digest, (chip.name, chip.inputs, chip.outputs, chip.parts, chip.builtin))
+        self.changed = True
+
+    def flat_path(self, name, key):
+        # A different simulator may flatten chips differently
+        digest = hashlib.sha1('{} {}'.format(self.version, key).encode()).hexdigest()
+        return self.directory / '{}-{}.flat'.format(name, digest)
+
+    def flat(self, name, key):
+        path = self.flat_path(name, key)
+        try:
+            with open(str(path), 'rb') as f:
+                flat = marshal.loads(f.read())
+            os.utime(str(path))
+            return flat
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+
+    def add_flat(self, name, key, flat):
+        if not self.write(self.flat_path(name, key), flat):
+            return
+        try:
+            versions = sorted(self.directory.glob('{}-*.flat'.format(name)),
+                              key=lambda path: path.stat().st_mtime)
+            for path in versions[:-self.VERSIONS]:
+                path.unlink()
+        except OSError:
+            pass # pruned by another run at the same time
+
+    def write(self, path, data):
+        tmp = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+        try:
+            if self.directory.is_file():
+                self.directory.unlink() # the single .hdlcache file of older versions
+            self.directory.mkdir(exist_ok=True)
+            with open(str(tmp), 'wb') as f:
+                marshal.dump(data, f)
+            os.replace(str(tmp), str(path))
+            return True
+        except OSError:
+            return False # e.g. a read-only directory; the cache is only a speedup
+
+    def save(self):
+        if self.changed:
+            self.write(self.directory / 'chips', (self.version, self.chips))
+            self.changed = False
+
+
+class Library:
+    """
+    Chip definitions by name, from a chip directory or tools/builtInChips,
+    and the chips flattened down to built-in parts.
+
+    Each chip is flattened once, on its own, and the chips using it copy
+    its parts. With a NetlistCache, only chips whose .hdl file or parts
+    changed since the last run are parsed and flattened again.
+
+    With fast_memory, the FAST_MEMORIES chips are built-ins even where the
+    directory has an .hdl file, except for those named in gate_level.
+    """
+    def __init__(self, directory, cache=True, fast_memory=False, gate_level=()):
+        self.directory = Path(directory)
+        self.builtins = FAST_MEMORIES.difference(gate_level) if fast_memory else set()
+        self.chips = {}
+        self.digests = {} # .hdl file hashes
+        self.keys = {}
+        self.flats = {}
+        self.flattened = [] # chips not found in the cache, in order
+        self.cache = NetlistCache(self.directory) if cache else None
+
+    def chip(self, name):
+        if name not in self.chips:
+            path = self.directory / (name + '.hdl')
+            if name in self.builtins or not path.exists():
+                path = BUILTIN_CHIPS / (name + '.hdl')
+                if not path.exists():
+                    raise ValueError('Chip {} not found'.format(name))
+            data = path.read_bytes()
+            digest = hashlib.sha1(data).hexdigest()
+            chip = self.cache and self.cache.chip(path, digest)
+            if chip is None:
+                chip = HDLParser(path, data.decode(errors='replace')).parse()
+                if self.cache:
+                    self.cache.add_chip(path, digest, chip)
+            if chip.builtin and not (chip.name in COMBINATIONAL or chip.name in REGISTERS
+                                     or chip.name in MEMORIES or chip.name == 'Keyboard'):
+                raise ValueError('No built-in implementation of {}'.format(chip.name))
+            self.chips[name] = chip
+            self.digests[name] = digest
+        return self.chips[name]
+
+    def key(self, name):
+        """
+        Hash of the .hdl files of chip `name` and, recursively, its parts
+        """
+        if name not in self.keys:
+            chip = self.chip(name)
+            digest = hashlib.sha1(self.digests[name].encode())
+            for part in sorted({part for part, _ in chip.parts}):
+                digest.update('{}={}'.format(part, self.key(part)).encode())
+            self.keys[name] = digest.hexdigest()
+        return self.keys[name]
+
+    def flat(self, name, path=None):
+        """
+        Chip `name` flattened on its own, as (widths, parts, pins). Nets
+        0.. are its input pins in order, parts are (chip name, input
+        signals, output nets) and pins maps its pins and internal pins to
+        signals. path names the chip in error messages.
+        """
+        if name not in self.flats:
+            key = self.key(name)
+            flat = self.cache and self.cache.flat(name, key)
+            if flat is None:
+                flat = Flattener(self).flatten(self.chip(name), path or name)
+                self.flattened.append(name)
+                if self.cache:
+                    self.cache.add_flat(name, key, flat)
+            self.flats[name] = flat
+        return self.flats[name]
+
+    def save(self):
+        if self.cache:
+            self.cache.save()
+
+
+# A signal is a tuple of segments (source, shift, width, offset): bits
+# shift.. of source placed at bit offset. The source is a Wire while a chip
+# is being flattened and a net number after, or None for ones (true).
+# Bits not covered by a segment are 0.
+
+def sub_bus(signal, lo, hi):
+    segments = []
+    for source, shift, width, offset in signal:
+        a, b = max(lo, offset), min(hi, offset + width - 1)
+        if a <= b:
+            segments.append((source, shift + a - offset, b - a + 1, a - lo))
+    return tuple(segments)
+
+
+def move(signal, offset):
+    return tuple((source, shift, width, at + offset) for source, shift, width, at in signal)
+
+
+def merge(segments):
+    """
+    Sorts segments by offset and joins neighbouring bits of the same source
+    """
+    merged = []
+    for segment in sorted(segments, key=lambda segment: segment[3]):
+        if merged:
+            source, shift, width, offset = merged[-1]
+            if (segment[0] == source and segment[3] == offset + width
+                    and (source is None or segment[1] == shift + width)):
+                merged[-1] = (source, shift, width + segment[2], offset)
+                continue
+        merged.append(segment)
+    return tuple(merged)
+
+
+class Wire:
+    """
+    An output or internal pin of a composite chip, fed by the outputs of its
+    parts
+    """
+    __slots__ = ('width', 'drivers', 'fed', 'signal')
+
+    def __init__(self, width):
+        self.width = width
+        self.drivers = [] # (offset, signal)
+        self.fed = 0 # bits fed so far
+        self.signal = None
+
+    def feed(self, signal, lo, hi):
+        bits = (2 << hi) - (1 << lo)
+        if self.fed & bits:
+            return False
+        self.fed |= bits
+        self.drivers.append((lo, signal))
+        return True
+
+
+class Part:
+    """
+    A built-in part of the flattened chip. inputs maps its input pins to
+    signals and outputs maps its output pins to nets. index is its slot in
+    the register state or memory list.
+    """
+    __slots__ = ('chip', 'inputs', 'outputs', 'index')
+
+    def __init__(self, chip, inputs, outputs, index):
+        self.chip = chip
+        self.inputs = inputs
+        self.outputs = outputs
+        self.index = index
+
+
+class Flattener:
+    """
+    Flattens one chip down to built-in parts for Library.flat(). The parts
+    of the chip come flattened from the library and are copied in with
+    their nets renumbered.
+    """
+    def __init__(self, library):
+        self.library = library
+        self.widths = []
+        self.parts = [] # (chip name, input signals, output nets)
+
+    def flatten(self, chip, path):
+        self.widths = list(chip.inputs.values())
+        signals = {pin: ((net, 0, width, 0),)
+                   for net, (pin, width) in enumerate(chip.inputs.items())}
+        scope = self.elaborate(chip, signals, path)
+        parts = [(name, {pin: self.resolve(signal) for pin, signal in inputs.items()}, outputs)
+                 for name, inputs, outputs in self.parts]
+        pins = {pin: self.resolve(signal) for pin, signal in scope.items()}
+        return self.widths, parts, pins
+
+    def add_net(self, width):
+        self.widths.append(width)
+        return len(self.widths) - 1
+
+    def elaborate(self, chip, inputs, path):
+        """
+        Adds the parts of `chip` with input pins fed by `inputs`, and returns
+        its pins and internal pins as signals
+        """
+        if chip.builtin:
+            return self.add_part(chip, inputs)
+        wires = {pin: Wire(width) for pin, width in chip.outputs.items()}
+
+        def error(message, *args):
+            return ValueError('{}: {}'.format(path, message.format(*args)))
+
+        # Internal pins take the width of the part output feeding them
+        for name, connections in chip.parts:
+            part = self.library.chip(name)
+            for pin, bits, net, net_bits in connections:
+                if pin in part.outputs and net not in chip.inputs and net not in chip.outputs:
+                    if net in ('true', 'false'):
+                        raise error("Can't connect {}.{} to {}", name, pin, net)
+                    if net_bits:
+                        raise error("Internal pin {} can't be subscripted", net)
+                    if net in wires:
+                        raise error('Internal pin {} is fed more than once', net)
+                    lo, hi = bits or (0, part.outputs[pin] - 1)
+                    wires[net] = Wire(hi - lo + 1)
+
+        for name, connections in chip.parts:
+            part = self.library.chip(name)
+            signals = {pin: () for pin in part.inputs}
+            connected = dict.fromkeys(part.inputs, 0)
+            outputs = []
+            for pin, bits, net, net_bits in connections:
+                width = part.inputs.get(pin) or part.outputs.get(pin)
+                if width is None:
+                    raise error('{} has no pin {}', name, pin)
+                lo, hi = bits or (0, width - 1)
+                if hi >= width:
+                    raise error('Sub bus {}[{}..{}] out of range', pin, lo, hi)
+                if pin in part.outputs:
+                    outputs.append((pin, lo, hi, net, net_bits))
+                    continue
+                if connected[pin] & (2 << hi) - (1 << lo):
+                    raise error('Input pin {}.{} may only be connected once', name, pin)
+                connected[pin] |= (2 << hi) - (1 << lo)
+                if net == 'true':
+                    signal = ((None, 0, hi - lo + 1, 0),)
+                elif net == 'false':
+                    signal = ()
+                elif net in chip.inputs:
+                    a, b = net_bits or (0, chip.inputs[net] - 1)
+                    if b >= chip.inputs[net]:
+                        raise error('Sub bus {}[{}..{}] out of range', net, a, b)
+                    if b - a != hi - lo:
+                        raise error('Different bus widths: {}.{} and {}', name, pin, net)
+                    signal = sub_bus(inputs[net], a, b)
+                elif net in chip.outputs:
+                    raise error("Can't connect output pin {} to {}.{}", net, name, pin)
+                elif net in wires:
+                    if net_bits:
+                        raise error("Internal pin {} can't be subscripted", net)
+                    if wires[net].width != hi - lo + 1:
+                        raise error('Different bus widths: {}.{} and {}', name, pin, net)
+                    signal = ((wires[net], 0, wires[net].width, 0),)
+                else:
+                    raise error('Undefined internal pin {}', net)
+                signals[pin] += move(signal, lo)
+
+            pins = self.instantiate(name, signals, '{}.{}'.format(path, name))
+            for pin, lo, hi, net, net_bits in outputs:
+                signal = sub_bus(pins[pin], lo, hi)
+                if net in chip.inputs:
+                    raise error("Can't connect {}.{} to input pin {}", name, pin, net)
+                a, b = net_bits or (0, wires[net].width - 1)
+                if b >= wires[net].width:
+                    raise error('Sub bus {}[{}..{}] out of range', net, a, b)
+                if b - a != hi - lo:
+                    raise error('Different bus widths: {}.{} and {}', name, pin, net)
+                if not wires[net].feed(signal, a, b):
+                    raise error('Output pin {} is fed more than once', net)
+
+        scope = dict(inputs)
+        scope.update((name, ((wire, 0, wire.width, 0),)) for name, wire in wires.items())
+        return scope
+
+    def add_part(self, chip, inputs):
+        outputs = {pin: self.add_net(width) for pin, width in chip.outputs.items()}
+        self.parts.append((chip.name, inputs, outputs))
+        pins = dict(inputs)
+        pins.update((pin, ((net, 0, chip.outputs[pin], 0),)) for pin, net in outputs.items())
+        return pins
+
+    def instantiate(self, name, inputs, path):
+        """
+        Copies in the parts of chip `name` with its input pins fed by
+        `inputs`, and returns its output pins as signals
+        """
+        chip = self.library.chip(name)
+        widths, parts, pins = self.library.flat(name, path)
+        count = len(chip.inputs)
+        feeds = [inputs[pin] for pin in chip.inputs]
+        base = len(self.widths) - count
+        self.widths.extend(widths[count:])
+
+        def renumber(signal):
+            segments = []
+            fed = False
+            for source, shift, width, offset in signal:
+                if source is not None and source < count:
+                    segments.extend(move(sub_bus(feeds[source], shift, shift + width - 1), offset))
+                    fed = True
+                else:
+                    segments.append((source if source is None else source + base,
+                                     shift, width, offset))
+            # Only the bits fed from outside can be merged anew
+            return merge(segments) if fed else tuple(segments)
+
+        for part, part_inputs, outputs in parts:
+            self.parts.append((part, {pin: renumber(signal) for pin, signal in part_inputs.items()},
+                               {pin: net + base for pin, net in outputs.items()}))
+        return {pin: renumber(pins[pin]) for pin in chip.outputs}
+
+    def resolve(self, signal):
+        """
+        Returns `signal` with its wires replaced by the nets feeding them
+        """
+        if not any(isinstance(source, Wire) for source, _, _, _ in signal):
+            return signal
+        segments = []
+        for source, shift, width, offset in signal:
+            if isinstance(source, Wire):
+                if source.signal is None:
+                    source.signal = self.resolve(tuple(
+                        segment for lo, signal in source.drivers for segment in move(signal, lo)))
+                segments.extend(move(sub_bus(source.signal, shift, shift + width - 1), offset))
+            else:
+                segments.append((source, shift, width, offset))
+        return merge(segments)
+
+
+class Netlist:
+    """
+    A chip flattened down to built-in parts. Every net is driven by an input
+    pin of the chip or an output pin of a part. pins maps the chip's pins and
+    internal pins to signals of nets.
+    """
+    def __init__(self, library, name):
+        self.library = library
+        self.chip = library.chip(name)
+        widths, parts, self.pins = library.flat(name)
+        library.save()
+        self.widths = list(widths)
+        self.inputs = {pin: net for net, pin in enumerate(self.chip.inputs)}
+        self.parts = []
+        self.registers = 0
+        self.memories = []
+        for chip, inputs, outputs in parts:
+            if chip in REGISTERS:
+                index = self.registers
+                self.registers += 1
+            elif chip in MEMORIES:
+                index = len(self.memories)
+                self.memories.append([0] * MEMORIES[chip])
+            else:
+                index = None
+            self.parts.append(Part(chip, inputs, outputs, index))
+        self.order = self.sort()
+
+    def sort(self):
+        """
+        Returns the parts with combinational outputs, each after the parts
+        feeding it. Register outputs only change on the clock, so they
+        break loops.
+        """
+        drivers = {}
+        for part in self.parts:
+            if part.chip in COMBINATIONAL or part.chip in MEMORIES:
+                for net in part.outputs.values():
+                    drivers[net] = part
+        feeders = {}
+        for part in drivers.values():
+            signals = [part.inputs['address']] if part.chip in MEMORIES else part.inputs.values()
+            feeders[part] = [drivers[net] for signal in signals
+                             for net, _, _, _ in signal if net in drivers]
+        order = []
+        done = set()
+        visiting = set()
+        for root in feeders:
+            if root in done:
+                continue
+            # Depth-first without recursion, as flattened chips can be deep
+            stack = [(root, iter(feeders[root]))]
+            visiting.add(root)
+            while stack:
+                part, pending = stack[-1]
+                for feeder in pending:
+                    if feeder in done:
+                        continue
+                    if feeder in visiting:
+                        raise ValueError('{}: combinational loop through {}'.format(
+                            self.chip.name, feeder.chip))
+                    visiting.add(feeder)
+                    stack.append((feeder, iter(feeders[feeder])))
+                    break
+                else:
+                    stack.pop()
+                    visiting.discard(part)
+                    done.add(part)
+                    order.append(part)
+        return order
+
+    def live(self, nets):
+        """
+        Returns the combinational parts that `nets` follow, in order
+        """
+        live = []
+        used = set(nets)
+        for part in reversed(self.order):
+            if used.isdisjoint(part.outputs.values()):
+                continue
+            live.append(part)
+            signals = [part.inputs['address']] if part.chip in MEMORIES else part.inputs.values()
+            for signal in signals:
+                used.update(net for net, _, _, _ in signal)
+        live.reverse()
+        return live
+
+
+class Compiler:
+    """
+    Writes the Python source of the functions that evaluate a netlist:
+
+        evaluate(v)  recomputes the combinational nets
+        tick(v, s)   takes the next register values and memory writes
+        tock(v, s)   shows the register values on their outputs
+
+    v holds the values of the nets that are read outside evaluate(), s
+    the register values. Within evaluate() nets are local variables.
+    """
+    def __init__(self, netlist):
+        self.netlist = netlist
+
+    def local(self, net):
+        return 'n{}'.format(net)
+
+    def stored(self, net):
+        return 'v[{}]'.format(net)
+
+    def expression(self, signal, name):
+        """
+        Python expression for `signal`, with name(net) for each net
+        """
+        terms = []
+        ones = 0
+        for net, shift, width, offset in signal:
+            if net is None:
+                ones |= mask(width) << offset
+                continue
+            term = name(net)
+            if shift:
+                term = '{} >> {}'.format(term, shift)
+            if shift + width < self.netlist.widths[net]:
+                term = '{} & {}'.format(term, mask(width))
+            if offset:
+                term = '{} << {}'.format('({})'.format(term) if '&' in term else term, offset)
+            terms.append(term)
+        if ones or not terms:
+            terms.append(str(ones))
+        return ' | '.join(terms)
+
+    def arguments(self, part, name, template):
+        """
+        Format arguments for a template of `part`, with inputs that are used
+        more than once as temporaries
+        """
+        args = {}
+        lines = []
+        for pin, signal in part.inputs.items():
+            value = self.expression(signal, name)
+            if not RE_ATOM.match(value):
+                if template.count('{' + pin + '}') > 1 and name == self.local:
+                    lines.append('t_{} = {}'.format(pin, value))
+                    value = 't_' + pin
+                else:
+                    value = '(' + value + ')'
+            args[pin] = value
+        args.update((pin, name(net)) for pin, net in part.outputs.items())
+        args['memory'] = 'm{}'.format(part.index)
+        args['state'] = 's[{}]'.format(part.index)
+        return args, lines
+
+    def evaluate(self):
+        netlist = self.netlist
+        # Nets read outside evaluate(): pins of the chip and inputs of
+        # clocked parts
+        stored = set()
+        for signal in netlist.pins.values():
+            stored.update(net for net, _, _, _ in signal)
+        for part in netlist.parts:
+            if part.chip in REGISTERS or part.chip in MEMORIES:
+                for signal in part.inputs.values():
+                    stored.update(net for net, _, _, _ in signal)
+        stored.discard(None)
+
+        live = netlist.live(stored)
+        computed = {net for part in live for net in part.outputs.values()}
+        used = set(stored)
+        for part in live:
+            signals = [part.inputs['address']] if part.chip in MEMORIES else part.inputs.values()
+            for signal in signals:
+                used.update(net for net, _, _, _ in signal)
+        used.discard(None)
+        body = ['{} = v[{}]'.format(self.local(net), net)
+                for net in sorted(used - computed) if net is not None]
+        for part in live:
+            if part.chip in MEMORIES:
+                templates = {'out': '{memory}[{address}]'}
+            else:
+                templates = COMBINATIONAL[part.chip]
+            for pin, template in templates.items():
+                args, lines = self.arguments(part, self.local, template)
+                body.extend(lines)
+                output = self.local(part.outputs[pin])
+                body.append('{} = {}'.format(output, template.format(**args)))
+        body.extend('v[{}] = {}'.format(net, self.local(net)) for net in sorted(stored & computed))
+        return self.function('evaluate(v)', body)
+
+    def tick(self):
+        body = []
+        for part in self.netlist.parts:
+            if part.chip in REGISTERS:
+                args, _ = self.arguments(part, self.stored, REGISTERS[part.chip])
+                body.append('{} = {}'.format(args['state'], REGISTERS[part.chip].format(**args)))
+            elif part.chip in MEMORIES and part.chip not in READ_ONLY:
+                args, _ = self.arguments(part, self.stored, '')
+                body.append('if {load}:'.format(**args))
+                body.append('    {memory}[{address}] = {in}'.format(**args))
+        return self.function('tick(v, s)', body)
+
+    def tock(self):
+        return self.function('tock(v, s)', [
+            'v[{}] = s[{}]'.format(part.outputs['out'], part.index)
+            for part in self.netlist.parts if part.chip in REGISTERS])
+
+    def function(self, signature, body):
+        return 'def {}:\n'.format(signature) + ''.join(
+            '    {}\n'.format(line) for line in body or ['pass'])
+
+    def compile(self):
+        """
+        Returns the functions evaluate, tick and tock
+        """
+        namespace = {'alu': alu}
+        for n, memory in enumerate(self.netlist.memories):
+            namespace['m{}'.format(n)] = memory
+        source = '\n'.join([self.evaluate(), self.tick(), self.tock()])
+        exec(compile(source, '<{}>'.format(self.netlist.chip.name), 'exec'), namespace)
+        return namespace['evaluate'], namespace['tick'], namespace['tock']
+
+
+class Chip:
+    """
+    A chip for test scripts. Like the Java hardware simulator, set() only
+    changes an input pin; outputs follow on eval(), tick() or tock().
+    Registers and memories of built-in parts are named by their chip, e.g.
+    ARegister[] or RAM16K[12].
+    """
+    def __init__(self, netlist):
+        self.netlist = netlist
+        self.values = [0] * len(netlist.widths)
+        self.state = [0] * netlist.registers
+        compiler = Compiler(netlist)
+        self.evaluate, self._tick, self._tock = compiler.compile()
+        self.getters = {
+            pin: eval('lambda v: ' + compiler.expression(signal, compiler.stored))
+            for pin, signal in netlist.pins.items()
+        }
+        self.keyboards = [part.outputs['out'] for part in netlist.parts if part.chip == 'Keyboard']
+        self.evaluate(self.values)
+
+    def part(self, name):
+        for part in self.netlist.parts:
+            if part.chip == name and (part.chip in REGISTERS or part.chip in MEMORIES):
+                return part
+        raise ValueError('Unknown pin: {}'.format(name))
+
+    def set(self, name, value):
+        if name in self.netlist.inputs:
+            self.values[self.netlist.inputs[name]] = value & mask(self.netlist.chip.inputs[name])
+            return
+        match = RE_PIN.match(name)
+        part = self.part(match.group('name') if match else name)
+        if part.chip in REGISTERS:
+            self.state[part.index] = self.values[part.outputs['out']] = value
+        else:
+            self.netlist.memories[part.index][int(match.group('index'))] = value
+
+    def get(self, name):
+        if name in self.getters:
+            return self.getters[name](self.values)
+        match = RE_PIN.match(name)
+        part = self.part(match.group('name') if match else name)
+        if part.chip in REGISTERS:
+            return self.state[part.index]
+        return self.netlist.memories[part.index][int(match.group('index'))]
+
+    def eval(self):
+        self.evaluate(self.values)
+
+    def tick(self):
+        self.evaluate(self.values)
+        self._tick(self.values, self.state)
+
+    def tock(self):
+        self._tock(self.values, self.state)
+        self.evaluate(self.values)
+
+    def press(self, key):
+        for net in self.keyboards:
+            self.values[net] = key
+
+    def load(self, part, path):
+        memory = self.netlist.memories[self.part(part).index]
+        words = read_program(path)
+        if len(words) > len(memory):
+            raise ValueError('Program too large: {} instructions'.format(len(words)))
+        memory[:] = words + [0] * (len(memory) - len(words))
+
+
+# Batch evaluation. Bus bit i of n input vectors is one n-bit integer, a bit
+# plane, with the bit of the first vector as its most significant bit, so
+# each operation on planes evaluates the chip for every vector at once.
+# `ones` is the plane of all ones. The functions below return the output
+# planes of a built-in chip from its input planes, adding Python
+# statements with emit().
+
+def planewise(emit, template, *buses):
+    return [emit(template.format(*bits)) for bits in zip(*buses)]
+
+
+def sliced_mux(emit, a, b, sel):
+    return emit('{0} ^ ({0} ^ {1}) & {2}'.format(a, b, sel))
+
+
+def sliced_select(emit, inputs, sel):
+    # Mux tree over sel, lowest bit first
+    for s in sel:
+        inputs = [sliced_mux(emit, a, b, s) for a, b in zip(inputs[::2], inputs[1::2])]
+    return inputs[0]
+
+
+def sliced_decode(emit, value, sel):
+    # value & (sel == n) for each n
+    outputs = [value]
+    for s in reversed(sel):
+        ns = emit('{} ^ ones'.format(s))
+        outputs = [emit('{} & {}'.format(o, t)) for o in outputs for t in (ns, s)]
+    return outputs
+
+
+def sliced_add(emit, a, b, carry='0'):
+    # Returns the sum and the carry out
+    out = []
+    for x, y in zip(a, b):
+        t = emit('{} ^ {}'.format(x, y))
+        out.append(emit('{} ^ {}'.format(t, carry)))
+        carry = emit('{} & {} | {} & {}'.format(x, y, carry, t))
+    return out, carry
+
+
+def sliced_increment(emit, a):
+    out = []
+    carry = 'ones'
+    for x in a:
+        out.append(emit('{} ^ {}'.format(x, carry)))
+        carry = emit('{} & {}'.format(x, carry))
+    return out
+
+
+def sliced_alu(emit, p):
+    x = planewise(emit, '{} & ({} ^ ones)', p['x'], p['zx'] * 16)
+    x = planewise(emit, '{} ^ {}', x, p['nx'] * 16)
+    y = planewise(emit, '{} & ({} ^ ones)', p['y'], p['zy'] * 16)
+    y = planewise(emit, '{} ^ {}', y, p['ny'] * 16)
+    total, _ = sliced_add(emit, x, y)
+    both = planewise(emit, '{} & {}', x, y)
+    out = [sliced_mux(emit, a, b, p['f'][0]) for a, b in zip(both, total)]
+    out = planewise(emit, '{} ^ {}', out, p['no'] * 16)
+    return {'out': out, 'zr': [emit('({}) ^ ones'.format(' | '.join(out)))], 'ng': [out[15]]}
+
+
+def sliced_full_adder(emit, p):
+    out, carry = sliced_add(emit, p['a'], p['b'], p['c'][0])
+    return {'sum': out, 'carry': [carry]}
+
+
+def sliced_demux(pins):
+    return lambda emit, p: dict(zip(pins, (
+        [plane] for plane in sliced_decode(emit, p['in'][0], p['sel']))))
+
+
+SLICED = {
+    'Nand': lambda emit, p: {'out': planewise(emit, '{} & {} ^ ones', p['a'], p['b'])},
+    'Not': lambda emit, p: {'out': planewise(emit, '{} ^ ones', p['in'])},
+    'And': lambda emit, p: {'out': planewise(emit, '{} & {}', p['a'], p['b'])},
+    'Or': lambda emit, p: {'out': planewise(emit, '{} | {}', p['a'], p['b'])},
+    'Xor': lambda emit, p: {'out': planewise(emit, '{} ^ {}', p['a'], p['b'])},
+    'Mux': lambda emit, p: {'out': [sliced_mux(emit, p['a'][0], p['b'][0], p['sel'][0])]},
+    'DMux': sliced_demux('ab'),
+    'Not16': lambda emit, p: {'out': planewise(emit, '{} ^ ones', p['in'])},
+    'And16': lambda emit, p: {'out': planewise(emit, '{} & {}', p['a'], p['b'])},
+    'Or16': lambda emit, p: {'out': planewise(emit, '{} | {}', p['a'], p['b'])},
+    'Mux16': lambda emit, p: {'out': [
+        sliced_mux(emit, a, b, p['sel'][0]) for a, b in zip(p['a'], p['b'])]},
+    'Or8Way': lambda emit, p: {'out': [emit(' | '.join(p['in']))]},
+    'Mux4Way16': lambda emit, p: {'out': [
+        sliced_select(emit, bits, p['sel']) for bits in zip(*(p[pin] for pin in 'abcd'))]},
+    'Mux8Way16': lambda emit, p: {'out': [
+        sliced_select(emit, bits, p['sel']) for bits in zip(*(p[pin] for pin in 'abcdefgh'))]},
+    'DMux4Way': sliced_demux('abcd'),
+    'DMux8Way': sliced_demux('abcdefgh'),
+    'HalfAdder': lambda emit, p: dict(zip(('sum', 'carry'), [
+        planewise(emit, '{} ^ {}', p['a'], p['b']),
+        planewise(emit, '{} & {}', p['a'], p['b'])])),
+    'FullAdder': sliced_full_adder,
+    'Add16': lambda emit, p: {'out': sliced_add(emit, p['a'], p['b'])[0]},
+    'Inc16': lambda emit, p: {'out': sliced_increment(emit, p['in'])},
+    'ALU': sliced_alu,
+}
+
+
+def to_planes(values, width):
+    """
+    Bit planes 0..width-1 of a sequence of unsigned values that fit in
+    `width` bits
+    """
+    if not values:
+        return [0] * width
+    if width <= 8:
+        size, words = 8, bytes(values)
+    else:
+        size, words = 16, array('H', values)
+        if sys.byteorder == 'little':
+            words.byteswap()
+        words = words.tobytes()
+    # Value k is bits size*k.. of the string, most significant first
+    bits = format(int.from_bytes(words, 'big'), '0{}b'.format(size * len(values)))
+    return [int(bits[size - 1 - i::size], 2) for i in range(width)]
+
+
+def from_planes(planes, count):
+    """
+    The `count` values that the bit planes hold
+    """
+    if not count:
+        return []
+    size = 8 if len(planes) <= 8 else 16
+    bits = bytearray(b'0' * (size * count))
+    for i, plane in enumerate(planes):
+        bits[size - 1 - i::size] = format(plane, '0{}b'.format(count)).encode()
+    words = int(bits, 2).to_bytes(size // 8 * count, 'big')
+    if size == 8:
+        return list(words)
+    words = array('H', words)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words.tolist()
+
+
+class BatchCompiler:
+    """
+    Writes evaluate(P, ones) for a combinational netlist, which takes the
+    bit planes of the input pins by name and returns those of the outputs
+    """
+    def __init__(self, netlist):
+        self.netlist = netlist
+        self.body = []
+        self.planes = {} # net -> plane names
+
+    def emit(self, expression):
+        name = 'b{}'.format(len(self.body))
+        self.body.append('{} = {}'.format(name, expression))
+        return name
+
+    def bits(self, signal, width):
+        bits = ['0'] * width
+        for net, shift, length, offset in signal:
+            for i in range(length):
+                bits[offset + i] = 'ones' if net is None else self.planes[net][shift + i]
+        return bits
+
+    def evaluate(self):
+        netlist = self.netlist
+        for pin, net in netlist.inputs.items():
+            self.planes[net] = [self.emit('P[{!r}][{}]'.format(pin, i))
+                                for i in range(netlist.widths[net])]
+        outputs = netlist.chip.outputs
+        for part in netlist.live(net for pin in outputs for net, _, _, _ in netlist.pins[pin]):
+            pins = netlist.library.chip(part.chip).inputs
+            planes = SLICED[part.chip](self.emit, {
+                pin: self.bits(signal, pins[pin]) for pin, signal in part.inputs.items()})
+            for pin, net in part.outputs.items():
+                self.planes[net] = planes[pin]
+        self.body.append('return {{{}}}'.format(', '.join(
+            '{!r}: [{}]'.format(pin, ', '.join(self.bits(netlist.pins[pin], width)))
+            for pin, width in outputs.items())))
+        return 'def evaluate(P, ones):\n' + ''.join('    {}\n'.format(line) for line in self.body)
+
+    def compile(self):
+        for part in self.netlist.parts:
+            if part.chip not in SLICED:
+                raise ValueError('{} is not combinational: it has a {}'.format(
+                    self.netlist.chip.name, part.chip))
+        namespace = {}
+        source = self.evaluate()
+        exec(compile(source, '<{} batch>'.format(self.netlist.chip.name), 'exec'), namespace)
+        return namespace['evaluate']
+
+
+class BatchChip:
+    """
+    A combinational chip evaluated for many input vectors at once
+    """
+    def __init__(self, netlist):
+        self.netlist = netlist
+        self.evaluate = BatchCompiler(netlist).compile()
+
+    def run(self, inputs):
+        """
+        inputs maps input pins to sequences of unsigned values, one for each
+        vector; pins left out are 0. Returns lists of the output values by
+        pin.
+        """
+        counts = {len(values) for values in inputs.values()}
+        if len(counts) > 1:
+            raise ValueError('Input pins have different numbers of values')
+        count = counts.pop() if counts else 0
+        planes = {pin: to_planes(inputs.get(pin, ()), width)
+                  for pin, width in self.netlist.chip.inputs.items()}
+        outputs = self.evaluate(planes, (1 << count) - 1)
+        return {pin: from_planes(planes, count) for pin, planes in outputs.items()}
+
+
+def load_chip(path, cache=True, fast_memory=False, gate_level=()):
+    """
+    Chip for a test script `load` command. The loaded chip itself is always
+    gate-level, as it is the one under test.
+    """
+    path = Path(path)
+    library = Library(path.parent, cache, fast_memory, {path.stem, *gate_level})
+    return Chip(Netlist(library, path.stem))
+
+
+def run_script(path, cache=True, fast_memory=False, gate_level=()):
+    """
+    Runs a test script and returns the number of the first output line that
+    differs from its compare-to file, or None
+    """
+    script = TestScript(path, lambda path: load_chip(path, cache, fast_memory, gate_level))
+    script.run()
+    if script.compare_file:
+        return script.compare()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run hardware test scripts')
+    parser.add_argument('scripts', nargs='+', help='.tst test scripts')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='parse and flatten every chip, ignoring the .hdlcache files')
+    parser.add_argument('-m', '--fast-memory', action='store_true',
+                        help='run RAM8..RAM16K, Screen, Keyboard and ROM32K as built-ins, '
+                             'even where there is an .hdl file for them')
+    parser.add_argument('-g', '--gate-level', action='append', default=[], metavar='CHIP',
+                        help='with --fast-memory, still run CHIP from its .hdl file')
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.scripts:
+        try:
+            line = run_script(path, not args.no_cache, args.fast_memory, args.gate_level)
+        except (SyntaxError, ValueError) as e:
+            print('{}: {}'.format(path, e))
+            failed = True
+            continue
+        if line:
+            print('{}: Comparison failure at line {}'.format(path, line))
+            failed = True
+        else:
+            print('{}: End of script - Comparison ended successfully'.format(path))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
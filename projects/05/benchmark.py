@@ -0,0 +1,325 @@
+"""
+CPU emulator benchmarks
+
+Usage: python3 benchmark.py [name ...]
+"""
+
+import sys
+import re
+import time
+import random
+import tempfile
+import shutil
+from pathlib import Path
+
+from CPUEmulator import Computer, read_program, run_script, ALU
+from HardwareSimulator import (
+    Chip, BatchChip, Netlist, Library, BUILTIN_CHIPS,
+    COMBINATIONAL, REGISTERS, MEMORIES, READ_ONLY, alu, load_chip)
+from testscript import TestScript
+
+HERE = Path(__file__).resolve().parent
+PROJECTS = HERE.parent
+
+
+def run_undecoded(words, cycles):
+    """
+    Decodes every instruction from its binary string as it runs, for
+    comparison with Computer.run()
+    """
+    rom = ['{:016b}'.format(word) for word in words]
+    ram = [0] * 32768
+    a = d = pc = 0
+    for _ in range(cycles):
+        ins = rom[pc]
+        if ins[0] == '0':
+            a = int(ins, 2)
+            pc += 1
+            continue
+        out = ALU[int(ins[3:10], 2)](d, a, ram[a & 0x7FFF])
+        negative, zero = out & 0x8000, out == 0
+        if (ins[13] == '1' and negative or ins[14] == '1' and zero
+                or ins[15] == '1' and not negative and not zero):
+            target = a
+        else:
+            target = pc + 1
+        if ins[12] == '1':
+            ram[a & 0x7FFF] = out
+        if ins[10] == '1':
+            a = out
+        if ins[11] == '1':
+            d = out
+        pc = target & 0x7FFF
+
+
+# CPU.hdl in this directory does not load (its Or part has pin a connected
+# twice), so the hardware benchmark builds Computer.hdl with this CPU
+CPU_HDL = '''
+CHIP CPU {
+    IN inM[16], instruction[16], reset;
+    OUT outM[16], writeM, addressM[15], pc[15];
+
+    PARTS:
+    Not(in=instruction[15], out=isA);
+    Mux16(a=instruction, b=aluOut, sel=instruction[15], out=aIn);
+    Or(a=isA, b=instruction[5], out=loadA);
+    ARegister(in=aIn, load=loadA, out=aOut, out[0..14]=addressM);
+    And(a=instruction[15], b=instruction[4], out=loadD);
+    DRegister(in=aluOut, load=loadD, out=dOut);
+    Mux16(a=aOut, b=inM, sel=instruction[12], out=am);
+    ALU(x=dOut, y=am, zx=instruction[11], nx=instruction[10], zy=instruction[9],
+        ny=instruction[8], f=instruction[7], no=instruction[6],
+        out=aluOut, out=outM, zr=zr, ng=ng);
+    And(a=instruction[15], b=instruction[3], out=writeM);
+    Or(a=zr, b=ng, out=notPos);
+    Not(in=notPos, out=pos);
+    And(a=instruction[0], b=pos, out=jgt);
+    And(a=instruction[1], b=zr, out=jeq);
+    And(a=instruction[2], b=ng, out=jlt);
+    Or(a=jgt, b=jeq, out=j1);
+    Or(a=j1, b=jlt, out=j2);
+    And(a=instruction[15], b=j2, out=jump);
+    PC(in=aOut, load=jump, inc=true, reset=reset, out[0..14]=pc);
+}
+'''
+
+
+def computer_netlist():
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('Computer.hdl', 'Memory.hdl'):
+            shutil.copy(str(HERE / name), directory)
+        (Path(directory) / 'CPU.hdl').write_text(CPU_HDL)
+        return Netlist(Library(directory), 'Computer')
+
+
+def run_interpreted(netlist, cycles):
+    """
+    Evaluates the netlist one part at a time, reading every pin through its
+    signal, for comparison with the compiled Chip
+    """
+    values = [0] * len(netlist.widths)
+    state = [0] * netlist.registers
+
+    def read(signal):
+        value = 0
+        for net, shift, width, offset in signal:
+            bits = (1 << width) - 1 if net is None else values[net] >> shift & (1 << width) - 1
+            value |= bits << offset
+        return value
+
+    def function(template):
+        # Pins become p['name'] in the template
+        pins = {name: "p['{}']".format(name) for name in
+                ('a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'x', 'y', 'zx', 'nx', 'zy', 'ny',
+                 'no', 'in', 'sel', 'load', 'inc', 'reset', 'out', 'address', 'memory', 'state')}
+        return eval('lambda p: ' + template.format(**pins), {'alu': alu})
+
+    steps = []
+    for part in netlist.order:
+        if part.chip in MEMORIES:
+            templates = {'out': '{memory}[{address}]'}
+        else:
+            templates = COMBINATIONAL[part.chip]
+        steps.append((part, [(pin, part.outputs[pin], function(template))
+                             for pin, template in templates.items()]))
+    registers = [(part, function(REGISTERS[part.chip]))
+                 for part in netlist.parts if part.chip in REGISTERS]
+    memories = [part for part in netlist.parts
+                if part.chip in MEMORIES and part.chip not in READ_ONLY]
+
+    def evaluate():
+        for part, outputs in steps:
+            p = {pin: read(signal) for pin, signal in part.inputs.items()}
+            if part.chip in MEMORIES:
+                p['memory'] = netlist.memories[part.index]
+            for pin, net, output in outputs:
+                p[pin] = values[net] = output(p)
+
+    for _ in range(cycles):
+        evaluate()
+        for part in memories:
+            p = {pin: read(signal) for pin, signal in part.inputs.items()}
+            if p['load']:
+                netlist.memories[part.index][p['address']] = p['in']
+        for part, next_state in registers:
+            p = {pin: read(signal) for pin, signal in part.inputs.items()}
+            p['state'] = state[part.index]
+            state[part.index] = next_state(p)
+        for part, _ in registers:
+            values[part.outputs['out']] = state[part.index]
+        evaluate()
+
+
+def run_compiled(netlist, cycles):
+    chip = Chip(netlist)
+    for _ in range(cycles):
+        chip.tick()
+        chip.tock()
+
+
+def bench_hardware(cycles=10 ** 5):
+    print('Hardware simulator, Computer.hdl (projects/06 Pong.asm, {:,} clock cycles)'.format(cycles))
+    words = read_program(PROJECTS / '06' / 'pong' / 'Pong.asm')
+    rates = {}
+    for name, run, n in [
+        ('interpreted', run_interpreted, cycles // 10),
+        ('compiled', run_compiled, cycles),
+    ]:
+        netlist = computer_netlist()
+        rom = netlist.memories[next(part.index for part in netlist.parts if part.chip == 'ROM32K')]
+        rom[:len(words)] = words
+        start = time.process_time()
+        run(netlist, n)
+        elapsed = time.process_time() - start
+        rates[name] = n / elapsed
+        print('  {:<12} {:>8.3f}s {:>12,.0f} cycles/sec'.format(name, elapsed, rates[name]))
+    print('  speedup      {:>8.1f}x'.format(rates['compiled'] / rates['interpreted']))
+
+
+def bench_batch(vectors=10 ** 6, single=2 * 10 ** 4):
+    print('Batch evaluation (projects/02 ALU.hdl, {:,} random input vectors)'.format(vectors))
+    netlist = Netlist(Library(PROJECTS / '02'), 'ALU')
+    random.seed(0)
+    inputs = {pin: [random.getrandbits(width) for _ in range(vectors)]
+              for pin, width in netlist.chip.inputs.items()}
+
+    chip = Chip(netlist)
+    start = time.process_time()
+    for k in range(single):
+        for pin, values in inputs.items():
+            chip.set(pin, values[k])
+        chip.eval()
+        for pin in netlist.chip.outputs:
+            chip.get(pin)
+    elapsed = time.process_time() - start
+    per_vector = single / elapsed
+    print('  {:<12} {:>8.3f}s {:>12,.0f} vectors/sec'.format('per vector', elapsed, per_vector))
+
+    batch = BatchChip(netlist)
+    start = time.process_time()
+    outputs = batch.run(inputs)
+    elapsed = time.process_time() - start
+    print('  {:<12} {:>8.3f}s {:>12,.0f} vectors/sec'.format('batch', elapsed, vectors / elapsed))
+    print('  speedup      {:>8.1f}x'.format(vectors / elapsed / per_vector))
+
+    expected = BatchChip(Netlist(Library(BUILTIN_CHIPS, cache=False), 'ALU')).run(inputs)
+    for pin in netlist.chip.outputs:
+        differ = sum(a != b for a, b in zip(outputs[pin], expected[pin]))
+        print('  {:<12} differs from the built-in ALU on {:,} vectors'.format(pin, differ))
+
+
+def bench_elaborate():
+    print('Elaboration, gate-level Computer.hdl (projects/01-03 chips)')
+    with tempfile.TemporaryDirectory() as directory:
+        for path in [*(PROJECTS / '01').glob('*.hdl'), *(PROJECTS / '02').glob('*.hdl'),
+                     *(PROJECTS / '03' / 'a').glob('*.hdl'), HERE / 'Computer.hdl', HERE / 'Memory.hdl']:
+            shutil.copy(str(path), directory)
+        (Path(directory) / 'CPU.hdl').write_text(CPU_HDL)
+        for name, edit in [
+            ('no cache', None),
+            ('cold', None),
+            ('warm', None),
+            ('edited leaf', 'HalfAdder.hdl'),
+        ]:
+            if edit:
+                with open(str(Path(directory) / edit), 'a') as f:
+                    f.write('// edited\n')
+            start = time.process_time()
+            library = Library(directory, cache=name != 'no cache')
+            netlist = Netlist(library, 'Computer')
+            elapsed = time.process_time() - start
+            print('  {:<12} {:>8.3f}s {:>6,} parts, {} chips flattened'.format(
+                name, elapsed, len(netlist.parts), len(library.flattened)))
+
+
+def bench_memory(cycles=2000):
+    print('Fast memory, ComputerRect.tst with the projects/01-03 chips '
+          '(then {:,} more clock cycles)'.format(cycles))
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        # Not ALU.hdl, whose zr and ng are wrong, nor PC.hdl, as the script
+        # reads PC[] of the built-in PC
+        for path in [*(PROJECTS / '01').glob('*.hdl'), *(PROJECTS / '02').glob('*.hdl'),
+                     *(PROJECTS / '03').glob('*/*.hdl')]:
+            if path.name not in ('ALU.hdl', 'PC.hdl'):
+                shutil.copy(str(path), str(directory))
+        for name in ('Computer.hdl', 'Memory.hdl', 'ComputerRect.tst', 'ComputerRect.cmp', 'Rect.hack'):
+            shutil.copy(str(HERE / name), str(directory))
+        (directory / 'CPU.hdl').write_text(CPU_HDL)
+        # A gate-level RAM16K has no RAM16K[] to set or read
+        script = (directory / 'ComputerRect.tst').read_text()
+        (directory / 'ComputerGate.tst').write_text(
+            re.sub(r'RAM16K\[\d+\]%[^\s;]+|set RAM16K\[0\] 4,|compare-to \S+,', '', script))
+
+        for name, gate_level in [
+            ('fast', ()),
+            ('RAM16K..RAM4K', ('RAM16K', 'RAM4K')),
+            ('RAM16K..RAM512', ('RAM16K', 'RAM4K', 'RAM512')),
+        ]:
+            chips = []
+
+            def load(path):
+                chips.append(load_chip(path, cache=False, fast_memory=True, gate_level=gate_level))
+                return chips[-1]
+
+            script = TestScript(directory / ('ComputerGate.tst' if gate_level else 'ComputerRect.tst'),
+                                load)
+            start = time.process_time()
+            script.run(write=False)
+            elapsed = time.process_time() - start
+            line = script.compare() if script.compare_file else None
+            chip = chips[0]
+            start = time.process_time()
+            for _ in range(cycles):
+                chip.tick()
+                chip.tock()
+            rate = cycles / (time.process_time() - start)
+            print('  {:<15} {:>8,} parts {:>8.3f}s {:<9} {:>10,.0f} cycles/sec'.format(
+                name, len(chip.netlist.parts), elapsed,
+                'failed at line {}'.format(line) if line else 'ok' if script.compare_file else 'ran',
+                rate))
+
+
+def bench_emulator(cycles=5 * 10 ** 6):
+    print('Emulator throughput (projects/06 Pong.asm, {:,} instructions)'.format(cycles))
+    words = read_program(PROJECTS / '06' / 'pong' / 'Pong.asm')
+    for name, run in [
+        ('undecoded', lambda: run_undecoded(words, cycles)),
+        ('decoded', lambda: Computer(words).run(cycles)),
+    ]:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print('  {:<10} {:>8.3f}s {:>12,.0f} instructions/sec'.format(
+            name, elapsed, cycles / elapsed))
+
+
+def bench_scripts():
+    print('Test scripts (projects/05)')
+    for path in sorted(HERE.glob('*.tst')):
+        if path.stem == 'Memory':
+            continue
+        start = time.perf_counter()
+        line = run_script(path)
+        elapsed = time.perf_counter() - start
+        print('  {:<26} {:>8.3f}s {}'.format(
+            path.name, elapsed, 'failed at line {}'.format(line) if line else 'ok'))
+
+
+BENCHMARKS = {
+    'emulator': bench_emulator,
+    'scripts': bench_scripts,
+    'hardware': bench_hardware,
+    'batch': bench_batch,
+    'elaborate': bench_elaborate,
+    'memory': bench_memory,
+}
+
+
+def main():
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/bin/env python3
+"""
+Runs test scripts on the Python simulators and emulators, in parallel
+
+Usage: python3 runtests.py [path ...] [-j jobs] [-e]
+
+Finds the .tst scripts under each path, all of projects/ by default, runs
+them on a pool of processes and compares their output with the compare-to
+file in memory, without writing .out files. What a script loads picks the
+backend:
+
+    .hdl             HardwareSimulator.py, or with --emulate the CPU
+                     emulator's CPU and Computer for CPU.hdl/Computer.hdl
+    .hack, .asm      CPUEmulator.py. A missing .hack is assembled from the
+                     .asm of the same name, and a missing .asm translated
+                     from the .vm files next to it.
+    .vm, directory   projects/08 vmemulator.py
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+import time
+import signal
+import argparse
+
+from testscript import TestScript
+import CPUEmulator
+import HardwareSimulator
+
+HERE = Path(__file__).resolve().parent
+PROJECTS = HERE.parent
+
+sys.path.insert(0, str(PROJECTS / '08'))
+import vmtranslator
+import vmemulator
+sys.path.pop(0)
+
+EMULATED = ('CPU.hdl', 'Computer.hdl')
+
+
+def translate(path):
+    """
+    ROM words for the .asm file `path`, translated from the .vm files in its
+    directory. One file is translated alone, several with bootstrap code.
+    """
+    vmfiles = sorted(path.parent.glob('*.vm'))
+    if not vmfiles:
+        raise FileNotFoundError('{} not found'.format(path))
+    lines = vmtranslator.translate(vmfiles, bootstrap=len(vmfiles) > 1)
+    return CPUEmulator.import_assembler().Assembler().assemble_stream(lines)
+
+
+def backend(path, emulate=False):
+    """
+    Name of the backend that loads `path`: hardware, cpu or vm
+    """
+    path = Path(path)
+    if path.suffix == '.hdl' and not (emulate and path.name in EMULATED):
+        return 'hardware'
+    elif path.suffix in ('.hdl', '.hack', '.asm', '.bin'):
+        return 'cpu'
+    return 'vm'
+
+
+def load_chip(path, emulate=False):
+    """
+    Chip for a test script `load` command
+    """
+    path = Path(path)
+    name = backend(path, emulate)
+    if name == 'hardware':
+        return HardwareSimulator.load_chip(path)
+    elif name == 'vm':
+        return vmemulator.load_chip(path)
+    elif path.suffix == '.hack' and not path.exists() and path.with_suffix('.asm').exists():
+        return CPUEmulator.load_chip(path.with_suffix('.asm'))
+    elif path.suffix == '.asm' and not path.exists():
+        return CPUEmulator.ComputerChip(translate(path))
+    return CPUEmulator.load_chip(path)
+
+
+class Timeout(Exception):
+    pass
+
+
+def alarm(signum, frame):
+    raise Timeout()
+
+
+def run_script(path, emulate=False, timeout=None):
+    """
+    Runs a test script and returns (backends, result, seconds). The result
+    is 'ok', 'failed at line n', 'no compare file' or an error.
+    """
+    backends = []
+
+    def load(target):
+        if backend(target, emulate) not in backends:
+            backends.append(backend(target, emulate))
+        return load_chip(target, emulate)
+
+    if timeout and hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, alarm)
+        signal.alarm(timeout)
+    start = time.perf_counter()
+    try:
+        script = TestScript(path, load)
+        script.run(write=False)
+        if not script.compare_file:
+            result = 'no compare file'
+        else:
+            line = script.compare()
+            result = 'failed at line {}'.format(line) if line else 'ok'
+    except Timeout:
+        result = 'timed out after {}s'.format(timeout)
+    except Exception as e:
+        result = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if timeout and hasattr(signal, 'SIGALRM'):
+            signal.alarm(0)
+    return ', '.join(backends) or '-', result, time.perf_counter() - start
+
+
+def find_scripts(paths):
+    scripts = set()
+    for path in map(Path, paths):
+        if path.is_dir():
+            scripts.update(path.rglob('*.tst'))
+        else:
+            scripts.add(path)
+    return sorted(path.resolve() for path in scripts)
+
+
+def run_all(scripts, jobs=1, emulate=False, timeout=None):
+    """
+    Runs the scripts on a pool of `jobs` processes and returns their
+    run_script() results, in order
+    """
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(run_script, scripts, [emulate] * len(scripts),
+                                 [timeout] * len(scripts)))
+    return [run_script(path, emulate, timeout) for path in scripts]
+
+
+def name(path):
+    try:
+        return str(path.relative_to(PROJECTS))
+    except ValueError:
+        return str(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run test scripts and compare their output')
+    parser.add_argument('paths', nargs='*', default=[str(PROJECTS)],
+                        help='.tst files or directories to search (default: all projects)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of scripts to run in parallel (default: %(default)s)')
+    parser.add_argument('-e', '--emulate', action='store_true',
+                        help='run CPU.hdl and Computer.hdl on the CPU emulator')
+    parser.add_argument('-t', '--timeout', type=int, default=120,
+                        help='seconds a script may run (default: %(default)s)')
+    args = parser.parse_args()
+
+    scripts = find_scripts(args.paths)
+    start = time.perf_counter()
+    results = run_all(scripts, args.jobs, args.emulate, args.timeout)
+    elapsed = time.perf_counter() - start
+
+    width = max([len(name(path)) for path in scripts] + [6])
+    print('{:<{}}  {:<8} {:>8}  {}'.format('script', width, 'backend', 'seconds', 'result'))
+    for path, (backends, result, seconds) in zip(scripts, results):
+        print('{:<{}}  {:<8} {:>8.3f}  {}'.format(name(path), width, backends, seconds, result))
+
+    passed = sum(result in ('ok', 'no compare file') for _, result, _ in results)
+    failed = sum(result.startswith('failed') for _, result, _ in results)
+    print('\n{} scripts: {} passed, {} failed, {} errors in {:.2f}s '
+          '({:.2f}s of scripts on {} processes)'.format(
+              len(results), passed, failed, len(results) - passed - failed, elapsed,
+              sum(seconds for _, _, seconds in results), args.jobs))
+    if passed < len(results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+Runner for the nand2tetris test script language (.tst)
+
+A script drives a chip through a small interface, so the same runner works
+for any simulator:
+
+    chip.set(name, value)     set pin/register/memory `name`
+    chip.get(name)            current value of `name`
+    chip.eval()               recompute combinational outputs
+    chip.tick(), chip.tock()  first and second half of a clock cycle
+    chip.vmstep(count)        run `count` VM commands (VM emulator only)
+    chip.ticktock(count)      run `count` clock cycles at once (optional)
+    chip.load(part, path)     `<part> load <file>`, e.g. ROM32K load Max.hack
+    chip.press(key)           hold down a key, 0 to let go (optional)
+
+The chip itself comes from `load <file>`, which is handed to the `load`
+callable given to TestScript.
+
+Scripts that ask for a key in an echo message, like the "hold down the 'K'
+key" of projects/05 Memory.tst, have the key pressed for them until the
+message is cleared.
+"""
+
+import re
+from pathlib import Path
+
+RE_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<comment>//[^\n]*|/\*.*?\*/) |
+        (?P<punct>[,;{}]) |
+        (?P<word>"[^"]*"|[^\s,;{}]+)
+    )''', re.VERBOSE | re.DOTALL)
+RE_KEY = re.compile(r"hold down (?:the )?'(.)'", re.IGNORECASE)
+RE_COLUMN = re.compile(r'(?P<name>[^%]+)%(?P<fmt>[BDSX])(?P<left>\d+)\.(?P<width>\d+)\.(?P<right>\d+)$')
+
+CONDITIONS = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def parse_value(s):
+    # %B0101, %X1F, %D-3 or plain decimal
+    base = {'%B': 2, '%X': 16, '%D': 10}.get(s[:2].upper())
+    if base:
+        return int(s[2:], base)
+    return int(s)
+
+
+def to_signed(value):
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+class Column:
+    """
+    One entry of an output-list, e.g. RAM16K[0]%D1.7.1
+    """
+    def __init__(self, spec):
+        match = RE_COLUMN.match(spec)
+        if not match:
+            raise SyntaxError('Invalid output-list entry: {}'.format(spec))
+        self.name = match.group('name')
+        self.fmt = match.group('fmt')
+        self.left = int(match.group('left'))
+        self.width = int(match.group('width'))
+        self.right = int(match.group('right'))
+
+    def header(self):
+        total = self.left + self.width + self.right
+        name = self.name[:total]
+        pad = total - len(name)
+        return ' ' * (pad // 2) + name + ' ' * (pad - pad // 2)
+
+    def format(self, value):
+        if self.fmt == 'S':
+            s = str(value)[:self.width].ljust(self.width)
+        elif self.fmt == 'D':
+            s = str(to_signed(value)).rjust(self.width)
+        elif self.fmt == 'B':
+            s = format(value & 0xFFFF, '016b')
+        else:
+            s = format(value & 0xFFFF, '04X')
+        return ' ' * self.left + s[-self.width:] + ' ' * self.right
+
+
+def parse(data):
+    """
+    Returns the script as a list of commands. A command is a tuple of words,
+    or ('repeat', count, body) / ('while', condition, body) for blocks.
+    """
+    tokens = []
+    pos = 0
+    data = data.rstrip()
+    while pos < len(data):
+        match = RE_TOKEN.match(data, pos)
+        if not match:
+            raise SyntaxError('Invalid script at offset {}'.format(pos))
+        pos = match.end()
+        if match.group('punct'):
+            tokens.append(match.group('punct'))
+        elif match.group('word'):
+            tokens.append(match.group('word'))
+    tokens.reverse()
+    commands = parse_block(tokens)
+    if tokens:
+        raise SyntaxError('Unexpected {!r}'.format(tokens[-1]))
+    return commands
+
+
+def parse_block(tokens):
+    commands = []
+    words = []
+    while tokens and tokens[-1] != '}':
+        token = tokens.pop()
+        if token in (',', ';'):
+            if words:
+                commands.append(tuple(words))
+            words = []
+        elif token == '{':
+            if words[0] == 'repeat':
+                count = int(words[1]) if len(words) > 1 else None
+                commands.append(('repeat', count, parse_block(tokens)))
+            elif words[0] == 'while' and len(words) == 4:
+                commands.append(('while', tuple(words[1:]), parse_block(tokens)))
+            else:
+                raise SyntaxError('Invalid block: {}'.format(' '.join(words)))
+            if not tokens:
+                raise SyntaxError('Missing }')
+            tokens.pop()
+            words = []
+        else:
+            words.append(token)
+    if words:
+        commands.append(tuple(words))
+    return commands
+
+
+class TestScript:
+    def __init__(self, path, load):
+        self.path = Path(path)
+        self.load = load
+        self.commands = parse(self.path.read_text())
+        self.chip = None
+        self.columns = []
+        self.lines = []
+        self.output_file = None
+        self.compare_file = None
+        self.time = 0
+        self.half = False
+
+    def resolve(self, fn):
+        return self.path.parent / fn
+
+    def run(self, write=True):
+        """
+        Runs the script and returns its output lines, which are written to
+        its output file unless `write` is False
+        """
+        self.execute(self.commands)
+        if self.output_file and write:
+            with open(str(self.output_file), 'w') as f:
+                f.writelines(line + '\n' for line in self.lines)
+        return self.lines
+
+    def execute(self, commands):
+        for command in commands:
+            if command[0] == 'repeat':
+                if command[1] is None:
+                    raise ValueError('repeat without a count never ends')
+                if command[2] == [('vmstep',)]:
+                    # Let the VM run the whole loop itself
+                    self.chip.vmstep(command[1])
+                    continue
+                if command[2] == [('ticktock',)] and hasattr(self.chip, 'ticktock'):
+                    self.chip.ticktock(command[1])
+                    self.time += command[1]
+                    continue
+                for _ in range(command[1]):
+                    self.execute(command[2])
+            elif command[0] == 'while':
+                while self.condition(*command[1]):
+                    self.execute(command[2])
+            else:
+                self.execute_command(command)
+
+    def condition(self, name, op, value):
+        if op not in CONDITIONS:
+            raise SyntaxError('Invalid condition: {}'.format(op))
+        return CONDITIONS[op](to_signed(self.chip.get(name)), to_signed(parse_value(value)))
+
+    def execute_command(self, words):
+        cmd, args = words[0], words[1:]
+        if cmd == 'load':
+            # Without a file, the VM emulator loads the script's directory
+            self.chip = self.load(self.resolve(args[0] if args else ''))
+        elif cmd == 'output-file':
+            self.output_file = self.resolve(args[0])
+        elif cmd == 'compare-to':
+            self.compare_file = self.resolve(args[0])
+        elif cmd == 'output-list':
+            self.columns = [Column(spec) for spec in args]
+            self.lines.append('|' + '|'.join(c.header() for c in self.columns) + '|')
+        elif cmd == 'output':
+            self.lines.append('|' + '|'.join(
+                c.format(self.timestamp() if c.name == 'time' else self.chip.get(c.name))
+                for c in self.columns) + '|')
+        elif cmd == 'set':
+            self.chip.set(args[0], parse_value(args[1]) & 0xFFFF)
+        elif cmd == 'eval':
+            self.chip.eval()
+        elif cmd == 'tick':
+            self.chip.tick()
+            self.half = True
+        elif cmd == 'tock':
+            self.chip.tock()
+            self.time += 1
+            self.half = False
+        elif cmd == 'ticktock':
+            self.chip.tick()
+            self.chip.tock()
+            self.time += 1
+        elif cmd == 'vmstep':
+            self.chip.vmstep()
+        elif cmd in ('echo', 'clear-echo'):
+            match = RE_KEY.search(' '.join(args))
+            if hasattr(self.chip, 'press') and (match or cmd == 'clear-echo'):
+                self.chip.press(ord(match.group(1)) if match else 0)
+        elif cmd in ('breakpoint', 'clear-breakpoints'):
+            pass
+        elif args and args[0] == 'load':
+            self.chip.load(cmd, self.resolve(args[1]))
+        else:
+            raise SyntaxError('Unknown command: {}'.format(' '.join(words)))
+
+    def timestamp(self):
+        return '{}{}'.format(self.time, '+' if self.half else '')
+
+    def compare(self):
+        """
+        Returns the number of the first output line that differs from the
+        compare-to file, or None if they match. '*' in the compare file
+        matches any character.
+        """
+        with open(str(self.compare_file)) as f:
+            expected = f.read().splitlines()
+        for n, (line, want) in enumerate(zip(self.lines, expected), 1):
+            if len(line) != len(want) or any(
+                    c != w and w != '*' for c, w in zip(line, want)):
+                return n
+        if len(self.lines) != len(expected):
+            return min(len(self.lines), len(expected)) + 1
+        return None
@@ -4,10 +4,22 @@
 
 import sys
 import re
+import argparse
+import struct
+import mmap
+from array import array
+from types import MappingProxyType
 
 RE_INVALID_CHARS = re.compile(r'\s+')
 
-SYMBOLS = {
+# Packed binary image: header, then one 16-bit little-endian word per
+# instruction
+BINARY_MAGIC = b'HACK'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHI') # magic, version, number of words
+
+# Read-only; each program gets its own SymbolTable on top of these
+PREDEFINED = MappingProxyType({
     'R0': 0,
     'R1': 1,
     'R2': 2,
@@ -31,57 +43,64 @@ SYMBOLS = {
     'ARG': 2,
     'THIS': 3,
     'THAT': 4,
-}
+})
 
 COMP = {
-    '0':   '0101010',
-    '1':   '0111111',
-    '-1':  '0111010',
-    'D':   '0001100',
-    'A':   '0110000',
-    '!D':  '0001101',
-    '!A':  '0110001',
-    '-D':  '0001111',
-    '-A':  '0110011',
-    'D+1': '0011111',
-    'A+1': '0110111',
-    'D-1': '0001110',
-    'A-1': '0110010',
-    'D+A': '0000010',
-    'D-A': '0010011',
-    'A-D': '0000111',
-    'D&A': '0000000',
-    'D|A': '0010101',
-    'M':   '1110000',
-    '!M':  '1110001',
-    '-M':  '1110011',
-    'M+1': '1110111',
-    'M-1': '1110010',
-    'D+M': '1000010',
-    'D-M': '1010011',
-    'M-D': '1000111',
-    'D&M': '1000000',
-    'D|M': '1010101',
+    '0':   0b0101010,
+    '1':   0b0111111,
+    '-1':  0b0111010,
+    'D':   0b0001100,
+    'A':   0b0110000,
+    '!D':  0b0001101,
+    '!A':  0b0110001,
+    '-D':  0b0001111,
+    '-A':  0b0110011,
+    'D+1': 0b0011111,
+    'A+1': 0b0110111,
+    'D-1': 0b0001110,
+    'A-1': 0b0110010,
+    'D+A': 0b0000010,
+    'D-A': 0b0010011,
+    'A-D': 0b0000111,
+    'D&A': 0b0000000,
+    'D|A': 0b0010101,
+    'M':   0b1110000,
+    '!M':  0b1110001,
+    '-M':  0b1110011,
+    'M+1': 0b1110111,
+    'M-1': 0b1110010,
+    'D+M': 0b1000010,
+    'D-M': 0b1010011,
+    'M-D': 0b1000111,
+    'D&M': 0b1000000,
+    'D|M': 0b1010101,
+    # Operands of + & | in either order
+    'A+D': 0b0000010,
+    'A&D': 0b0000000,
+    'A|D': 0b0010101,
+    'M+D': 0b1000010,
+    'M&D': 0b1000000,
+    'M|D': 0b1010101,
 }
     
 DEST = {
-    'M': '001',
-    'D': '010',
-    'MD': '011',
-    'A': '100',
-    'AM': '101',
-    'AD': '110',
-    'AMD': '111',
+    'M': 0b001,
+    'D': 0b010,
+    'MD': 0b011,
+    'A': 0b100,
+    'AM': 0b101,
+    'AD': 0b110,
+    'AMD': 0b111,
 }
 
 JUMP = {
-    'JGT': '001',
-    'JEQ': '010',
-    'JGE': '011',
-    'JLT': '100',
-    'JNE': '101',
-    'JLE': '110',
-    'JMP': '111',
+    'JGT': 0b001,
+    'JEQ': 0b010,
+    'JGE': 0b011,
+    'JLT': 0b100,
+    'JNE': 0b101,
+    'JLE': 0b110,
+    'JMP': 0b111,
 }
 
 def prepare(filedata):
@@ -94,44 +113,30 @@ def prepare(filedata):
     return lines
         
 
-def parse_labels(lines):
-    # Add goto labels to symbol table
-    n = 0
-    out = []
-    for line in lines:
-        if line.startswith('(') and line.endswith(')'):
-            SYMBOLS[line[1:-1]] = n
-        else:
-            out.append(line)
-            n += 1
-        
-    return out
-        
-def parse_code(lines):
-    out = []
-    n = 16
-    for line in lines:
-        if line.startswith('@'):
-            (n, ins) = handle_a(n, line)
-            out.append(ins)
-        else:
-            (n, ins) = handle_c(n, line)
-            out.append(ins)
-    return out
-             
-        
-def handle_a(n, s):
+class SymbolTable(dict):
+    # Labels and variables of one program
+    def __init__(self):
+        super().__init__(PREDEFINED)
+        self.next_variable = 16
+
+    def add_variable(self, name):
+        value = self[name] = self.next_variable
+        self.next_variable += 1
+        return value
+
+def handle_a(s, symbols):
     # A-Instruction
     if s[1:].isdigit():
-        value = s[1:]
-    elif s[1:] not in SYMBOLS:
-        value = SYMBOLS[s[1:]] = n 
-        n += 1
+        value = int(s[1:])
+        if value > 0x7FFF:
+            raise ValueError('A-instruction out of range: {}'.format(s))
+    elif s[1:] not in symbols:
+        value = symbols.add_variable(s[1:])
     else: 
-        value = SYMBOLS[s[1:]]
-    return (n, '0{0:015b}'.format(int(value)))
+        value = symbols[s[1:]]
+    return value
 
-def handle_c(n, line):
+def handle_c(line):
     # C-Instruction
     dest = comp = jump = ''
 
@@ -143,19 +148,120 @@ def handle_c(n, line):
     if ';' in line:
         jump = line.split(';')[1]
 
-    dest_b = DEST.get(dest, '000')
-    comp_b = COMP.get(comp, '0000000')
-    jump_b = JUMP.get(jump, '000')
+    out = 0b111 << 13
+    out |= COMP.get(comp, 0) << 6
+    out |= DEST.get(dest, 0) << 3
+    out |= JUMP.get(jump, 0)
+    return out
+
+def format_words(words):
+    # Instructions as text, one 16-digit binary number per line
+    return '\n'.join(map('{:016b}'.format, words))
+
+def pack(words):
+    # Binary image of the instructions
+    image = array('H', words)
+    if sys.byteorder == 'big':
+        image.byteswap()
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(image))
+    return header + image.tobytes()
+
+def unpack(data):
+    # Instructions of a binary image. On little-endian machines this is a
+    # view of `data`, so nothing is parsed or copied.
+    if len(data) < BINARY_HEADER.size:
+        raise ValueError('Not a Hack binary image')
+    magic, version, count = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError('Not a Hack binary image')
+    end = BINARY_HEADER.size + 2 * count
+    if len(data) < end:
+        raise ValueError('Truncated Hack binary image')
+    view = memoryview(data)[BINARY_HEADER.size:end]
+    if sys.byteorder == 'big':
+        image = array('H')
+        image.frombytes(view)
+        image.byteswap()
+        return image
+    return view.cast('H')
+
+def load_binary(filename):
+    # Memory-maps a binary image
+    with open(filename, 'rb') as f:
+        return unpack(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+class Assembler:
+    # Assembles any number of programs in one process. Symbols are per
+    # program; the only state kept between programs is the cache of
+    # C-instruction encodings, which depend on nothing but the instruction
+    # text, so one instance can be shared between threads.
+    def __init__(self):
+        self.cache = {}
 
-    out = '111' 
-    out += comp_b
-    out += dest_b
-    out += jump_b
-    return (n, out)
+    def assemble(self, data):
+        # Returns the instructions as 16-bit ints
+        return self.assemble_stream(data).tolist()
+
+    def assemble_stream(self, lines):
+        # One pass over any iterable of lines, e.g. a file or a generator.
+        # An A-instruction that refers to a symbol not seen yet is written as
+        # 0 and patched when the label turns up. Whatever is still missing at
+        # the end is a variable, numbered from 16 in order of first use, the
+        # same numbers a separate pass over the labels would give it.
+        # Returns an array('H').
+        symbols = SymbolTable()
+        fixups = {} # Symbol -> indexes of the A-instructions waiting for it
+        words = array('H')
+        cache = self.cache
+        for line in lines:
+            line = ''.join(line.split('//', 1)[0].split())
+            if not line:
+                continue
+            if line.startswith('(') and line.endswith(')'):
+                symbols[line[1:-1]] = n = len(words)
+                indexes = fixups.pop(line[1:-1], None)
+                if indexes:
+                    if n > 0x7FFF:
+                        raise ValueError('Label past the end of ROM: {}'.format(line))
+                    for i in indexes:
+                        words[i] = n
+            elif line.startswith('@'):
+                if line[1:].isdigit() or line[1:] in symbols:
+                    value = handle_a(line, symbols)
+                    if value > 0x7FFF:
+                        raise ValueError('A-instruction out of range: {}'.format(line))
+                    words.append(value)
+                else:
+                    fixups.setdefault(line[1:], []).append(len(words))
+                    words.append(0)
+            else:
+                ins = cache.get(line)
+                if ins is None:
+                    ins = cache[line] = handle_c(line)
+                words.append(ins)
+
+        for name, indexes in fixups.items():
+            value = symbols.add_variable(name)
+            for i in indexes:
+                words[i] = value
+        return words
 
 def assemble(data):
-    return '\n'.join(parse_code(parse_labels(prepare(data))))
+    return format_words(Assembler().assemble(data))
+
+def main():
+    parser = argparse.ArgumentParser(description='Assemble Hack .asm to machine code')
+    parser.add_argument('path', help='.asm file')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='write a packed binary image instead of .hack text')
+    args = parser.parse_args()
+
+    with open(args.path, 'r') as f:
+        words = Assembler().assemble_stream(f)
+    if args.binary:
+        sys.stdout.buffer.write(pack(words))
+    else:
+        print(format_words(words))
 
 if __name__ == '__main__':
-    with open(sys.argv[1], 'r') as f:
-        print(assemble(f.readlines()))
+    main()
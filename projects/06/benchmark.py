@@ -0,0 +1,198 @@
+"""
+Hack assembler benchmarks
+
+Usage: python3 benchmark.py [name ...]
+"""
+
+import sys
+import time
+import tempfile
+import tracemalloc
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import HackAssembler
+
+HERE = Path(__file__).resolve().parent
+
+
+def make_commented_source(nlines):
+    """
+    Pong.asm padded to at least `nlines` lines with comments and blank lines,
+    so it still fits in ROM
+    """
+    lines = (HERE / 'pong' / 'Pong.asm').read_text().splitlines(True)
+    padding = ['    // ' + 'x' * 40 + '\n', '\n'] * (nlines // len(lines) // 2)
+    return [out for line in lines for out in [line] + padding]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def traced(func, *args):
+    tracemalloc.start()
+    result, elapsed = timed(func, *args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def parse_labels(lines, symbols):
+    """
+    Second pass of the old assembler: records the labels in `symbols` and
+    returns the remaining instructions
+    """
+    out = []
+    for line in lines:
+        if line.startswith('(') and line.endswith(')'):
+            symbols[line[1:-1]] = len(out)
+        else:
+            out.append(line)
+    return out
+
+
+def parse_code(lines, symbols):
+    """
+    Third pass of the old assembler: encodes each instruction
+    """
+    out = []
+    for line in lines:
+        if line.startswith('@'):
+            out.append(HackAssembler.handle_a(line, symbols))
+        else:
+            out.append(HackAssembler.handle_c(line))
+    return out
+
+
+def assemble_three_passes(path):
+    with open(str(path)) as f:
+        data = f.readlines()
+    symbols = HackAssembler.SymbolTable()
+    lines = HackAssembler.prepare(data)
+    return parse_code(parse_labels(lines, symbols), symbols)
+
+
+def assemble_one_pass(path):
+    with open(str(path)) as f:
+        return HackAssembler.Assembler().assemble_stream(f)
+
+
+def bench_assemble(nlines=10 ** 6):
+    source = make_commented_source(nlines)
+    print('Assembler throughput ({:,} lines)'.format(len(source)))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp, 'Pong.asm')
+        path.write_text(''.join(source))
+        results = {}
+        for name, func in [
+            ('3-pass', assemble_three_passes),
+            ('1-pass', assemble_one_pass),
+        ]:
+            words, elapsed, peak = results[name] = traced(func, path)
+            print('  {:<8} {:>8.3f}s {:>12,.0f} lines/sec {:>8,} KB peak'.format(
+                name, elapsed, len(source) / elapsed, peak // 1024))
+        assert list(results['1-pass'][0]) == results['3-pass'][0]
+
+    # Untraced, stage by stage
+    lines, prepare = timed(HackAssembler.prepare, source)
+    symbols = HackAssembler.SymbolTable()
+    code, labels = timed(parse_labels, lines, symbols)
+    _, encode = timed(parse_code, code, symbols)
+    words, one_pass = timed(HackAssembler.Assembler().assemble_stream, source)
+    _, text = timed(HackAssembler.format_words, words)
+    _, binary = timed(HackAssembler.pack, words)
+    for name, elapsed in [
+        ('prepare', prepare),
+        ('labels', labels),
+        ('encode', encode),
+        ('1-pass', one_pass),
+        ('text', text),
+        ('binary', binary),
+    ]:
+        print('  {:<8} {:>8.3f}s'.format(name, elapsed))
+
+
+def bench_rom(repeat=100):
+    print('Loading a full 32K ROM (x{})'.format(repeat))
+    pong = HackAssembler.Assembler().assemble((HERE / 'pong' / 'Pong.asm').read_text().splitlines())
+    words = (pong * 2)[:32768]
+    with tempfile.TemporaryDirectory() as tmp:
+        text = Path(tmp, 'rom.hack')
+        text.write_text(HackAssembler.format_words(words))
+        binary = Path(tmp, 'rom.bin')
+        binary.write_bytes(HackAssembler.pack(words))
+
+        def parse_text():
+            with open(str(text)) as f:
+                return [int(line, 2) for line in f]
+
+        def unpack():
+            with open(str(binary), 'rb') as f:
+                return HackAssembler.unpack(f.read())
+
+        for name, load in [
+            ('text', parse_text),
+            ('read', unpack),
+            ('mmap', lambda: HackAssembler.load_binary(str(binary))),
+        ]:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                rom = load()
+            elapsed = time.perf_counter() - start
+            assert list(rom) == words
+            print('  {:<8} {:>10.1f} us/load'.format(name, elapsed / repeat * 1e6))
+
+
+def bench_batch(copies=10):
+    paths = sorted(HERE.glob('*/*.asm')) * copies
+    print('Batch assembly ({} programs)'.format(len(paths)))
+    sources = [p.read_text().splitlines() for p in paths]
+    expected = [HackAssembler.Assembler().assemble(source) for source in sources]
+
+    def processes():
+        return [
+            [int(line, 2) for line in subprocess.check_output(
+                [sys.executable, str(HERE / 'HackAssembler.py'), str(p)],
+                universal_newlines=True).split()]
+            for p in paths
+        ]
+
+    def shared():
+        assembler = HackAssembler.Assembler()
+        return [assembler.assemble(source) for source in sources]
+
+    def threads():
+        assembler = HackAssembler.Assembler()
+        with ThreadPoolExecutor(4) as executor:
+            return list(executor.map(assembler.assemble, sources))
+
+    for name, run in [
+        ('process', processes),
+        ('shared', shared),
+        ('threads', threads),
+    ]:
+        programs, elapsed = timed(run)
+        # Every program must come out as if assembled on its own
+        assert programs == expected
+        print('  {:<8} {:>8.3f}s {:>8.1f} ms/program'.format(
+            name, elapsed, elapsed / len(paths) * 1e3))
+
+
+BENCHMARKS = {
+    'assemble': bench_assemble,
+    'rom': bench_rom,
+    'batch': bench_batch,
+}
+
+
+def main():
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
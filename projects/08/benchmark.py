@@ -0,0 +1,350 @@
+"""
+VM translator benchmarks
+
+Usage: python3 benchmark.py [name ...]
+
+Programs are the projects/12 OS and the projects/09 samples, compiled to VM
+code in memory with the projects/11 compiler.
+"""
+
+import sys
+import time
+import tempfile
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+import vmtranslator
+import vmemulator
+from vmtranslator import Parser, CodeWriter, Emitter, Peephole, Fusion
+
+HERE = Path(__file__).resolve().parent
+PROJECTS = HERE.parent
+
+sys.path.insert(0, str(PROJECTS / '11'))
+import compiler
+from tokenizer import Tokenizer
+sys.path.pop(0)
+
+sys.path.insert(0, str(PROJECTS / '06'))
+from HackAssembler import Assembler
+sys.path.pop(0)
+
+sys.path.insert(0, str(PROJECTS / '05'))
+from CPUEmulator import Computer
+from testscript import TestScript
+from CPUEmulator import SCREEN, KBD
+sys.path.pop(0)
+
+
+def load_programs():
+    """
+    Returns {program: [(classname, vm lines)]}
+    """
+    dirs = [PROJECTS / '12'] + sorted(p for p in (PROJECTS / '09').iterdir() if p.is_dir())
+    programs = {}
+    for d in dirs:
+        classes = []
+        for p in sorted(d.glob('*.jack')):
+            lines = []
+            out = compiler.Emitter(buffer=lines)
+            compiler.CompilationEngine(Tokenizer(p.read_text()), out).compile()
+            classes.append((p.stem, lines))
+        if classes:
+            programs[str(d.relative_to(PROJECTS))] = classes
+    return programs
+
+
+def load_linked_programs():
+    """
+    Like load_programs(), but each projects/09 program and projects/12 test
+    is linked with the OS classes it doesn't provide itself
+    """
+    programs = load_programs()
+    os_classes = programs.pop('12')
+    tests = sorted(p for p in (PROJECTS / '12').iterdir() if p.is_dir())
+    for d in tests:
+        classes = []
+        for p in sorted(d.glob('*.jack')):
+            lines = []
+            out = compiler.Emitter(buffer=lines)
+            compiler.CompilationEngine(Tokenizer(p.read_text()), out).compile()
+            classes.append((p.stem, lines))
+        programs[str(d.relative_to(PROJECTS))] = classes
+
+    for program, classes in programs.items():
+        names = {classname for classname, lines in classes}
+        classes.extend(c for c in os_classes if c[0] not in names)
+    return programs
+
+
+def translate(classes, out, shared=False):
+    counters = Counter()
+    CodeWriter(counters=counters, out=out, shared=shared).write_bootstrap()
+    for classname, lines in classes:
+        writer = CodeWriter(classname=classname, counters=counters, out=out,
+                            shared=shared)
+        for command in Parser(lines).advance():
+            writer.write_command(command)
+    out.flush()
+
+
+class PrintEmitter(Emitter):
+    """
+    Writes every line with its own print() call, as before Emitter
+    """
+    def write(self, s):
+        print(s, file=self.out)
+
+
+def bench_emit(repeat=10):
+    print('Output throughput (projects/12 OS + projects/09, x{})'.format(repeat))
+    programs = list(load_programs().values()) * repeat
+    lines = []
+    for classes in programs:
+        translate(classes, Emitter(buffer=lines))
+
+    for name, cls in [('print', PrintEmitter), ('emitter', Emitter)]:
+        with tempfile.TemporaryFile('w') as f:
+            start = time.perf_counter()
+            for classes in programs:
+                translate(classes, cls(f))
+            elapsed = time.perf_counter() - start
+        print('  {:<8} {:>8} lines {:>8.3f}s {:>12,.0f} lines/sec'.format(
+            name, len(lines), elapsed, len(lines) / elapsed))
+
+
+def bench_commands(repeat=10):
+    print('Per-instruction cost (projects/12 OS + projects/09, x{})'.format(repeat))
+    lines = [
+        line
+        for classes in load_programs().values()
+        for classname, vmlines in classes
+        for line in vmlines
+    ] * repeat
+
+    start = time.perf_counter()
+    commands = list(Parser(lines).advance())
+    parse = time.perf_counter() - start
+
+    writer = CodeWriter(classname='Bench', counters=Counter(), out=Emitter(buffer=[]))
+    start = time.perf_counter()
+    for command in commands:
+        writer.write_command(command)
+    codegen = time.perf_counter() - start
+
+    for name, elapsed in [('parse', parse), ('codegen', codegen)]:
+        print('  {:<8} {:>8} commands {:>8.3f}s {:>8.0f} ns/command'.format(
+            name, len(commands), elapsed, elapsed / len(commands) * 1e9))
+
+
+def count_instructions(lines):
+    return sum(1 for line in lines if not line.startswith(('//', '(')))
+
+
+def bench_peephole():
+    print('Peephole optimizer (instructions)')
+    removed = Counter()
+    for program, classes in load_programs().items():
+        lines = []
+        translate(classes, Emitter(buffer=lines))
+        peephole = Peephole()
+        start = time.perf_counter()
+        optimized = peephole.optimize(lines)
+        elapsed = time.perf_counter() - start
+        before, after = count_instructions(lines), count_instructions(optimized)
+        removed.update(peephole.removed)
+        print('  {:<16} {:>7} -> {:>7} ({:>5.1%} smaller) {:>7.3f}s'.format(
+            program, before, after, 1 - after / before, elapsed))
+    for rule, count in removed.most_common():
+        print('  {:<16} {:>7} removed'.format(rule, count))
+
+
+def bench_shared():
+    print('ROM size (instructions) with the OS linked in, limit 32768')
+    print('  {:<18} {:>8} {:>8} {:>8} {:>8}'.format(
+        '', 'inline', '-O', '-s', '-s -O'))
+    for program, classes in load_linked_programs().items():
+        sizes = []
+        for shared in (False, True):
+            lines = []
+            translate(classes, Emitter(buffer=lines), shared=shared)
+            sizes.append(count_instructions(lines))
+            sizes.append(count_instructions(Peephole().optimize(lines)))
+        print('  {:<18} {:>8} {:>8} {:>8} {:>8}'.format(program, *sizes))
+
+
+def assemble_lists(vmfiles):
+    """
+    Every stage's output held in full before the next starts
+    """
+    lines = []
+    out = Emitter(buffer=lines)
+    counters = Counter()
+    CodeWriter(counters=counters, out=out, shared=True).write_bootstrap()
+    for p in vmfiles:
+        with open(str(p)) as f:
+            vmlines = f.readlines()
+        writer = CodeWriter(classname=p.stem, counters=counters, out=out, shared=True)
+        for command in list(Parser(vmlines).advance()):
+            writer.write_command(command)
+    return Assembler().assemble(lines)
+
+
+def assemble_stream(vmfiles):
+    return Assembler().assemble_stream(vmtranslator.translate(vmfiles, shared=True))
+
+
+def bench_stream():
+    print('.vm files to machine code with the OS linked in, -s (peak memory)')
+    with tempfile.TemporaryDirectory() as tmp:
+        for program, classes in load_linked_programs().items():
+            progdir = Path(tmp, program.replace('/', '_'))
+            progdir.mkdir()
+            for classname, lines in classes:
+                (progdir / (classname + '.vm')).write_text('\n'.join(lines) + '\n')
+            vmfiles = sorted(progdir.glob('*.vm'))
+
+            results = []
+            for func in (assemble_lists, assemble_stream):
+                tracemalloc.start()
+                start = time.perf_counter()
+                try:
+                    words = func(vmfiles)
+                except ValueError:
+                    words = None
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                results.append((words, elapsed, peak))
+            (words, elapsed, peak), (stream_words, stream_elapsed, stream_peak) = results
+            if stream_words is None:
+                print('  {:<18} too large for ROM'.format(program))
+                continue
+            assert list(stream_words) == words
+            print('  {:<18} lists {:>6.3f}s {:>7,} KB  stream {:>6.3f}s {:>7,} KB'.format(
+                program, elapsed, peak // 1024, stream_elapsed, stream_peak // 1024))
+
+
+def bench_vm(n=22):
+    print('Recursive fibonacci({}): VM emulator vs translated to the CPU emulator'.format(n))
+    d = HERE / 'FunctionCalls' / 'FibonacciElement'
+    program = [
+        (p.stem, p.read_text().replace('push constant 4', 'push constant {}'.format(n)).splitlines())
+        for p in sorted(d.glob('*.vm'))
+    ]
+
+    start = time.perf_counter()
+    vm = vmemulator.VirtualMachine(program)
+    vm.run(10 ** 9)
+    vm_elapsed = time.perf_counter() - start
+    vm_result = vm.ram[vm.ram[0] - 1]
+
+    start = time.perf_counter()
+    lines = []
+    translate(program, Emitter(buffer=lines))
+    computer = Computer(Assembler().assemble(lines))
+    instructions = computer.run(10 ** 9)
+    cpu_elapsed = time.perf_counter() - start
+    assert computer.ram[computer.ram[0] - 1] == vm_result
+
+    print('  {:<4} {:>10,} commands     {:>7.3f}s {:>12,.0f} commands/sec'.format(
+        'vm', vm.steps, vm_elapsed, vm.steps / vm_elapsed))
+    print('  {:<4} {:>10,} instructions {:>7.3f}s {:>12,.0f} instructions/sec'.format(
+        'cpu', instructions, cpu_elapsed, instructions / cpu_elapsed))
+
+    print('Test scripts on the VM emulator')
+    scripts = sorted((PROJECTS / '07').glob('*/*/*VME.tst')) + sorted(HERE.glob('*/*/*VME.tst'))
+    scripts += [PROJECTS / '12' / name / (name + '.tst') for name in ('ArrayTest', 'MathTest', 'MemoryTest')]
+    total = 0
+    for path in scripts:
+        start = time.perf_counter()
+        script = TestScript(path, vmemulator.load_chip)
+        script.run()
+        line = script.compare()
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        script.output_file.unlink()
+        print('  {:<24} {:>7.3f}s {}'.format(path.stem, elapsed, 'failed at line {}'.format(line) if line else 'ok'))
+    print('  {:<24} {:>7.3f}s'.format('total', total))
+
+
+def translate_halting(classes, fusion=None):
+    """
+    A linked program, translated with -s, that stops when Sys.init returns
+    """
+    lines = []
+    out = Emitter(buffer=lines)
+    counters = Counter()
+    CodeWriter(counters=counters, out=out, shared=True).write_bootstrap()
+    lines.extend(['(BENCH.HALT)', '@BENCH.HALT', '0;JMP'])
+    for classname, vmlines in classes:
+        writer = CodeWriter(classname=classname, counters=counters, out=out, shared=True)
+        commands = Parser(vmlines).advance()
+        for command in fusion.fuse(commands) if fusion else commands:
+            writer.write_command(command)
+    return lines
+
+
+# Programs that finish on their own in reasonable time, and the RAM that
+# shows they did the same thing
+RUNNABLE = {
+    '09/Fraction': (SCREEN, KBD),
+    '09/List': (SCREEN, KBD),
+    '12/ArrayTest': (8000, 8004),
+    '12/MathTest': (8000, 8014),
+    '12/MemoryTest': (8000, 8006),
+}
+
+
+def bench_fusion():
+    print('Superinstructions with the OS linked in, -s')
+    programs = load_linked_programs()
+    variants = [('none', ())] + [(name, (name,)) for name in Fusion.PATTERNS]
+    variants.append(('all', Fusion.PATTERNS))
+    rom = Counter()
+    cycles = Counter()
+    fused = Counter()
+    for program, classes in programs.items():
+        results = {}
+        for variant, patterns in variants:
+            fusion = Fusion(patterns)
+            lines = translate_halting(classes, fusion)
+            rom[variant] += count_instructions(lines)
+            fused[variant] += sum(fusion.fused.values())
+            if program in RUNNABLE:
+                computer = Computer(Assembler().assemble(lines))
+                cycles[variant] += computer.run(10 ** 8)
+                assert computer.halted
+                start, end = RUNNABLE[program]
+                results[variant] = computer.ram[start:end]
+        # Every variant must leave the same results
+        assert all(ram == results['none'] for ram in results.values()), program
+
+    print('  {:<16} {:>8} {:>10} {:>7} {:>12} {:>7}'.format(
+        'pattern', 'fused', 'ROM', 'saved', 'cycles', 'saved'))
+    for variant, patterns in variants:
+        print('  {:<16} {:>8} {:>10,} {:>7.1%} {:>12,} {:>7.1%}'.format(
+            variant, fused[variant], rom[variant], 1 - rom[variant] / rom['none'],
+            cycles[variant], 1 - cycles[variant] / cycles['none']))
+    print('  ROM over all {} programs, cycles over {}'.format(len(programs), ', '.join(RUNNABLE)))
+
+
+BENCHMARKS = {
+    'emit': bench_emit,
+    'commands': bench_commands,
+    'peephole': bench_peephole,
+    'shared': bench_shared,
+    'stream': bench_stream,
+    'vm': bench_vm,
+    'fusion': bench_fusion,
+}
+
+
+def main():
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+"""
+The Jack OS in Python, for the VM emulator
+
+Each class below stands in for the projects/12 class of the same name, with
+methods named after the Jack subroutines. Arguments arrive as unsigned 16-bit
+words; return values are masked back to 16 bits by the VM. Calls to other OS
+routines go through VirtualMachine.call(), so a program may replace any OS
+class with its own .vm code and the rest keep working with it.
+
+Output is headless: characters are written as text to the VM's console
+stream instead of being drawn on the screen, and the Keyboard read routines
+take their input from the VM's keyboard stream.
+"""
+
+import bisect
+import math
+
+SCREEN = 16384
+KBD = 24576
+SCREEN_WIDTH = 512
+SCREEN_HEIGHT = 256
+HEAP_BASE = 2048
+HEAP_END = SCREEN
+
+NEWLINE = 128
+BACKSPACE = 129
+DOUBLE_QUOTE = 34
+
+# Run by the VM when the program has Main.main but no Sys class, like the
+# projects/12 Sys.init. Sys.halt stops the VM instead of looping forever.
+SYS_INIT = '''
+function Sys.init 0
+call Memory.init 0
+pop temp 0
+call Math.init 0
+pop temp 0
+call Keyboard.init 0
+pop temp 0
+call Output.init 0
+pop temp 0
+call Screen.init 0
+pop temp 0
+call Main.main 0
+pop temp 0
+call Sys.halt 0
+pop temp 0
+return
+'''.splitlines()
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+class OSClass:
+    def __init__(self, vm):
+        self.vm = vm
+
+    def call(self, name, *args):
+        return self.vm.call(name, *args)
+
+    def fail(self, code):
+        self.call('Sys.error', code)
+        return 0
+
+    def init(self):
+        pass
+
+
+class Math(OSClass):
+    def multiply(self, x, y):
+        return x * y
+
+    def divide(self, x, y):
+        x, y = signed(x), signed(y)
+        if y == 0:
+            return self.fail(3)
+        q = abs(x) // abs(y)
+        return -q if (x < 0) != (y < 0) else q
+
+    def sqrt(self, x):
+        x = signed(x)
+        if x < 0:
+            return self.fail(4)
+        return math.isqrt(x)
+
+    def min(self, x, y):
+        return min(signed(x), signed(y))
+
+    def max(self, x, y):
+        return max(signed(x), signed(y))
+
+    def abs(self, x):
+        return abs(signed(x))
+
+
+class Memory(OSClass):
+    """
+    First-fit allocator over the heap. Every block starts with a word holding
+    its size, header included, like the projects/12 Memory.
+    """
+    def __init__(self, vm):
+        super().__init__(vm)
+        self.init()
+
+    def init(self):
+        self.free = [(HEAP_BASE, HEAP_END - HEAP_BASE)] # (address, size), sorted
+
+    def peek(self, address):
+        return self.vm.ram[address]
+
+    def poke(self, address, value):
+        self.vm.ram[address] = value
+
+    def alloc(self, size):
+        size = signed(size)
+        if size <= 0:
+            return self.fail(5)
+        size += 1
+        for i, (address, length) in enumerate(self.free):
+            if length >= size:
+                if length == size:
+                    del self.free[i]
+                else:
+                    self.free[i] = (address + size, length - size)
+                self.vm.ram[address] = size
+                return address + 1
+        return self.fail(6)
+
+    def deAlloc(self, o):
+        address = o - 1
+        length = self.vm.ram[address]
+        free = self.free
+        i = bisect.bisect(free, (address,))
+        # Merge with the neighbouring free blocks
+        if i < len(free) and address + length == free[i][0]:
+            length += free.pop(i)[1]
+        if i and free[i - 1][0] + free[i - 1][1] == address:
+            free[i - 1] = (free[i - 1][0], free[i - 1][1] + length)
+        else:
+            free.insert(i, (address, length))
+
+
+class Array(OSClass):
+    def new(self, size):
+        if signed(size) <= 0:
+            return self.fail(2)
+        return self.call('Memory.alloc', size)
+
+    def dispose(self, this):
+        self.call('Memory.deAlloc', this)
+
+
+class String(OSClass):
+    """
+    Strings are kept in Python, keyed by the address of a one-word heap
+    block that only serves as the object's identity
+    """
+    def __init__(self, vm):
+        super().__init__(vm)
+        self.strings = {} # address -> (max length, chars)
+
+    def new(self, maxLength):
+        if signed(maxLength) < 0:
+            return self.fail(14)
+        this = self.call('Memory.alloc', 1)
+        self.strings[this] = (maxLength, [])
+        return this
+
+    def dispose(self, this):
+        del self.strings[this]
+        self.call('Memory.deAlloc', this)
+
+    def length(self, this):
+        return len(self.strings[this][1])
+
+    def charAt(self, this, j):
+        chars = self.strings[this][1]
+        if j >= len(chars):
+            return self.fail(15)
+        return chars[j]
+
+    def setCharAt(self, this, j, c):
+        chars = self.strings[this][1]
+        if j >= len(chars):
+            return self.fail(16)
+        chars[j] = c
+
+    def appendChar(self, this, c):
+        maxLength, chars = self.strings[this]
+        if len(chars) >= maxLength:
+            return self.fail(17)
+        chars.append(c)
+        return this
+
+    def eraseLastChar(self, this):
+        chars = self.strings[this][1]
+        if not chars:
+            return self.fail(18)
+        chars.pop()
+
+    def intValue(self, this):
+        chars = self.strings[this][1]
+        sign = 1
+        if chars and chars[0] == ord('-'):
+            sign, chars = -1, chars[1:]
+        value = 0
+        for c in chars:
+            if not ord('0') <= c <= ord('9'):
+                break
+            value = value * 10 + c - ord('0')
+        return sign * value
+
+    def setInt(self, this, i):
+        maxLength, chars = self.strings[this]
+        digits = [ord(c) for c in str(signed(i))]
+        if len(digits) > maxLength:
+            return self.fail(19)
+        chars[:] = digits
+
+    def newLine(self):
+        return NEWLINE
+
+    def backSpace(self):
+        return BACKSPACE
+
+    def doubleQuote(self):
+        return DOUBLE_QUOTE
+
+
+class Output(OSClass):
+    ROWS = 23
+    COLUMNS = 64
+
+    def _write(self, s):
+        if self.vm.console is not None:
+            self.vm.console.write(s)
+
+    def moveCursor(self, i, j):
+        if not (0 <= signed(i) < self.ROWS and 0 <= signed(j) < self.COLUMNS):
+            return self.fail(20)
+
+    def printChar(self, c):
+        if c == NEWLINE:
+            self.println()
+        elif c == BACKSPACE:
+            self.backSpace()
+        else:
+            self._write(chr(c))
+
+    def printString(self, s):
+        for j in range(self.call('String.length', s)):
+            self.call('Output.printChar', self.call('String.charAt', s, j))
+
+    def printInt(self, i):
+        self._write(str(signed(i)))
+
+    def println(self):
+        self._write('\n')
+
+    def backSpace(self):
+        self._write('\b')
+
+
+class Screen(OSClass):
+    def __init__(self, vm):
+        super().__init__(vm)
+        self.init()
+
+    def init(self):
+        self.color = True
+
+    def clearScreen(self):
+        ram = self.vm.ram
+        ram[SCREEN:KBD] = type(ram)(ram.typecode, bytes(2 * (KBD - SCREEN)))
+
+    def setColor(self, b):
+        self.color = bool(b)
+
+    def _fill(self, x1, x2, y):
+        # Pixels x1..x2 of row y, a word at a time
+        ram = self.vm.ram
+        row = SCREEN + y * 32
+        while x1 <= x2:
+            address = row + x1 // 16
+            end = min(x2, x1 | 15)
+            mask = (2 << (end & 15)) - (1 << (x1 & 15))
+            if self.color:
+                ram[address] |= mask
+            else:
+                ram[address] &= ~mask & 0xFFFF
+            x1 = end + 1
+
+    def drawPixel(self, x, y):
+        if not (0 <= signed(x) < SCREEN_WIDTH and 0 <= signed(y) < SCREEN_HEIGHT):
+            return self.fail(7)
+        self._fill(x, x, y)
+
+    def drawLine(self, x1, y1, x2, y2):
+        x1, y1, x2, y2 = map(signed, (x1, y1, x2, y2))
+        if not all(0 <= x < SCREEN_WIDTH for x in (x1, x2)) or \
+           not all(0 <= y < SCREEN_HEIGHT for y in (y1, y2)):
+            return self.fail(8)
+        if y1 == y2:
+            self._fill(min(x1, x2), max(x1, x2), y1)
+            return
+        dx, dy = abs(x2 - x1), abs(y2 - y1)
+        sx, sy = (1 if x2 > x1 else -1), (1 if y2 > y1 else -1)
+        a = b = diff = 0
+        while abs(a) <= dx and abs(b) <= dy:
+            self._fill(x1 + a, x1 + a, y1 + b)
+            if diff < 0:
+                a += sx
+                diff += dy
+            else:
+                b += sy
+                diff -= dx
+
+    def drawRectangle(self, x1, y1, x2, y2):
+        x1, y1, x2, y2 = map(signed, (x1, y1, x2, y2))
+        if not (0 <= x1 <= x2 < SCREEN_WIDTH and 0 <= y1 <= y2 < SCREEN_HEIGHT):
+            return self.fail(9)
+        for y in range(y1, y2 + 1):
+            self._fill(x1, x2, y)
+
+    def drawCircle(self, x, y, r):
+        x, y, r = map(signed, (x, y, r))
+        if not (0 <= x < SCREEN_WIDTH and 0 <= y < SCREEN_HEIGHT):
+            return self.fail(12)
+        if not 0 <= r <= 181:
+            return self.fail(13)
+        for dy in range(max(-r, -y), min(r, SCREEN_HEIGHT - 1 - y) + 1):
+            half = math.isqrt(r * r - dy * dy)
+            self._fill(max(x - half, 0), min(x + half, SCREEN_WIDTH - 1), y + dy)
+
+
+class Keyboard(OSClass):
+    """
+    Each character of the keyboard stream is a key that keyPressed() sees
+    held down once and released the next time. A key set in RAM by a test
+    script is seen as long as it stays there.
+    """
+    def __init__(self, vm):
+        super().__init__(vm)
+        self.held = False
+
+    def _read(self):
+        c = self.vm.keyboard.read(1) if self.vm.keyboard else ''
+        return NEWLINE if c == '\n' else ord(c) if c else 0
+
+    def keyPressed(self):
+        if self.vm.ram[KBD]:
+            return self.vm.ram[KBD]
+        if self.held:
+            self.held = False
+            return 0
+        c = self._read()
+        self.held = bool(c)
+        return c
+
+    def readChar(self):
+        c = self._read()
+        if not c:
+            # Nothing will ever be typed
+            self.call('Sys.halt')
+            return 0
+        self.call('Output.printChar', c)
+        return c
+
+    def readLine(self, message):
+        self.call('Output.printString', message)
+        chars = []
+        while True:
+            c = self.readChar()
+            if c in (NEWLINE, 0):
+                break
+            if c == BACKSPACE:
+                chars = chars[:-1]
+            else:
+                chars.append(c)
+        s = self.call('String.new', max(len(chars), 1))
+        for c in chars:
+            self.call('String.appendChar', s, c)
+        return s
+
+    def readInt(self, message):
+        s = self.readLine(message)
+        value = self.call('String.intValue', s)
+        self.call('String.dispose', s)
+        return value
+
+
+class Sys(OSClass):
+    def halt(self):
+        self.vm.halted = True
+
+    def error(self, errorCode):
+        for c in 'ERR':
+            self.call('Output.printChar', ord(c))
+        self.call('Output.printInt', errorCode)
+        self.vm.error_code = signed(errorCode)
+        self.call('Sys.halt')
+
+    def wait(self, duration):
+        # Headless, so there is nothing to wait for
+        if signed(duration) <= 0:
+            return self.fail(1)
+
+
+CLASSES = (Math, Memory, Array, String, Output, Screen, Keyboard, Sys)
+
+
+def natives(vm, exclude=()):
+    """
+    Returns {'Class.subroutine': method} for the OS classes not in `exclude`.
+    Python helpers start with an underscore and are left out.
+    """
+    functions = {}
+    for cls in CLASSES:
+        if cls.__name__ in exclude:
+            continue
+        instance = cls(vm)
+        names = {'init'} | {
+            name for name, value in vars(cls).items()
+            if callable(value) and not name.startswith('_')
+        }
+        for name in names:
+            functions['{}.{}'.format(cls.__name__, name)] = getattr(instance, name)
+    return functions
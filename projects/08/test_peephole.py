@@ -0,0 +1,146 @@
+"""
+Tests for the peephole optimizer in vmtranslator.py
+
+Usage: python3 -m unittest test_peephole (or pytest), from projects/08
+
+Each rule is checked on a small window of assembly, including the label and
+comment boundaries it has to respect. The end-to-end tests build projects/12
+test programs with the OS, with and without the optimizer, run both on the
+CPU emulator and compare the memory they leave behind.
+"""
+
+import sys
+import unittest
+from collections import Counter
+from pathlib import Path
+
+from vmtranslator import Peephole
+
+PROJECTS = Path(__file__).resolve().parent.parent
+
+sys.path.insert(0, str(PROJECTS / '05'))
+sys.path.insert(0, str(PROJECTS / '11'))
+from CPUEmulator import Computer
+from build import Toolchain, read_sources, HackAssembler
+del sys.path[:2]
+
+PUSH_D = ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1']
+POP_D = ['@SP', 'M=M-1', 'A=M', 'D=M']
+
+
+class PushPopTest(unittest.TestCase):
+    def test_removed_before_a_load(self):
+        self.assertEqual(Peephole().remove_push_pop(PUSH_D + POP_D + ['@R13']), ['@R13'])
+
+    def test_kept_before_other_instructions(self):
+        lines = PUSH_D + POP_D + ['D=D+1']
+        self.assertEqual(Peephole().remove_push_pop(list(lines)), lines)
+
+    def test_kept_across_a_label(self):
+        lines = PUSH_D + ['(L)'] + POP_D + ['@R13']
+        self.assertEqual(Peephole().remove_push_pop(list(lines)), lines)
+
+    def test_comments_kept(self):
+        self.assertEqual(Peephole().remove_push_pop(PUSH_D + ['// c'] + POP_D + ['@R13']),
+                         ['// c', '@R13'])
+
+
+class ZeroOffsetTest(unittest.TestCase):
+    def test_add_zero(self):
+        self.assertEqual(Peephole().remove_zero_offsets(['@0', 'A=A+D']), ['A=D'])
+
+    def test_copy_back(self):
+        self.assertEqual(Peephole().remove_zero_offsets(['D=A', 'A=D']), ['D=A'])
+
+    def test_kept_across_a_label(self):
+        lines = ['D=A', '(L)', 'A=D']
+        self.assertEqual(Peephole().remove_zero_offsets(list(lines)), lines)
+
+    def test_comments_kept(self):
+        self.assertEqual(Peephole().remove_zero_offsets(['@0', '// c', 'A=A+D']),
+                         ['// c', 'A=D'])
+
+
+class DeadWriteTest(unittest.TestCase):
+    def test_overwritten_a(self):
+        self.assertEqual(Peephole().remove_dead_writes(['@5', '@6']), ['@6'])
+        self.assertEqual(Peephole().remove_dead_writes(['A=M', '@7']), ['@7'])
+
+    def test_overwritten_d(self):
+        self.assertEqual(Peephole().remove_dead_writes(['D=M', 'D=A']), ['D=A'])
+
+    def test_read_d_kept(self):
+        lines = ['D=M', 'D=D+A']
+        self.assertEqual(Peephole().remove_dead_writes(list(lines)), lines)
+
+    def test_jump_kept(self):
+        lines = ['D;JGT', '@6']
+        self.assertEqual(Peephole().remove_dead_writes(list(lines)), lines)
+
+    def test_kept_across_a_label(self):
+        for lines in (['@5', '(L)', '@6'], ['D=M', '(L)', 'D=A']):
+            self.assertEqual(Peephole().remove_dead_writes(list(lines)), lines)
+
+    def test_comments_kept(self):
+        self.assertEqual(Peephole().remove_dead_writes(['@5', '// c', '@6']), ['// c', '@6'])
+
+
+class ReloadTest(unittest.TestCase):
+    def test_pointer_and_word(self):
+        self.assertEqual(Peephole().remove_reloads(['@LCL', 'A=M', 'M=D', '@LCL', 'A=M', 'D=M']),
+                         ['@LCL', 'A=M', 'M=D'])
+
+    def test_pointer_written(self):
+        # D holds the new pointer, not the word it points to
+        self.assertEqual(Peephole().remove_reloads(['@LCL', 'M=D', '@LCL', 'A=M', 'D=M']),
+                         ['@LCL', 'M=D', 'A=M', 'D=M'])
+
+    def test_kept_across_a_label(self):
+        lines = ['@R5', 'M=D', '(L)', '@R5', 'D=M']
+        self.assertEqual(Peephole().remove_reloads(list(lines)), lines)
+
+    def test_kept_after_a_jump(self):
+        lines = ['@R5', 'M=D', '0;JMP', '@R5', 'D=M']
+        self.assertEqual(Peephole().remove_reloads(list(lines)), lines)
+
+    def test_comments_kept(self):
+        self.assertEqual(Peephole().remove_reloads(['@R5', 'M=D', '// c', '@R5', 'D=M']),
+                         ['@R5', 'M=D', '// c'])
+
+
+class ProgramTest(unittest.TestCase):
+    """
+    Builds and runs programs with the OS, with and without the optimizer
+    """
+    CYCLES = 5 * 10 ** 6
+
+    @classmethod
+    def setUpClass(cls):
+        cls.toolchain = Toolchain()
+
+    def run_program(self, path, optimize):
+        """
+        Returns the RAM left by the program, but for the stack and registers
+        """
+        classes = dict(self.toolchain.load_os())
+        classes.update((classname, self.toolchain.compile(source))
+                       for classname, source in read_sources(path).items())
+        lines = list(self.toolchain.translate(classes, Counter(), optimize, shared=True,
+                                              bootstrap=True))
+        # Stop where Sys.init returns to, instead of falling into the next class
+        end = lines.index('(Sys.init$RET.0)') + 1
+        lines[end:end] = ['@Sys.init$RET.0', '0;JMP']
+        computer = Computer(HackAssembler.Assembler().assemble_stream(lines))
+        computer.run(self.CYCLES)
+        self.assertTrue(computer.halted, '{} did not finish'.format(path.name))
+        return computer.ram[16:256] + computer.ram[2048:]
+
+    def test_programs(self):
+        for name in ('ArrayTest', 'MathTest', 'MemoryTest'):
+            with self.subTest(name):
+                path = PROJECTS / '12' / name
+                self.assertEqual(self.run_program(path, True), self.run_program(path, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,470 @@
+#!/bin/env python3
+"""
+Headless VM emulator
+
+Usage: python3 vmemulator.py program.vm|directory [-n steps]
+       python3 vmemulator.py script.tst
+
+Runs .vm code without translating it to assembly. Commands are parsed with
+vmtranslator.Parser and encoded once as (op, x, y) tuples, with labels,
+functions, segments and statics resolved to integers, then run by a single
+loop over array-backed RAM laid out like the Hack platform's. OS classes the
+program doesn't define itself are provided in Python by jackos.py. A
+directory without .vm files is compiled from its .jack files first.
+"""
+
+from pathlib import Path
+from array import array
+import bisect
+import sys
+import time
+import argparse
+import re
+
+from vmtranslator import (
+    Parser, C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION,
+    C_RETURN, C_CALL, S_CONSTANT, S_LOCAL, S_ARGUMENT, S_THIS, S_THAT,
+    S_STATIC, S_TEMP, S_POINTER,
+)
+import jackos
+
+HERE = Path(__file__).resolve().parent
+PROJECTS = HERE.parent
+
+sys.path.insert(0, str(PROJECTS / '05'))
+from testscript import TestScript
+sys.path.pop(0)
+
+RAM_SIZE = 32768
+STACK_BASE = 256
+STATIC_BASE = 16
+
+# Operations, numbered in the order the run loop tests for them
+(
+    OP_PUSH_SEGMENT, # RAM[RAM[x] + y] for local, argument, this and that
+    OP_PUSH_CONSTANT,
+    OP_POP_SEGMENT,
+    OP_PUSH_ADDRESS, # RAM[x] for static, temp and pointer
+    OP_ADD,
+    OP_POP_ADDRESS,
+    OP_IF_GOTO,
+    OP_CALL_NATIVE,
+    OP_CALL,
+    OP_FUNCTION,
+    OP_RETURN,
+    OP_GOTO,
+    OP_NOT,
+    OP_SUB,
+    OP_EQ,
+    OP_LT,
+    OP_GT,
+    OP_NEG,
+    OP_AND,
+    OP_OR,
+) = range(20)
+
+ARITHMETIC = {
+    'add': OP_ADD,
+    'sub': OP_SUB,
+    'neg': OP_NEG,
+    'eq': OP_EQ,
+    'gt': OP_GT,
+    'lt': OP_LT,
+    'and': OP_AND,
+    'or': OP_OR,
+    'not': OP_NOT,
+}
+
+# Segments addressed through the pointer in RAM[n]
+POINTERS = {
+    S_LOCAL: 1,
+    S_ARGUMENT: 2,
+    S_THIS: 3,
+    S_THAT: 4,
+}
+
+RE_PIN = re.compile(r'(?P<name>\w+)(?:\[(?P<index>\d*)\])?$')
+
+
+def import_compiler():
+    sys.path.insert(0, str(PROJECTS / '11'))
+    try:
+        import compiler
+        import tokenizer
+    finally:
+        sys.path.pop(0)
+    return compiler, tokenizer
+
+
+def read_program(path):
+    """
+    Returns [(classname, VM lines)] of a .vm file or a directory of them. A
+    directory without .vm files is compiled from its .jack files with the
+    projects/11 compiler.
+    """
+    path = Path(path)
+    if not path.is_dir():
+        return [(path.stem, path.read_text().splitlines())]
+    vmfiles = sorted(path.glob('*.vm'))
+    if vmfiles:
+        return [(p.stem, p.read_text().splitlines()) for p in vmfiles]
+    compiler, tokenizer = import_compiler()
+    classes = []
+    for p in sorted(path.glob('*.jack')):
+        lines = []
+        compiler.CompilationEngine(tokenizer.Tokenizer(p.read_text()),
+                                   compiler.Emitter(buffer=lines)).compile()
+        classes.append((p.stem, lines))
+    return classes
+
+
+class VirtualMachine:
+    """
+    The VM of nand2tetris II. The stack, segment pointers, statics and heap
+    live in RAM at the same addresses as on the Hack computer, so programs
+    that peek and poke memory or draw on the screen behave the same.
+    """
+    def __init__(self, program=(), console=None, keyboard=None):
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.console = console # Output text goes here
+        self.keyboard = keyboard # Keyboard.readChar reads from here
+        self.load(program)
+
+    def load(self, program):
+        """
+        Loads [(classname, VM lines)] and resets the VM
+        """
+        self.code = []
+        self.functions = {} # Name -> index
+        self.labels = {} # (function, label) -> index
+        self.statics = {} # 'Class.index' -> address, in order of first use
+        self.starts, self.names = [], [] # Where each function starts, for errors
+        for classname, lines in program:
+            self.encode(classname, lines)
+        classes = {name.split('.')[0] for name in self.functions}
+        if 'Sys' not in classes and 'Main.main' in self.functions:
+            self.encode('Sys', jackos.SYS_INIT)
+        self.natives = jackos.natives(self, exclude=classes)
+        self.code.append((OP_GOTO, len(self.code), 0)) # Stop at the end
+        self.code = [self.resolve(n, ins) for n, ins in enumerate(self.code)]
+        if len(self.code) > 0xFFFF:
+            raise ValueError('Program too large: {} commands'.format(len(self.code)))
+        self.entry = self.functions.get('Sys.init', 0)
+        self.reset()
+
+    def encode(self, classname, lines):
+        code = self.code
+        scope = classname # Labels belong to the function they're in
+        for c in Parser(lines).advance():
+            if c.type == C_PUSH:
+                if c.segment == S_CONSTANT:
+                    code.append((OP_PUSH_CONSTANT, c.arg2, 0))
+                elif c.segment in POINTERS:
+                    code.append((OP_PUSH_SEGMENT, POINTERS[c.segment], c.arg2))
+                else:
+                    code.append((OP_PUSH_ADDRESS, self.address(classname, c), 0))
+            elif c.type == C_POP:
+                if c.segment in POINTERS:
+                    code.append((OP_POP_SEGMENT, POINTERS[c.segment], c.arg2))
+                else:
+                    code.append((OP_POP_ADDRESS, self.address(classname, c), 0))
+            elif c.type == C_ARITHMETIC:
+                code.append((ARITHMETIC[c.cmd], 0, 0))
+            elif c.type == C_LABEL:
+                self.labels[(scope, c.arg1)] = len(code)
+            elif c.type in (C_GOTO, C_IF):
+                code.append((OP_GOTO if c.type == C_GOTO else OP_IF_GOTO, (scope, c.arg1), 0))
+            elif c.type == C_FUNCTION:
+                scope = c.arg1
+                self.functions[c.arg1] = len(code)
+                self.starts.append(len(code))
+                self.names.append(c.arg1)
+                code.append((OP_FUNCTION, c.arg2, array('H', bytes(2 * c.arg2))))
+            elif c.type == C_CALL:
+                code.append((OP_CALL, c.arg1, c.arg2))
+            elif c.type == C_RETURN:
+                code.append((OP_RETURN, 0, 0))
+
+    def address(self, classname, c):
+        if c.segment == S_STATIC:
+            name = '{}.{}'.format(classname, c.arg2)
+            if name not in self.statics:
+                self.statics[name] = STATIC_BASE + len(self.statics)
+            return self.statics[name]
+        elif c.segment == S_TEMP and c.arg2 < 8:
+            return 5 + c.arg2
+        elif c.segment == S_POINTER and c.arg2 < 2:
+            return 3 + c.arg2
+        raise SyntaxError('Invalid segment: {}'.format(c.comment))
+
+    def resolve(self, n, ins):
+        # Replaces the names in a call or goto with where they lead
+        op, x, y = ins
+        if op == OP_CALL:
+            if x in self.functions:
+                return OP_CALL, self.functions[x], y
+            elif x in self.natives:
+                return OP_CALL_NATIVE, self.natives[x], y
+            raise ValueError('Unknown function {} in {}'.format(x, self.function_at(n)))
+        elif op in (OP_GOTO, OP_IF_GOTO) and isinstance(x, tuple):
+            if x not in self.labels:
+                raise ValueError('Unknown label {} in {}'.format(x[1], x[0]))
+            return op, self.labels[x], y
+        return ins
+
+    def reset(self):
+        self.ram[0] = STACK_BASE
+        self.pc = self.entry
+        self.depth = 0 # Number of frames pushed by calls
+        self.floor = 0 # run() stops when a return drops below this depth
+        self.steps = 0
+        self.halted = False
+        self.error_code = None
+
+    def function_at(self, n):
+        i = bisect.bisect(self.starts, n)
+        return self.names[i - 1] if i else '(top level)'
+
+    def run(self, steps):
+        """
+        Runs up to `steps` commands and returns how many ran. Stops when the
+        program halts: Sys.halt, a goto to itself, or a return from the
+        function it started in.
+        """
+        if self.halted:
+            return 0
+        code, ram = self.code, self.ram
+        pc, depth, floor = self.pc, self.depth, self.floor
+        sp = ram[0]
+        n = 0
+        try:
+            for n in range(1, steps + 1):
+                op, x, y = code[pc]
+                pc += 1
+                if op == 0: # OP_PUSH_SEGMENT
+                    ram[sp] = ram[ram[x] + y]
+                    sp += 1
+                elif op == 1: # OP_PUSH_CONSTANT
+                    ram[sp] = x
+                    sp += 1
+                elif op == 2: # OP_POP_SEGMENT
+                    sp -= 1
+                    ram[ram[x] + y] = ram[sp]
+                elif op == 3: # OP_PUSH_ADDRESS
+                    ram[sp] = ram[x]
+                    sp += 1
+                elif op == 4: # OP_ADD
+                    sp -= 1
+                    ram[sp - 1] = ram[sp - 1] + ram[sp] & 0xFFFF
+                elif op == 5: # OP_POP_ADDRESS
+                    sp -= 1
+                    ram[x] = ram[sp]
+                elif op == 6: # OP_IF_GOTO
+                    sp -= 1
+                    if ram[sp]:
+                        pc = x
+                elif op == 7: # OP_CALL_NATIVE
+                    sp -= y
+                    args = ram[sp:sp + y]
+                    ram[0], self.pc, self.depth = sp, pc, depth
+                    value = x(*args)
+                    sp = ram[0]
+                    ram[sp] = (value or 0) & 0xFFFF
+                    sp += 1
+                    if self.halted:
+                        break
+                elif op == 8: # OP_CALL
+                    ram[sp] = pc
+                    ram[sp + 1] = ram[1]
+                    ram[sp + 2] = ram[2]
+                    ram[sp + 3] = ram[3]
+                    ram[sp + 4] = ram[4]
+                    ram[2] = sp - y
+                    sp += 5
+                    ram[1] = sp
+                    pc = x
+                    depth += 1
+                elif op == 9: # OP_FUNCTION
+                    # A slice assignment past the end would grow the array
+                    if sp + x > RAM_SIZE:
+                        raise IndexError('array assignment index out of range')
+                    ram[sp:sp + x] = y
+                    sp += x
+                elif op == 10: # OP_RETURN
+                    frame = ram[1]
+                    pc = ram[frame - 5]
+                    ram[ram[2]] = ram[sp - 1]
+                    sp = ram[2] + 1
+                    ram[4] = ram[frame - 1]
+                    ram[3] = ram[frame - 2]
+                    ram[2] = ram[frame - 3]
+                    ram[1] = ram[frame - 4]
+                    depth -= 1
+                    if depth < floor:
+                        self.halted = not floor
+                        break
+                elif op == 11: # OP_GOTO
+                    if x == pc - 1:
+                        pc = x
+                        self.halted = True
+                        break
+                    pc = x
+                elif op == 12: # OP_NOT
+                    ram[sp - 1] ^= 0xFFFF
+                elif op == 13: # OP_SUB
+                    sp -= 1
+                    ram[sp - 1] = ram[sp - 1] - ram[sp] & 0xFFFF
+                elif op == 14: # OP_EQ
+                    sp -= 1
+                    ram[sp - 1] = 0xFFFF if ram[sp - 1] == ram[sp] else 0
+                elif op == 15: # OP_LT
+                    sp -= 1
+                    ram[sp - 1] = 0xFFFF if ram[sp - 1] ^ 0x8000 < ram[sp] ^ 0x8000 else 0
+                elif op == 16: # OP_GT
+                    sp -= 1
+                    ram[sp - 1] = 0xFFFF if ram[sp - 1] ^ 0x8000 > ram[sp] ^ 0x8000 else 0
+                elif op == 17: # OP_NEG
+                    ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+                elif op == 18: # OP_AND
+                    sp -= 1
+                    ram[sp - 1] &= ram[sp]
+                else: # OP_OR
+                    sp -= 1
+                    ram[sp - 1] |= ram[sp]
+        except (IndexError, OverflowError) as e:
+            self.halted = True
+            raise RuntimeError('{} in {}'.format(e, self.function_at(pc - 1)))
+        finally:
+            ram[0] = sp & 0xFFFF
+            self.pc, self.depth = pc, depth
+            self.steps += n
+        return n
+
+    def call(self, name, *args):
+        """
+        Calls a VM or OS function from Python and returns its value
+        """
+        native = self.natives.get(name)
+        if native is not None:
+            return (native(*args) or 0) & 0xFFFF
+        ram = self.ram
+        sp = ram[0]
+        for arg in args:
+            ram[sp] = arg & 0xFFFF
+            sp += 1
+        if sp + 5 > RAM_SIZE:
+            raise RuntimeError('Stack overflow calling {}'.format(name))
+        ram[sp] = 0 # Return address, never used
+        ram[sp + 1:sp + 5] = ram[1:5]
+        ram[2] = sp - len(args)
+        ram[0] = ram[1] = sp + 5
+
+        saved = self.pc, self.depth, self.floor
+        self.pc = self.functions[name]
+        self.depth = self.floor = saved[1] + 1
+        while self.depth >= self.floor and not self.halted:
+            self.run(1 << 20)
+        self.pc, self.depth, self.floor = saved
+        ram[0] -= 1
+        return ram[ram[0]]
+
+
+class VMChip:
+    """
+    A VM program for test scripts: RAM[n], sp, local, argument, this, that,
+    and local[n], argument[n], this[n], that[n], temp[n], pointer[n]
+    """
+    POINTERS = {'sp': 0, 'local': 1, 'argument': 2, 'this': 3, 'that': 4}
+
+    def __init__(self, program=()):
+        self.vm = VirtualMachine(program)
+
+    def locate(self, name):
+        match = RE_PIN.match(name)
+        if not match:
+            raise ValueError('Unknown VM variable: {}'.format(name))
+        name, index = match.group('name', 'index')
+        if not index:
+            if name in self.POINTERS:
+                return self.POINTERS[name]
+        elif name == 'RAM':
+            return int(index)
+        elif name in self.POINTERS and name != 'sp':
+            return self.vm.ram[self.POINTERS[name]] + int(index)
+        elif name in ('temp', 'pointer'):
+            return (5 if name == 'temp' else 3) + int(index)
+        raise ValueError('Unknown VM variable: {}'.format(name))
+
+    def set(self, name, value):
+        self.vm.ram[self.locate(name)] = value
+
+    def get(self, name):
+        return self.vm.ram[self.locate(name)]
+
+    def eval(self):
+        pass
+
+    def tick(self):
+        self.vm.run(1)
+
+    def tock(self):
+        pass
+
+    def vmstep(self, count=1):
+        self.vm.run(count)
+
+    def load(self, part, path):
+        raise ValueError('The VM emulator has no part {}'.format(part))
+
+
+def load_chip(path):
+    """
+    Chip for a test script `load` command
+    """
+    return VMChip(read_program(path))
+
+
+def run_script(path):
+    """
+    Runs a test script and returns the number of the first output line that
+    differs from its compare-to file, or None
+    """
+    script = TestScript(path, load_chip)
+    script.run()
+    if script.compare_file:
+        return script.compare()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a VM program or VM emulator test script')
+    parser.add_argument('path', help='.vm file, directory of .vm or .jack files, or .tst test script')
+    parser.add_argument('-n', '--steps', type=int, default=10 ** 8,
+                        help='maximum number of VM commands to run (default: %(default)s)')
+    args = parser.parse_args()
+
+    path = Path(args.path)
+    if path.suffix == '.tst':
+        line = run_script(path)
+        if line:
+            print('Comparison failure at line {}'.format(line))
+            sys.exit(1)
+        print('End of script - Comparison ended successfully')
+        return
+
+    vm = VirtualMachine(read_program(path), console=sys.stdout, keyboard=sys.stdin)
+    start = time.perf_counter()
+    try:
+        vm.run(args.steps)
+    except RuntimeError as e:
+        print('\n{}: {}'.format(path, e), file=sys.stderr)
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+    sys.stdout.flush()
+    print('\n{} commands in {:.3f}s ({:,.0f} commands/sec){}'.format(
+        vm.steps, elapsed, vm.steps / elapsed,
+        ', halted' if vm.halted else ''), file=sys.stderr)
+    if vm.error_code is not None:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -7,96 +7,174 @@ Writes .asm to standard output
 
 from pathlib import Path
 import sys
+import argparse
 import re 
+import itertools
 from collections import Counter
 
+# Command types
+(
+    C_ARITHMETIC,
+    C_PUSH,
+    C_POP,
+    C_LABEL,
+    C_GOTO,
+    C_IF,
+    C_FUNCTION,
+    C_RETURN,
+    C_CALL,
+    C_FUSED,
+) = range(10)
+
+COMMAND_TYPES = (
+    'C_ARITHMETIC',
+    'C_PUSH',
+    'C_POP',
+    'C_LABEL',
+    'C_GOTO',
+    'C_IF',
+    'C_FUNCTION',
+    'C_RETURN',
+    'C_CALL',
+    'C_FUSED',
+)
+
 COMMANDS = {
-    'add': 'C_ARITHMETIC',
-    'sub': 'C_ARITHMETIC',
-    'neg': 'C_ARITHMETIC',
-    'eq': 'C_ARITHMETIC',
-    'gt': 'C_ARITHMETIC',
-    'lt': 'C_ARITHMETIC',
-    'and': 'C_ARITHMETIC',
-    'or': 'C_ARITHMETIC',
-    'not': 'C_ARITHMETIC',
-    'push': 'C_PUSH',
-    'pop': 'C_POP',
-    'label': 'C_LABEL',
-    'goto': 'C_GOTO',
-    'if-goto': 'C_IF',
-    'function': 'C_FUNCTION',
-    'return': 'C_RETURN',
-    'call': 'C_CALL',
+    'add': C_ARITHMETIC,
+    'sub': C_ARITHMETIC,
+    'neg': C_ARITHMETIC,
+    'eq': C_ARITHMETIC,
+    'gt': C_ARITHMETIC,
+    'lt': C_ARITHMETIC,
+    'and': C_ARITHMETIC,
+    'or': C_ARITHMETIC,
+    'not': C_ARITHMETIC,
+    'push': C_PUSH,
+    'pop': C_POP,
+    'label': C_LABEL,
+    'goto': C_GOTO,
+    'if-goto': C_IF,
+    'function': C_FUNCTION,
+    'return': C_RETURN,
+    'call': C_CALL,
+}
+
+# Memory segments
+(
+    S_CONSTANT,
+    S_LOCAL,
+    S_ARGUMENT,
+    S_THIS,
+    S_THAT,
+    S_STATIC,
+    S_TEMP,
+    S_POINTER,
+) = range(8)
+
+SEGMENTS = {
+    'constant': S_CONSTANT,
+    'local': S_LOCAL,
+    'argument': S_ARGUMENT,
+    'this': S_THIS,
+    'that': S_THAT,
+    'static': S_STATIC,
+    'temp': S_TEMP,
+    'pointer': S_POINTER,
 }
 
 RE_INVALID_CHARS = re.compile(r'\s+')
-RE_COMMENT_PATTERN = re.compile(r'//.*')
 
 MAIN_CLASSNAME = 'Main'
 
 
 class Command:
+    __slots__ = ('cmd', 'type', 'arg1', 'arg2', 'segment', 'comment')
+
     def __init__(self, cmd, arg1=None, arg2=None, debug=''):
         self.cmd = cmd
-        self.comment = ''
+        self.comment = debug
         self.arg1 = None
         self.arg2 = None
+        self.segment = None
         self.type = COMMANDS[cmd]
 
-        if self.type == 'C_ARITHMETIC':
+        if self.type == C_ARITHMETIC:
             self.arg1 = cmd
-            self.arg2 = None
-        elif self.type == 'C_RETURN': 
-            self.arg1 = None
+        elif self.type == C_RETURN:
             self.arg2 = arg2
-        elif self.type in ('C_CALL', 'C_FUNCTION', 'C_PUSH', 'C_POP'):
+        elif self.type in (C_PUSH, C_POP):
+            self.arg1 = arg1
+            self.arg2 = int(arg2)
+            self.segment = SEGMENTS.get(arg1)
+        elif self.type in (C_CALL, C_FUNCTION):
             self.arg1 = arg1
-            self.arg2 = int(arg2) 
-        elif self.type in (
-            'C_IF',
-            'C_LABEL',
-            'C_GOTO'
-        ):
+            self.arg2 = int(arg2)
+        else: # C_IF, C_LABEL, C_GOTO
             self.arg1 = arg1
             self.arg2 = arg2
-        else:
-            raise SyntaxError(cmd)
-    
-        # Build the comment string
-        if debug:
-            self.comment = debug 
 
     def __repr__(self):
         return "Command({}, arg1={}, arg2={}, type={}, comment={})".format(
             self.cmd, 
             self.arg1, 
             self.arg2, 
-            self.type,
+            COMMAND_TYPES[self.type],
             self.comment,
         )
 
 
+class Superinstruction:
+    """
+    A sequence of commands that CodeWriter translates as a whole
+    """
+    __slots__ = ('name', 'commands', 'type', 'comment')
+
+    def __init__(self, name, commands):
+        self.name = name
+        self.commands = commands
+        self.type = C_FUSED
+        self.comment = '; '.join(c.comment for c in commands)
+
+    def __repr__(self):
+        return "Superinstruction({}, {})".format(self.name, self.commands)
+
+
 class Parser:
     def __init__(self, lines):
         self.lines = lines
-        
-    def clean(self, line):
-        return RE_COMMENT_PATTERN.sub('', line).strip()
-
-    def tokenize(self, line):
-        return [
-            x.strip() 
-            for x in self.clean(line).split() 
-            if x.strip()
-        ]
 
     def advance(self):
         for line in self.lines:
-            cleaned = self.clean(line)
-            tokens = self.tokenize(line)
-            if tokens:
-                yield Command(*tokens, debug=cleaned)
+            cleaned = line.split('//', 1)[0].strip()
+            if cleaned:
+                yield Command(*cleaned.split(), debug=cleaned)
+
+
+class Emitter:
+    """
+    Collects emitted lines and writes them to `out` in chunks of
+    `chunk_lines`. If `buffer` is given, lines are appended to that list
+    instead.
+    """
+    CHUNK_LINES = 8192
+
+    def __init__(self, out=None, buffer=None, chunk_lines=CHUNK_LINES):
+        self.out = out
+        self.lines = [] if buffer is None else buffer
+        self.direct = buffer is not None
+        self.chunk_lines = chunk_lines
+
+    def write(self, s):
+        self.lines.append(s)
+        if not self.direct and len(self.lines) >= self.chunk_lines:
+            self.flush()
+
+    def flush(self):
+        if self.direct or not self.lines or self.out is None:
+            return
+        self.lines.append('')
+        self.out.write('\n'.join(self.lines))
+        self.lines.clear()
 
 
 class CodeWriter:
@@ -110,10 +188,53 @@ class CodeWriter:
         'that': 'THAT',
     }
 
-    def __init__(self, classname=None, counters=None):
+    def __init__(self, classname=None, counters=None, out=None, shared=False):
         self.classname = classname
         self.counters = counters
-        self.out = sys.stdout
+        self.shared = shared # Use the shared $$ routines for call/return/compare
+        # A plain stream is wrapped in a chunked Emitter, written out by close()
+        self.out = out if isinstance(out, Emitter) else Emitter(out or sys.stdout)
+
+        # Indexed by command type
+        self.writers = (
+            lambda c: self.write_arithmetic(c.cmd), # C_ARITHMETIC
+            self.write_push, # C_PUSH
+            self.write_pop, # C_POP
+            lambda c: self.write_label(c.arg1), # C_LABEL
+            lambda c: self.write_goto(c.arg1), # C_GOTO
+            lambda c: self.write_if(c.arg1), # C_IF
+            lambda c: self.write_function(c.arg1, c.arg2), # C_FUNCTION
+            lambda c: self.write_return(c.arg2), # C_RETURN
+            lambda c: self.write_call(c.arg1, c.arg2), # C_CALL
+            lambda c: self.fused_writers[c.name](*c.commands), # C_FUSED
+        )
+        self.fused_writers = {
+            'array-store': self.write_array_store,
+            'increment': self.write_increment,
+            'compare-branch': self.write_compare_branch,
+            'array-load': self.write_array_load,
+            'not-branch': self.write_not_branch,
+            'add-constant': self.write_add_constant,
+        }
+        self.push_writers = {
+            S_CONSTANT: self.write_push_constant,
+            S_LOCAL: self.write_push_local,
+            S_ARGUMENT: self.write_push_argument,
+            S_THIS: self.write_push_this,
+            S_THAT: self.write_push_that,
+            S_STATIC: self.write_push_static,
+            S_TEMP: self.write_push_temp,
+            S_POINTER: self.write_push_pointer,
+        }
+        self.pop_writers = {
+            S_LOCAL: self.write_pop_local,
+            S_ARGUMENT: self.write_pop_argument,
+            S_THIS: self.write_pop_this,
+            S_THAT: self.write_pop_that,
+            S_STATIC: self.write_pop_static,
+            S_TEMP: self.write_pop_temp,
+            S_POINTER: self.write_pop_pointer,
+        }
 
     def write_bootstrap(self):
         """
@@ -124,70 +245,107 @@ class CodeWriter:
         self.write('D=A')
         self.write('@SP')
         self.write('M=D')
+        if self.shared:
+            self.write_shared_routines()
         self.write_call('Sys.init', 0)
 
+    def write_shared_routines(self):
+        """
+        Writes the $$CALL, $$RETURN and $$CMP routines that call sites jump
+        to instead of inlining the code. Execution skips over them.
+        """
+        self.write('@$$END')
+        self.write('0;JMP')
+
+        self.write_comment('$$CALL: D = return address, R13 = nargs + 5, R14 = function')
+        self.write('($$CALL)')
+        self.dreg_to_stack()
+        for ptr in ['@LCL', '@ARG', '@THIS', '@THAT']:
+            self.write(ptr)
+            self.write('D=M')
+            self.dreg_to_stack()
+        self.write('@SP')
+        self.write('D=M')
+        self.write('@R13')
+        self.write('D=D-M')
+        self.write('@ARG')
+        self.write('M=D')
+        self.write('@SP')
+        self.write('D=M')
+        self.write('@LCL')
+        self.write('M=D')
+        self.write('@R14')
+        self.write('A=M')
+        self.write('0;JMP')
+
+        self.write_comment('$$RETURN')
+        self.write('($$RETURN)')
+        self.write_return_inline()
+
+        self.write_comment('$$CMP: D = return address')
+        for op, jump in [('EQ', 'JEQ'), ('GT', 'JGT'), ('LT', 'JLT')]:
+            self.write('($$CMP.{})'.format(op))
+            self.write('@R15')
+            self.write('M=D')
+            self.write('@SP')
+            self.write('AM=M-1')
+            self.write('D=M')
+            self.write('@SP')
+            self.write('A=M-1')
+            self.write('D=M-D')
+            self.write('@$$CMP.TRUE')
+            self.write('D;{}'.format(jump))
+            self.write('@$$CMP.FALSE')
+            self.write('0;JMP')
+        for label, value in [('TRUE', '-1'), ('FALSE', '0')]:
+            self.write('($$CMP.{})'.format(label))
+            self.write('@SP')
+            self.write('A=M-1')
+            self.write('M={}'.format(value))
+            self.write('@R15')
+            self.write('A=M')
+            self.write('0;JMP')
+
+        self.write('($$END)')
+
     def write_comment(self, s):
         self.write('// {}'.format(s))
 
     def write_command(self, c):
         self.write_comment(c.comment)
-        if c.type == 'C_PUSH':
-            if c.arg1 == 'temp':
-                self.write_push_temp(c.arg2)
-            elif c.arg1 == 'pointer':
-                self.write_push_pointer(c.arg2)
-            elif c.arg1 == 'local':
-                self.write_push_local(c.arg2)
-            elif c.arg1 == 'this':
-                self.write_push_this(c.arg2)
-            elif c.arg1 == 'that':
-                self.write_push_that(c.arg2)
-            elif c.arg1 == 'static':
-                self.write_push_static(c.arg2)
-            elif c.arg1 == 'argument':
-                self.write_push_argument(c.arg2)
-            elif c.arg1 == 'constant':
-                self.write_push_constant(c.arg2)
-            else:
-                raise SyntaxError("C_PUSH invalid segment: {}".format(c.arg1))
-
-        elif c.type == 'C_POP':
-            if c.arg1 == 'temp':
-                self.write_pop_temp(c.arg2)
-            elif c.arg1 == 'pointer':
-                self.write_pop_pointer(c.arg2)
-            elif c.arg1 == 'local':
-                self.write_pop_local(c.arg2)
-            elif c.arg1 == 'this':
-                self.write_pop_this(c.arg2)
-            elif c.arg1 == 'that':
-                self.write_pop_that(c.arg2)
-            elif c.arg1 == 'static':
-                self.write_pop_static(c.arg2)
-            elif c.arg1 == 'argument':
-                self.write_pop_argument(c.arg2)
-            else:
-                raise SyntaxError("C_POP invalid segment: {}".format(c.arg1))
-
-        elif c.type == 'C_ARITHMETIC':
-            self.write_arithmetic(c.cmd)
-        elif c.type == 'C_CALL':
-            self.write_call(c.arg1, c.arg2)
-        elif c.type == 'C_FUNCTION':
-            self.write_function(c.arg1, c.arg2)
-        elif c.type == 'C_RETURN':
-            self.write_return(c.arg2)
-        elif c.type == 'C_IF':
-            self.write_if(c.arg1)
-        elif c.type == 'C_LABEL':
-            self.write_label(c.arg1)
-        elif c.type == 'C_GOTO':
-            self.write_goto(c.arg1)
-        else:
-            raise SyntaxError(c.type)
+        self.writers[c.type](c)
+
+    def stream(self, commands):
+        """
+        Yields the assembly lines of each command as soon as it is written.
+        Needs an Emitter with a buffer, which is emptied as it goes.
+        """
+        lines = self.out.lines
+        for command in commands:
+            self.write_command(command)
+            yield from lines
+            lines.clear()
+
+    def write_push(self, c):
+        writer = self.push_writers.get(c.segment)
+        if writer is None:
+            raise SyntaxError("C_PUSH invalid segment: {}".format(c.arg1))
+        writer(c.arg2)
+
+    def write_pop(self, c):
+        writer = self.pop_writers.get(c.segment)
+        if writer is None:
+            raise SyntaxError("C_POP invalid segment: {}".format(c.arg1))
+        writer(c.arg2)
 
     def write(self, s):
-        print(s, file=self.out)
+        self.out.write(s)
+
+    def close(self):
+        """
+        Writes out any lines still held in the Emitter
+        """
+        self.out.flush()
 
     def dreg_to_stack(self):
         """
@@ -283,7 +441,15 @@ class CodeWriter:
         self.write('M=D')
             
     def write_arithmetic(self, op):
-        if op == 'neg':
+        if self.shared and op in ('eq', 'lt', 'gt'):
+            return_label = '{}$CMP_RET.{}'.format(self.classname, self.counters['bool_labels'])
+            self.write('@{}'.format(return_label))
+            self.write('D=A')
+            self.write('@$$CMP.{}'.format(op.upper()))
+            self.write('0;JMP')
+            self.write('({})'.format(return_label))
+
+        elif op == 'neg':
             self.write('@SP')
             self.write('A=M-1')
             self.write('M=-M')
@@ -353,6 +519,13 @@ class CodeWriter:
             self.write_push_constant(0)
 
     def write_return(self, label):
+        if self.shared:
+            self.write('@$$RETURN')
+            self.write('0;JMP')
+        else:
+            self.write_return_inline()
+
+    def write_return_inline(self):
         self.write_comment('Store endFrame in @R13')
         self.write('@LCL')
         self.write('D=M')
@@ -413,7 +586,30 @@ class CodeWriter:
 
     def write_call(self, funcname, nvars):
         return_label = '{}$RET.{}'.format(funcname, self.counters['return_labels'])
+        if self.shared:
+            self.write_call_trampoline(funcname, nvars, return_label)
+        else:
+            self.write_call_inline(funcname, nvars, return_label)
+
+        # Increment return label index for next time
+        self.counters['return_labels'] += 1
 
+    def write_call_trampoline(self, funcname, nvars, return_label):
+        self.write('@{}'.format(5 + nvars))
+        self.write('D=A')
+        self.write('@R13')
+        self.write('M=D')
+        self.write('@{}'.format(funcname))
+        self.write('D=A')
+        self.write('@R14')
+        self.write('M=D')
+        self.write('@{}'.format(return_label))
+        self.write('D=A')
+        self.write('@$$CALL')
+        self.write('0;JMP')
+        self.write('({})'.format(return_label))
+
+    def write_call_inline(self, funcname, nvars, return_label):
         self.write_comment('Save return address for {} to stack'.format(return_label))
         self.write('@{}'.format(return_label))
         self.write('D=A')
@@ -448,26 +644,414 @@ class CodeWriter:
         self.write_comment('Write return label {}'.format(return_label))
         self.write('({})'.format(return_label))
 
-        # Increment return label index for next time
-        self.counters['return_labels'] += 1
-        
-def main():
-    path = Path(sys.argv[1])
+
+    def fixed_address(self, segment, index):
+        """
+        The A-instruction of a static, temp or pointer entry, or None
+        """
+        if segment == S_STATIC:
+            return '@{}.{}'.format(self.classname, index)
+        elif segment == S_TEMP:
+            return '@{}'.format(5 + index)
+        elif segment == S_POINTER:
+            return '@THAT' if index else '@THIS'
+
+    def write_add_constant(self, push, op):
+        """
+        push constant N; add|sub
+        """
+        sign = '+' if op.cmd == 'add' else '-'
+        if push.arg2 == 1:
+            self.write('@SP')
+            self.write('A=M-1')
+            self.write('M=M{}1'.format(sign))
+        else:
+            self.write('@{}'.format(push.arg2))
+            self.write('D=A')
+            self.write('@SP')
+            self.write('A=M-1')
+            self.write('M=M{}D'.format(sign))
+
+    def write_increment(self, push, constant, op, pop):
+        """
+        push S i; push constant N; add|sub; pop S i
+        """
+        sign = '+' if op.cmd == 'add' else '-'
+        n = constant.arg2
+        address = self.fixed_address(push.segment, push.arg2)
+        if address:
+            if n != 1:
+                self.write('@{}'.format(n))
+                self.write('D=A')
+            self.write(address)
+        elif n == 1:
+            if push.arg2:
+                self.write('@{}'.format(push.arg2))
+                self.write('D=A')
+                self.write('@{}'.format(self.BASE_ADDRESSES[push.arg1]))
+                self.write('A=D+M')
+            else:
+                self.write('@{}'.format(self.BASE_ADDRESSES[push.arg1]))
+                self.write('A=M')
+        else:
+            self.write('@{}'.format(self.BASE_ADDRESSES[push.arg1]))
+            self.write('D=M')
+            self.write('@{}'.format(push.arg2))
+            self.write('D=D+A')
+            self.write('@R13')
+            self.write('M=D')
+            self.write('@{}'.format(n))
+            self.write('D=A')
+            self.write('@R13')
+            self.write('A=M')
+        self.write('M=M{}{}'.format(sign, 1 if n == 1 else 'D'))
+
+    def write_compare_branch(self, op, *rest):
+        """
+        eq|lt|gt; [not;] if-goto L, without materializing the boolean
+        """
+        jumps = {'eq': ('JEQ', 'JNE'), 'lt': ('JLT', 'JGE'), 'gt': ('JGT', 'JLE')}
+        jump = jumps[op.cmd][len(rest) == 2]
+        self.write('@SP')
+        self.write('AM=M-1')
+        self.write('D=M')
+        self.write('@SP')
+        self.write('AM=M-1')
+        self.write('D=M-D')
+        self.write('@{}${}'.format(self.classname, rest[-1].arg1))
+        self.write('D;{}'.format(jump))
+
+    def write_not_branch(self, op, goto):
+        """
+        not; if-goto L: jumps unless the value is -1
+        """
+        self.write('@SP')
+        self.write('AM=M-1')
+        self.write('D=M+1')
+        self.write('@{}${}'.format(self.classname, goto.arg1))
+        self.write('D;JNE')
+
+    def write_array_load(self, op, pop, push):
+        """
+        add; pop pointer 1; push that 0
+        """
+        self.write('@SP')
+        self.write('AM=M-1')
+        self.write('D=M')
+        self.write('@SP')
+        self.write('A=M-1')
+        self.write('D=D+M')
+        self.write('@THAT')
+        self.write('M=D')
+        self.write('A=D')
+        self.write('D=M')
+        self.write('@SP')
+        self.write('A=M-1')
+        self.write('M=D')
+
+    def write_array_store(self, pop_temp, pop_pointer, push_temp, pop_that):
+        """
+        pop temp i; pop pointer 1; push temp i; pop that 0. Temp i and THAT
+        are still set, in case anything reads them later.
+        """
+        temp = self.fixed_address(S_TEMP, pop_temp.arg2)
+        self.write('@SP')
+        self.write('AM=M-1')
+        self.write('D=M')
+        self.write(temp)
+        self.write('M=D')
+        self.write('@SP')
+        self.write('AM=M-1')
+        self.write('D=M')
+        self.write('@THAT')
+        self.write('M=D')
+        self.write(temp)
+        self.write('D=M')
+        self.write('@THAT')
+        self.write('A=M')
+        self.write('M=D')
+
+
+class Fusion:
+    """
+    Optional pass over the parsed commands that replaces common sequences
+    from the Jack compiler with superinstructions. Labels are commands too,
+    so a sequence is never fused across one.
+    """
+    PATTERNS = (
+        'array-store',
+        'increment',
+        'compare-branch',
+        'array-load',
+        'not-branch',
+        'add-constant',
+    )
+    WINDOW = 4 # Longest pattern
+
+    def __init__(self, patterns=PATTERNS):
+        self.matchers = [
+            (name, getattr(self, 'match_' + name.replace('-', '_')))
+            for name in patterns
+        ]
+        self.fused = Counter() # Superinstructions made, by pattern
+
+    @staticmethod
+    def match(c, cmd, arg1=None, arg2=None):
+        return (c.cmd == cmd and (arg1 is None or c.arg1 == arg1) and
+                (arg2 is None or c.arg2 == arg2))
+
+    def match_array_store(self, w):
+        if (len(w) >= 4 and self.match(w[0], 'pop', 'temp') and
+                self.match(w[1], 'pop', 'pointer', 1) and
+                self.match(w[2], 'push', 'temp', w[0].arg2) and
+                self.match(w[3], 'pop', 'that', 0)):
+            return 4
+
+    def match_increment(self, w):
+        if (len(w) >= 4 and w[0].type == C_PUSH and w[0].segment != S_CONSTANT and
+                self.match(w[1], 'push', 'constant') and w[2].cmd in ('add', 'sub') and
+                self.match(w[3], 'pop', w[0].arg1, w[0].arg2)):
+            return 4
+
+    def match_compare_branch(self, w):
+        if len(w) >= 2 and w[0].cmd in ('eq', 'lt', 'gt'):
+            if w[1].cmd == 'if-goto':
+                return 2
+            if len(w) >= 3 and w[1].cmd == 'not' and w[2].cmd == 'if-goto':
+                return 3
+
+    def match_array_load(self, w):
+        if (len(w) >= 3 and w[0].cmd == 'add' and
+                self.match(w[1], 'pop', 'pointer', 1) and
+                self.match(w[2], 'push', 'that', 0)):
+            return 3
+
+    def match_not_branch(self, w):
+        if len(w) >= 2 and w[0].cmd == 'not' and w[1].cmd == 'if-goto':
+            return 2
+
+    def match_add_constant(self, w):
+        if len(w) >= 2 and self.match(w[0], 'push', 'constant') and w[1].cmd in ('add', 'sub'):
+            return 2
+
+    def fuse(self, commands):
+        """
+        Yields the commands, with the matched sequences replaced
+        """
+        commands = iter(commands)
+        window = []
+        while True:
+            window.extend(itertools.islice(commands, self.WINDOW - len(window)))
+            if not window:
+                return
+            for name, match in self.matchers:
+                n = match(window)
+                if n:
+                    self.fused[name] += 1
+                    yield Superinstruction(name, window[:n])
+                    del window[:n]
+                    break
+            else:
+                yield window.pop(0)
+
+
+class Peephole:
+    """
+    Optional optimization pass over the generated assembly. Comment lines
+    are kept but ignored; labels end every window since they can be jumped
+    to from anywhere.
+    """
+    # Push of the D-register immediately followed by a pop into D
+    PUSH_POP = (
+        '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+        '@SP', 'M=M-1', 'A=M', 'D=M',
+    )
+    DEREFS = ('A=M', 'A=M-1', 'A=M+1')
+
+    def __init__(self):
+        self.removed = Counter() # Instructions removed, by rule
+
+    @staticmethod
+    def split(line):
+        """
+        Splits a C-instruction into (dest, comp, jump)
+        """
+        dest, _, rest = line.rpartition('=')
+        comp, _, jump = rest.partition(';')
+        return dest, comp, jump
+
+    @staticmethod
+    def code(lines):
+        return [i for i, line in enumerate(lines) if not line.startswith('//')]
+
+    def drop(self, lines, indexes, rule):
+        self.removed[rule] += len(indexes)
+        return [line for i, line in enumerate(lines) if i not in indexes]
+
+    def optimize(self, lines):
+        while True:
+            count = len(lines)
+            lines = self.remove_push_pop(lines)
+            lines = self.remove_zero_offsets(lines)
+            lines = self.remove_dead_writes(lines)
+            lines = self.remove_reloads(lines)
+            if len(lines) == count:
+                return lines
+
+    def remove_push_pop(self, lines):
+        """
+        A push straight into a pop leaves the value in D where it started,
+        as long as the next instruction loads A
+        """
+        code = self.code(lines)
+        size = len(self.PUSH_POP)
+        drop = set()
+        i = 0
+        while i + size < len(code):
+            if (lines[code[i]] == '@SP' and
+                    tuple(lines[j] for j in code[i:i + size]) == self.PUSH_POP and
+                    lines[code[i + size]].startswith('@')):
+                drop.update(code[i:i + size])
+                i += size
+            else:
+                i += 1
+        return self.drop(lines, drop, 'push/pop')
+
+    def remove_zero_offsets(self, lines):
+        """
+        '@0' 'A=A+D' is just 'A=D', which is a no-op right after 'D=A'
+        """
+        code = self.code(lines)
+        drop = set()
+        for i, j in zip(code, code[1:]):
+            if lines[i] == '@0' and lines[j] == 'A=A+D':
+                lines[j] = 'A=D'
+                drop.add(i)
+            elif lines[i] in ('D=A', 'A=D') and lines[j] in ('D=A', 'A=D'):
+                drop.add(j)
+        return self.drop(lines, drop, 'zero offset')
+
+    def remove_dead_writes(self, lines):
+        """
+        Drops A and D writes that are overwritten before being read
+        """
+        code = self.code(lines)
+        drop = set()
+        for i, j in zip(code, code[1:]):
+            line, nxt = lines[i], lines[j]
+            if line.startswith('@'):
+                if nxt.startswith('@'):
+                    drop.add(i)
+                continue
+            if line.startswith('(') or nxt.startswith('('):
+                continue
+            dest, comp, jump = self.split(line)
+            if jump:
+                continue
+            if dest == 'A' and nxt.startswith('@'):
+                drop.add(i)
+            elif dest == 'D' and not nxt.startswith('@'):
+                next_dest, next_comp, _ = self.split(nxt)
+                if 'D' in next_dest and 'D' not in next_comp:
+                    drop.add(i)
+        return self.drop(lines, drop, 'dead write')
+
+    def remove_reloads(self, lines):
+        """
+        Drops '@X' (or an '@X' 'A=M' pair) that reloads the address already
+        in A, and 'D=M' when D already holds that memory word
+        """
+        code = self.code(lines)
+        drop = set()
+        a = None # Instructions that produced the current A
+        d = None # Value of `a` whose memory word is also in D
+        i = 0
+        while i < len(code):
+            line = lines[code[i]]
+            nxt = lines[code[i + 1]] if i + 1 < len(code) else None
+
+            if line.startswith('('):
+                a = d = None
+            elif line.startswith('@'):
+                if a == (line,):
+                    drop.add(code[i])
+                elif nxt in self.DEREFS and a == (line, nxt):
+                    drop.update(code[i:i + 2])
+                    i += 1
+                else:
+                    a = (line,)
+            elif line == 'D=M' and a is not None and d == a:
+                drop.add(code[i])
+            else:
+                dest, comp, jump = self.split(line)
+                if (dest, comp) in (('M', 'D'), ('D', 'M')):
+                    d = a
+                elif 'M' in dest or 'D' in dest:
+                    d = None
+                if 'A' in dest:
+                    # A pointer stays valid until the pointer itself is written
+                    deref = dest == 'A' and a is not None and len(a) == 1
+                    a = a + (line,) if deref and line in self.DEREFS else None
+                if jump == 'JMP':
+                    a = d = None
+            i += 1
+        return self.drop(lines, drop, 'reload')
+
+
+def translate(vmfiles, shared=False, bootstrap=True, fusion=None):
+    """
+    Lazily translates .vm files, yielding assembly lines. Files are read a
+    line at a time, so nothing is held in memory but the current command.
+    Commands go through `fusion`, a Fusion, if one is given.
+    """
     counters = Counter() # For keeping track of labels
+    lines = []
+    out = Emitter(buffer=lines)
+    if bootstrap:
+        CodeWriter(counters=counters, out=out, shared=shared).write_bootstrap()
+    elif shared:
+        CodeWriter(counters=counters, out=out, shared=True).write_shared_routines()
+    yield from lines
+    lines.clear()
 
-    # If argument is a directory, get all *.vm files, generate bootstrap code
-    if path.is_dir():
-        vmfiles = path.glob('**/*.vm') 
-        CodeWriter(counters=counters).write_bootstrap()
-    else:
-        vmfiles = [path] # Don't generate bootstrap code if there's only one vm file
     for filename in vmfiles:
         classname = Path(filename).name.split('.')[0]
         with open(str(filename), 'r') as f:
-            parser = Parser(f.readlines())
-            writer = CodeWriter(classname=classname, counters=counters)
-            for command in parser.advance():
-                writer.write_command(command)
+            writer = CodeWriter(classname=classname, counters=counters, out=out,
+                                shared=shared)
+            commands = Parser(f).advance()
+            if fusion:
+                commands = fusion.fuse(commands)
+            yield from writer.stream(commands)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Translate .vm files to Hack assembly')
+    parser.add_argument('path', help='.vm file or directory of .vm files')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='run the peephole optimizer over the output')
+    parser.add_argument('-s', '--shared', action='store_true',
+                        help='jump to shared call/return/compare routines instead of inlining them')
+    parser.add_argument('-f', '--fuse', action='store_true',
+                        help='translate common command sequences as superinstructions')
+    args = parser.parse_args()
+    fusion = Fusion() if args.fuse else None
+
+    path = Path(args.path)
+
+    # If argument is a directory, get all *.vm files, generate bootstrap code
+    if path.is_dir():
+        lines = translate(path.glob('**/*.vm'), shared=args.shared, fusion=fusion)
+    else:
+        # Don't generate bootstrap code if there's only one vm file
+        lines = translate([path], shared=args.shared, bootstrap=False, fusion=fusion)
+
+    if args.optimize:
+        lines = Peephole().optimize(list(lines))
+    out = Emitter(sys.stdout)
+    for line in lines:
+        out.write(line)
+    out.flush()
 
 if __name__ == '__main__':
     main()
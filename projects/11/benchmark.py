@@ -0,0 +1,341 @@
+"""
+Jack compiler benchmarks
+
+Usage: python3 benchmark.py [name ...]
+
+The corpus is every .jack file under projects/, concatenated as many times
+as each benchmark needs.
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+import importlib.util
+from pathlib import Path
+from collections import Counter
+
+from tokenizer import Tokenizer, StreamTokenizer
+from compiler import compile_all, CompilationEngine, Parser, CodeGenerator, Emitter
+from build import Toolchain, HackAssembler, compile_class, read_sources, request_build
+
+HERE = Path(__file__).resolve().parent
+PROJECTS = HERE.parent
+
+sys.path.insert(0, str(PROJECTS / '05'))
+from CPUEmulator import Computer, SCREEN, KBD
+sys.path.pop(0)
+
+
+def load_corpus(repeat):
+    sources = [p.read_text() for p in sorted(PROJECTS.glob('**/*.jack'))]
+    return '\n'.join(sources) * repeat
+
+
+def load_programs():
+    """
+    Sources of the projects/12 OS and the projects/09 sample programs
+    """
+    paths = sorted(PROJECTS.glob('12/*.jack')) + sorted(PROJECTS.glob('09/**/*.jack'))
+    return [p.read_text() for p in paths]
+
+
+def load_legacy_tokenizer():
+    """
+    projects/10 still has the original character-at-a-time tokenizer
+    """
+    sys.path.insert(0, str(PROJECTS / '10'))
+    try:
+        spec = importlib.util.spec_from_file_location(
+            'legacy_tokenizer', str(PROJECTS / '10' / 'tokenizer.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.pop(0)
+    return module.Tokenizer
+
+
+def count_tokens(tokenizer):
+    n = 0
+    while tokenizer.get_token():
+        n += 1
+    return n
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_tokenizer(data):
+    print('Tokenizer throughput ({} KB)'.format(len(data) // 1024))
+    for name, cls in [
+        ('legacy', load_legacy_tokenizer()),
+        ('regex', Tokenizer),
+    ]:
+        tokenizer = cls(data)
+        ntokens, elapsed = timed(count_tokens, tokenizer)
+        print('  {:<8} {:>9} tokens {:>8.3f}s {:>12,.0f} tokens/sec'.format(
+            name, ntokens, elapsed, ntokens / elapsed))
+
+
+def bench_strip_comments():
+    print('Comment stripping scaling')
+    corpus = load_corpus(1)
+    base = None
+    for size in (10 * 1024, 1024 * 1024, 10 * 1024 * 1024):
+        data = (corpus * (size // len(corpus) + 1))[:size]
+        _, elapsed = timed(Tokenizer('').strip_comments, data)
+        per_kb = elapsed / (size / 1024) * 1e6
+        base = base or per_kb
+        print('  {:>6} KB {:>8.3f}s {:>8.2f} us/KB ({:.2f}x the 10 KB rate)'.format(
+            size // 1024, elapsed, per_kb, per_kb / base))
+
+
+def bench_stream():
+    print('Peak tokenizer memory')
+    corpus = load_corpus(1)
+    for size in (1024 * 1024, 10 * 1024 * 1024):
+        with tempfile.TemporaryFile('w+') as f:
+            f.write((corpus * (size // len(corpus) + 1))[:size])
+            for name, make in [
+                ('whole', lambda: Tokenizer(f.read())),
+                ('stream', lambda: StreamTokenizer(f)),
+            ]:
+                f.seek(0)
+                tracemalloc.start()
+                _, elapsed = timed(count_tokens, make())
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print('  {:>6} KB {:<8} {:>8.3f}s {:>10,} KB peak'.format(
+                    size // 1024, name, elapsed, peak // 1024))
+
+
+def make_project(tmp, copies):
+    """
+    Copies every .jack file under projects/ `copies` times into tmp/src
+    """
+    srcdir = Path(tmp, 'src')
+    srcdir.mkdir()
+    for n in range(copies):
+        for p in PROJECTS.glob('**/*.jack'):
+            shutil.copy(str(p), str(srcdir / '{}_{}_{}'.format(
+                n, p.parent.name, p.name)))
+    return list(srcdir.glob('*.jack'))
+
+
+def bench_parallel(copies=20):
+    print('Parallel compilation wall time')
+    with tempfile.TemporaryDirectory() as tmp:
+        jackfiles = make_project(tmp, copies)
+
+        jobs = 1
+        while True:
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, elapsed = timed(compile_all, jackfiles, tmp, jobs, False)
+            print('  -j {:<3} {:>5} files {:>8.3f}s'.format(
+                jobs, len(jackfiles), elapsed))
+            if jobs >= os.cpu_count():
+                break
+            jobs = min(jobs * 2, os.cpu_count())
+
+
+def bench_cache(copies=20):
+    print('Build cache')
+    with tempfile.TemporaryDirectory() as tmp:
+        jackfiles = make_project(tmp, copies)
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, cold = timed(compile_all, jackfiles, tmp)
+            with open(str(jackfiles[0]), 'a') as f:
+                f.write('\n// edited\n')
+            _, warm = timed(compile_all, jackfiles, tmp)
+        print('  {} files: full build {:.3f}s, after one-file edit {:.3f}s'.format(
+            len(jackfiles), cold, warm))
+
+
+class PrintEngine(CompilationEngine):
+    """
+    Writes every line with its own print() call, as before Emitter
+    """
+    def write(self, s):
+        print(s, file=self.out.out)
+
+
+def bench_emit(repeat=20):
+    print('Output throughput (projects/12 OS + projects/09, x{})'.format(repeat))
+    sources = load_programs() * repeat
+    lines = []
+    for source in sources:
+        CompilationEngine(Tokenizer(source), Emitter(buffer=lines)).compile()
+
+    for name, cls in [('print', PrintEngine), ('emitter', CompilationEngine)]:
+        with tempfile.TemporaryFile('w') as out:
+            start = time.perf_counter()
+            for source in sources:
+                cls(Tokenizer(source), out).compile()
+            elapsed = time.perf_counter() - start
+        print('  {:<8} {:>8} lines {:>8.3f}s {:>12,.0f} lines/sec'.format(
+            name, len(lines), elapsed, len(lines) / elapsed))
+
+
+def bench_ast(repeat=20):
+    print('Parsing and code generation (projects/12 OS + projects/09, x{})'.format(repeat))
+    sources = load_programs() * repeat
+    # Before the trees below are kept alive, which slows the garbage collector
+    _, both = timed(lambda: [
+        CompilationEngine(Tokenizer(s), Emitter(buffer=[])).compile() for s in sources])
+    trees, parse = timed(lambda: [Parser(Tokenizer(s)).parse_class() for s in sources])
+    lines = []
+    _, generate = timed(lambda: [CodeGenerator(Emitter(buffer=lines)).generate(t) for t in trees])
+    for name, elapsed in [('parse', parse), ('generate', generate), ('both', both)]:
+        print('  {:<8} {:>8} lines {:>8.3f}s {:>12,.0f} lines/sec'.format(
+            name, len(lines), elapsed, len(lines) / elapsed))
+
+
+def load_build_programs():
+    """
+    Directories of the projects/09 sample programs and projects/12 tests
+    """
+    dirs = sorted(PROJECTS.glob('09/*/')) + sorted(PROJECTS.glob('12/*/'))
+    return [d for d in dirs if any(d.glob('*.jack'))]
+
+
+def build_with_processes(d, tmp):
+    """
+    compiler.py, vmtranslator.py and HackAssembler.py one after another,
+    passing files
+    """
+    srcdir = Path(tmp, d.name)
+    srcdir.mkdir()
+    for p in list(PROJECTS.glob('12/*.jack')) + list(d.glob('*.jack')):
+        shutil.copy(str(p), str(srcdir / p.name))
+    subprocess.check_call([sys.executable, str(HERE / 'compiler.py'), '--no-cache', d.name],
+                          cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    asm = srcdir.with_suffix('.asm')
+    with open(str(asm), 'w') as f:
+        subprocess.check_call([sys.executable, str(PROJECTS / '08' / 'vmtranslator.py'),
+                               '-s', '-O', str(srcdir)], stdout=f)
+    with open(str(srcdir.with_suffix('.hack')), 'w') as f:
+        subprocess.check_call([sys.executable, str(PROJECTS / '06' / 'HackAssembler.py'),
+                               str(asm)], stdout=f)
+
+
+def wait_for_server(path):
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.01)
+
+
+def bench_pipeline():
+    options = dict(optimize=True, shared=True)
+    toolchain = Toolchain()
+    dirs = []
+    for d in load_build_programs():
+        try:
+            toolchain.build(read_sources(d), **options)
+            dirs.append(d)
+        except ValueError as e:
+            print('  skipping {}: {}'.format(d.name, e))
+    print('Whole-program builds with the OS, -s -O ({} programs)'.format(len(dirs)))
+    sources = [read_sources(d) for d in dirs]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _, processes = timed(lambda: [build_with_processes(d, tmp) for d in dirs])
+
+        toolchain = Toolchain()
+        _, cold = timed(lambda: toolchain.build(sources[0], **options))
+        _, warm = timed(lambda: [toolchain.build(s, **options) for s in sources])
+
+        sock = str(Path(tmp, 'build.sock'))
+        server = subprocess.Popen([sys.executable, str(HERE / 'build.py'), '--serve', sock])
+        try:
+            wait_for_server(sock)
+            _, daemon = timed(lambda: [request_build(sock, s, **options) for s in sources])
+        finally:
+            server.terminate()
+            server.wait()
+
+    for name, elapsed, count in [
+        ('process', processes, len(dirs)),
+        ('cold', cold, 1),
+        ('warm', warm, len(dirs)),
+        ('daemon', daemon, len(dirs)),
+    ]:
+        print('  {:<8} {:>8.3f}s {:>8.1f} ms/program'.format(
+            name, elapsed, elapsed / count * 1e3))
+
+
+def build_halting(toolchain, sources, fold):
+    """
+    The program linked with the OS and translated with -s, stopping when
+    Sys.init returns
+    """
+    classes = {c: compile_class(source, fold) for c, source in sorted(sources.items())}
+    os_classes = toolchain.load_os(fold)
+    classes = dict({c: os_classes[c] for c in os_classes if c not in classes}, **classes)
+    counters = Counter()
+    lines = list(toolchain.translate({}, counters, shared=True, bootstrap=True))
+    lines.extend(['(BENCH.HALT)', '@BENCH.HALT', '0;JMP'])
+    lines.extend(toolchain.translate(classes, counters, shared=True))
+    return HackAssembler.Assembler().assemble(lines)
+
+
+def bench_fold(screen_cycles=2 * 10 ** 7):
+    print('Constant folding, projects/12 tests with the OS linked in, -s')
+    toolchain = Toolchain()
+    math, screen = [], []
+    for fold in (False, True):
+        # MathTest runs to the end
+        program = build_halting(toolchain, read_sources(PROJECTS / '12' / 'MathTest'), fold)
+        computer = Computer(program)
+        cycles = computer.run(10 ** 8)
+        math.append((len(program), cycles, computer.ram[8000:8014]))
+
+        # ScreenTest takes billions of cycles, so it is timed over the start
+        # of its first line, which only ever sets pixels
+        program = build_halting(toolchain, read_sources(PROJECTS / '12' / 'ScreenTest'), fold)
+        computer = Computer(program)
+        cycles = computer.run(screen_cycles)
+        pixels = sum(bin(word).count('1') for word in computer.ram[SCREEN:KBD])
+        screen.append((len(program), cycles / pixels))
+
+    assert math[0][2] == math[1][2], 'MathTest results differ'
+    for name, (base, fold), unit in [
+        ('MathTest', (math[0][:2], math[1][:2]), 'cycles'),
+        ('ScreenTest', screen, 'cycles/pixel'),
+    ]:
+        print('  {:<10} {:>6} ROM {:>12,.0f} {:<12} fold: {:>6} ROM {:>12,.0f} ({:+.1%})'.format(
+            name, base[0], base[1], unit, fold[0], fold[1], fold[1] / base[1] - 1))
+
+
+BENCHMARKS = {
+    'tokenizer': lambda: bench_tokenizer(load_corpus(5)),
+    'strip_comments': bench_strip_comments,
+    'stream': bench_stream,
+    'parallel': bench_parallel,
+    'cache': bench_cache,
+    'emit': bench_emit,
+    'ast': bench_ast,
+    'pipeline': bench_pipeline,
+    'fold': bench_fold,
+}
+
+
+def main():
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Build Jack programs all the way to Hack machine code in one process
+
+Usage: python3 build.py path [-o program.hack] [-O] [-s] [-b] [-F]
+       python3 build.py --serve SOCKET
+       python3 build.py --socket SOCKET path ...
+
+The compiler, the projects/08 VM translator and the projects/06 assembler
+pass lines to each other in memory, so nothing is written to disk but the
+final program. Classes the program doesn't define itself are taken from the
+projects/12 OS, which is compiled and translated once per process.
+
+With --serve, builds are requested over a Unix socket: one JSON object per
+connection, answered with one JSON object. The OS is compiled once, before
+serving, and every request runs in a process forked from the warm server.
+"""
+
+import os
+import sys
+import json
+import socket
+import socketserver
+import argparse
+import itertools
+from collections import Counter
+from pathlib import Path
+
+from tokenizer import Tokenizer
+from compiler import Parser, CodeGenerator, Emitter
+
+HERE = Path(__file__).resolve().parent
+PROJECTS = HERE.parent
+OS_DIR = PROJECTS / '12'
+ROM_SIZE = 32768
+
+sys.path.insert(0, str(PROJECTS / '08'))
+sys.path.insert(0, str(PROJECTS / '06'))
+import vmtranslator
+import HackAssembler
+del sys.path[:2]
+
+
+def read_sources(path):
+    """
+    Returns {classname: source} for a .jack file or a directory of them
+    """
+    path = Path(path)
+    jackfiles = sorted(path.glob('*.jack')) if path.is_dir() else [path]
+    return {p.stem: p.read_text() for p in jackfiles}
+
+
+def parse(source):
+    """
+    Returns the AST of one class
+    """
+    return Parser(Tokenizer(source)).parse_class()
+
+
+def generate(tree, fold=False):
+    """
+    Returns the VM lines of a class AST
+    """
+    lines = []
+    CodeGenerator(Emitter(buffer=lines), fold).generate(tree)
+    return lines
+
+
+def compile_class(source, fold=False):
+    """
+    Returns the VM lines of one class
+    """
+    return generate(parse(source), fold)
+
+
+class Toolchain:
+    """
+    Keeps what can be reused between builds: the ASTs of the sources seen so
+    far, the compiled OS classes, their translation, and the assembler's
+    instruction cache
+    """
+    def __init__(self, os_dir=OS_DIR):
+        self.os_dir = os_dir
+        self.trees = {} # Jack source -> AST
+        self.os_classes = {}
+        self.prefixes = {}
+        self.assembler = HackAssembler.Assembler()
+
+    def compile(self, source, fold=False):
+        """
+        Returns the VM lines of one class, parsing each source only once
+        """
+        tree = self.trees.get(source)
+        if tree is None:
+            tree = self.trees[source] = parse(source)
+        return generate(tree, fold)
+
+    def load_os(self, fold=False):
+        if fold not in self.os_classes:
+            self.os_classes[fold] = {
+                classname: self.compile(source, fold)
+                for classname, source in read_sources(self.os_dir).items()
+            }
+        return self.os_classes[fold]
+
+    def translate(self, classes, counters, optimize=False, shared=False, bootstrap=False):
+        """
+        Returns the assembly lines for {classname: VM lines}, as a generator
+        unless they have to be optimized
+        """
+        lines = self.stream(classes, counters, shared, bootstrap)
+        if optimize:
+            # Every class starts with a function label, which the peephole
+            # optimizer never looks across, so classes can be optimized apart
+            return vmtranslator.Peephole().optimize(list(lines))
+        return lines
+
+    def stream(self, classes, counters, shared=False, bootstrap=False):
+        lines = []
+        out = vmtranslator.Emitter(buffer=lines)
+        if bootstrap:
+            vmtranslator.CodeWriter(counters=counters, out=out, shared=shared).write_bootstrap()
+            yield from lines
+            lines.clear()
+        for classname, vmlines in classes.items():
+            writer = vmtranslator.CodeWriter(classname=classname, counters=counters,
+                                             out=out, shared=shared)
+            yield from writer.stream(vmtranslator.Parser(vmlines).advance())
+
+    def prefix(self, os_classnames, optimize=False, shared=False, fold=False):
+        """
+        Returns the bootstrap code and the given OS classes, and the label
+        counters to carry on from. Translated once for each combination.
+        """
+        key = (os_classnames, optimize, shared, fold)
+        if key not in self.prefixes:
+            os_classes = self.load_os(fold)
+            counters = Counter()
+            lines = list(self.translate({c: os_classes[c] for c in os_classnames},
+                                        counters, optimize, shared, bootstrap=True))
+            self.prefixes[key] = (lines, counters)
+        return self.prefixes[key]
+
+    def build(self, sources, optimize=False, shared=False, link_os=True, fold=False):
+        """
+        Returns the instructions for {classname: Jack source}
+        """
+        classes = {
+            classname: self.compile(source, fold)
+            for classname, source in sorted(sources.items())
+        }
+        os_classnames = tuple(
+            classname for classname in self.load_os() if classname not in classes
+        ) if link_os else ()
+        lines, counters = self.prefix(os_classnames, optimize, shared, fold)
+        words = self.assembler.assemble_stream(itertools.chain(
+            lines, self.translate(classes, Counter(counters), optimize, shared)))
+        if len(words) > ROM_SIZE:
+            raise ValueError('Program too large: {} instructions{}'.format(
+                len(words), '' if shared else ' (try -s)'))
+        return words
+
+
+class BuildHandler(socketserver.StreamRequestHandler):
+    """
+    Request: {"sources": {classname: source}, "optimize": bool, "shared": bool,
+              "link_os": bool, "fold": bool}
+    Response: {"hack": ".hack text"} or {"error": message}
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode())
+            words = self.server.toolchain.build(
+                request['sources'],
+                optimize=request.get('optimize', False),
+                shared=request.get('shared', False),
+                link_os=request.get('link_os', True),
+                fold=request.get('fold', False),
+            )
+            response = {'hack': HackAssembler.format_words(words)}
+        except Exception as e:
+            response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class BuildServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    def __init__(self, path, toolchain):
+        self.toolchain = toolchain
+        # Translate the whole OS up front, so forked requests start warm
+        os_classnames = tuple(toolchain.load_os())
+        for optimize, shared, fold in itertools.product((False, True), repeat=3):
+            toolchain.prefix(os_classnames, optimize, shared, fold)
+        super().__init__(path, BuildHandler)
+
+
+def serve(path, toolchain=None):
+    if os.path.exists(path):
+        os.unlink(path)
+    with BuildServer(path, toolchain or Toolchain()) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def request_build(path, sources, **options):
+    """
+    Sends a build to a server. Returns the instructions, or raises
+    RuntimeError with the server's error message.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        f = sock.makefile('rwb')
+        f.write(json.dumps(dict(options, sources=sources)).encode() + b'\n')
+        f.flush()
+        response = json.loads(f.readline().decode())
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return [int(line, 2) for line in response['hack'].split()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build .jack files to Hack machine code')
+    parser.add_argument('path', nargs='?', help='.jack file or directory of .jack files')
+    parser.add_argument('-o', '--output', help='output file (default: <path>.hack)')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='run the peephole optimizer over the assembly')
+    parser.add_argument('-s', '--shared', action='store_true',
+                        help='use shared call/return/compare routines')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='write a packed binary image instead of .hack text')
+    parser.add_argument('-F', '--fold', action='store_true',
+                        help='fold constants and simplify expressions in the compiler')
+    parser.add_argument('--no-os', action='store_true',
+                        help="don't link in the projects/12 OS classes")
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='serve build requests on a Unix socket')
+    parser.add_argument('--socket', metavar='SOCKET',
+                        help='send the build to a server instead')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+    if not args.path:
+        parser.error('path is required')
+
+    path = Path(args.path).resolve()
+    sources = read_sources(path)
+    options = dict(optimize=args.optimize, shared=args.shared, link_os=not args.no_os,
+                   fold=args.fold)
+    try:
+        if args.socket:
+            words = request_build(args.socket, sources, **options)
+        else:
+            words = Toolchain().build(sources, **options)
+    except RuntimeError as e: # Already formatted by the server
+        print('{}: {}'.format(path, e), file=sys.stderr)
+        sys.exit(1)
+    except Exception as e:
+        print('{}: {}: {}'.format(path, type(e).__name__, e), file=sys.stderr)
+        sys.exit(1)
+
+    output = args.output or str(path.with_suffix('.hack') if path.is_file()
+                                else path / (path.name + '.hack'))
+    if args.binary:
+        with open(output, 'wb') as f:
+            f.write(HackAssembler.pack(words))
+    else:
+        with open(output, 'w') as f:
+            f.write(HackAssembler.format_words(words) + '\n')
+    print('Writing to {} ({} instructions)'.format(output, len(words)))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,11 +14,23 @@ Building a more robust compiler could save a lot of time!
 
 import sys
 import os
-from tokenizer import Tokenizer
+import json
+import hashlib
+import argparse
+from tokenizer import StreamTokenizer
+from nodes import (
+    Class, Variable, Subroutine, Let, Do, If, While, Return,
+    Constant, String, Name, Index, Call, Operation,
+)
 from xml.dom.minidom import Document
 from pathlib import Path
 import logging
 from collections import namedtuple, Counter
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / '08'))
+from vmtranslator import Emitter
+sys.path.pop(0)
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
@@ -48,81 +60,201 @@ class SymbolTable:
         return self.table[name] if name in self.table else None
 
 
+WORD = 0xFFFF
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def divide(x, y):
+    x, y = signed(x), signed(y)
+    q = abs(x) // abs(y)
+    return -q if (x < 0) != (y < 0) else q
+
+
+FOLD = {
+    '+': lambda x, y: x + y,
+    '-': lambda x, y: x - y,
+    '*': lambda x, y: x * y,
+    '/': divide,
+    '&': lambda x, y: x & y,
+    '|': lambda x, y: x | y,
+    '<': lambda x, y: -(signed(x) < signed(y)),
+    '>': lambda x, y: -(signed(x) > signed(y)),
+    '=': lambda x, y: -(x == y),
+    'neg': lambda x: -x,
+    'not': lambda x: ~x,
+}
+
+
+def constant(node):
+    return node.value if isinstance(node, Constant) else None
+
+
+def is_pure(node):
+    """
+    True if the node can be left out without changing what the program does.
+    Division may fail, so it never is.
+    """
+    if isinstance(node, Operation):
+        return node.op != '/' and all(is_pure(n) for n in node.operands)
+    if isinstance(node, Index):
+        return is_pure(node.index)
+    return isinstance(node, (Constant, Name))
+
+
+def simplify(node):
+    """
+    Folds constants, removes identities like x + 0 and x * 1, and turns
+    multiplication by a power of two into additions (the '<<' operation).
+    Operands with side effects are never dropped.
+    """
+    if not isinstance(node, Operation):
+        return node
+    operands = [simplify(n) for n in node.operands]
+    values = [constant(n) for n in operands]
+    if None not in values and not (node.op == '/' and values[1] == 0):
+        return Constant(FOLD[node.op](*values) & WORD)
+    if len(operands) == 1:
+        return simplify_unary(node.op, operands[0])
+    return SIMPLIFY.get(node.op, Operation)(node.op, tuple(operands))
+
+
+def simplify_unary(op, a):
+    # --x and ~~x
+    if isinstance(a, Operation) and a.op == op:
+        return a.operands[0]
+    return Operation(op, (a,))
+
+
+def negate(a):
+    return simplify_unary('neg', a) if constant(a) is None else Constant(-a.value & WORD)
+
+
+def simplify_add(op, operands):
+    a, b = operands
+    if constant(a) is not None:
+        a, b = b, a
+    c = constant(b)
+    if c is None:
+        return Operation(op, operands)
+    if c == 0:
+        return a
+    # (x + c1) + c2 = x + (c1 + c2)
+    if isinstance(a, Operation) and a.op in ('+', '-') and constant(a.operands[1]) is not None:
+        c1 = a.operands[1].value
+        return simplify_add('+', (a.operands[0], Constant(c + (c1 if a.op == '+' else -c1) & WORD)))
+    if c & 0x8000 and c != 0x8000:
+        # x + -c = x - c, saving the negation of the constant
+        return Operation('-', (a, Constant(-c & WORD)))
+    return Operation('+', (a, b))
+
+
+def simplify_subtract(op, operands):
+    a, b = operands
+    if constant(b) is not None:
+        return simplify_add('+', (a, Constant(-b.value & WORD)))
+    if constant(a) == 0:
+        return negate(b)
+    return Operation(op, operands)
+
+
+def simplify_multiply(op, operands):
+    a, b = operands
+    if constant(a) is not None:
+        a, b = b, a
+    c = constant(b)
+    if c is None or c == 0 and not is_pure(a):
+        return Operation(op, operands)
+    if c == 0:
+        return b
+    if c == 1:
+        return a
+    if c & (c - 1) == 0:
+        shift = c.bit_length() - 1
+        if isinstance(a, Operation) and a.op == '<<':
+            a, shift = a.operands[0], shift + a.operands[1].value
+        if shift >= 16 and is_pure(a):
+            return Constant(0)
+        return Operation('<<', (a, Constant(shift)))
+    n = -c & WORD
+    if n & (n - 1) == 0:
+        # x * -2^k = -(x * 2^k)
+        return negate(simplify_multiply(op, (a, Constant(n))))
+    return Operation(op, operands)
+
+
+def simplify_divide(op, operands):
+    a, b = operands
+    c = constant(b)
+    if c == 1:
+        return a
+    if c == WORD:
+        return negate(a)
+    return Operation(op, operands)
+
+
+def simplify_and(op, operands):
+    a, b = operands
+    if constant(a) is not None:
+        a, b = b, a
+    c = constant(b)
+    if c == WORD:
+        return a
+    if c == 0 and is_pure(a):
+        return b
+    return Operation(op, operands)
+
+
+def simplify_or(op, operands):
+    a, b = operands
+    if constant(a) is not None:
+        a, b = b, a
+    c = constant(b)
+    if c == 0:
+        return a
+    if c == WORD and is_pure(a):
+        return b
+    return Operation(op, operands)
+
+
+SIMPLIFY = {
+    '+': simplify_add,
+    '-': simplify_subtract,
+    '*': simplify_multiply,
+    '/': simplify_divide,
+    '&': simplify_and,
+    '|': simplify_or,
+}
+
+
+class Parser:
+    """
+    Builds the AST of one class from its tokens
+    """
+    OPERATORS = frozenset('+-*/&|<>=')
+
+    UNARY_OPERATORS = {
+        '-': 'neg',
+        '~': 'not',
+    }
 
-class CompilationEngine:
-
-    OPERATORS = {
-        '+': 'add',
-        '-': 'sub',
-        '*': 'call Math.multiply 2',
-        '/': 'call Math.divide 2',
-        '&': 'and',
-        '|': 'or',
-        '<': 'lt',
-        '>': 'gt',
-        '=': 'eq',
+    KEYWORD_CONSTANTS = {
+        'true': WORD,
+        'false': 0,
+        'null': 0,
     }
 
-    def __init__(self, tokenizer, out):
+    def __init__(self, tokenizer):
         self.tokenizer = tokenizer
-        self.out = out
-        self.current = None
-        self.next = None
         self.current = self.tokenizer.get_token()
         self.next = self.tokenizer.get_token()
-        self.if_index = 0
-        self.while_index = 0
-        self.return_type = False
 
     def advance(self):
         self.current = self.next
         self.next = self.tokenizer.get_token()
 
-    def lookup(self, name):
-        return self.symbols.lookup(name) or self.class_symbols.lookup(name)
-
-    def code_write(self, exp):
-        """
-        Translates variable name/string literal into vm instructions 
-        """
-
-        if str(exp).isdigit():
-            self.write('push constant {}'.format(exp))
-        elif exp == 'this':
-            self.write('push pointer 0')
-        elif exp == 'that':
-            self.write('push pointer 1')
-        elif self.lookup(exp):
-            symbol = self.lookup(exp)
-            self.write('push {} {}'.format(symbol.kind, symbol.index))
-
-        # Operators
-        elif exp in self.OPERATORS:
-            self.write(self.OPERATORS[exp])
-
-        # Constants
-        elif exp in ('null', 'false'):
-            self.write('push constant 0')
-        elif exp == 'true':
-            self.write('push constant 0')
-            self.write('not')
-
-        # String?
-        elif exp.startswith('"') and exp.endswith('"'):
-            string = exp[1:-1]
-            length = len(string)
-            self.write('push constant {}'.format(length))
-            self.write("call String.new 1")
-            for char in string:
-                self.write('push constant {}'.format(ord(char)))
-                self.write('call String.appendChar 2')
-        else:
-            raise SyntaxError(exp)
-        
-
-    def write(self, s):
-        print(s, file=self.out)
-            
     def eat(self, value=None):
         if value is not None and self.current.value != value:
             raise SyntaxError("expected: {} actual: {} (next: {})".format(
@@ -130,123 +262,315 @@ class CompilationEngine:
                 self.current.value, 
                 self.next.value)
             )
-        else:
-            tmp = self.current
-            self.advance()
-            return tmp.value
-    
-    def compile_class(self):
-        # Init symbol table
-        self.class_symbols = SymbolTable()
+        # Inlined advance(), eat() is called for every token
+        tmp = self.current
+        self.current = self.next
+        self.next = self.tokenizer.get_token()
+        return tmp.value
 
+    def parse_class(self):
         self.eat('class')
-        self.class_name = self.eat()
+        name = self.eat()
         self.eat('{')
+        variables = []
         while self.current.value in ('static', 'field'):
-            self.compile_class_var_dec()
+            self.parse_class_var_dec(variables)
+        subroutines = []
         while self.current.value != '}':
-            self.compile_subroutine_dec()
+            subroutines.append(self.parse_subroutine_dec())
         self.eat('}')
+        return Class(name, variables, subroutines)
 
-    def compile_class_var_dec(self):
+    def parse_class_var_dec(self, variables):
         kind = self.eat() # static | field
+        kind = 'this' if kind == 'field' else kind
         type_ = self.eat() # int | char | boolean | className
         while True:
-            self.class_symbols.define(
-                type_ = type_,
-                kind = 'this' if kind == 'field' else kind,
-                name = self.eat(), # varName
-            )
+            variables.append(Variable(self.eat(), type_, kind)) # varName
             if self.current.value != ',':
                 break
             self.eat(',')
         self.eat(';')
 
-    def compile_subroutine_dec(self):
-        self.symbols = SymbolTable()
-
-        sub_type = self.eat() # constructor|function|method
-        self.return_type = self.eat() # void | (type)
-        sub_name = self.eat() # subroutineName
-
-        if sub_type == 'method':
-            self.symbols.define('this', self.class_name, 'argument')
-
-        nargs = self.compile_parameter_list()
+    def parse_subroutine_dec(self):
+        kind = self.eat() # constructor|function|method
+        if kind not in ('constructor', 'function', 'method'):
+            raise SyntaxError(kind)
+        return_type = self.eat() # void | (type)
+        name = self.eat() # subroutineName
+        parameters = self.parse_parameter_list()
 
         self.eat('{')
+        variables = []
         while self.current.value == 'var':
-            self.compile_var_dec()
-
-        self.write('function {}.{} {}'.format(
-            self.class_name, 
-            sub_name, 
-            self.symbols.count('local')) 
-        )
-
-        if sub_type == 'method':
-            self.write('push argument 0')  
-            self.write('pop pointer 0')  # THIS = argument 0
-            self.compile_statements()
-
-        elif sub_type == 'constructor':
-            nvars = self.class_symbols.count('this')
-            self.write('push constant {}'.format(nvars))
-            self.write('call Memory.alloc 1')
-            self.write('pop pointer 0') # Anchor THIS at base address
-            self.compile_statements()
-
-        elif sub_type == 'function':
-            self.compile_statements()
-
-        else:
-            raise SyntaxError(sub_type)
+            self.parse_var_dec(variables)
+        statements = self.parse_statements()
         self.eat('}')
+        return Subroutine(kind, return_type, name, parameters, variables, statements)
 
-    def compile_parameter_list(self):
-        nargs = 0
+    def parse_parameter_list(self):
+        parameters = []
         self.eat('(')
         while self.current.value != ')':
-            nargs += 1
-            self.symbols.define(
-                kind = 'argument',
-                type_ = self.eat(),
-                name = self.eat(),
-            )
+            type_ = self.eat()
+            parameters.append(Variable(self.eat(), type_, 'argument'))
             if self.current.value == ',':
                 self.eat(',')
         self.eat(')')
-        return nargs
+        return parameters
 
-    def compile_var_dec(self):
+    def parse_var_dec(self, variables):
         self.eat('var')
         type_ = self.eat() # type
         while True:
-            self.symbols.define(
-                kind = 'local', 
-                name = self.eat(), # varName
-                type_ = type_,
-            )
+            variables.append(Variable(self.eat(), type_, 'local')) # varName
             if self.current.value != ',':
                 break
             self.eat(',')
         self.eat(';')
 
-    def compile_let(self):
+    def parse_statements(self):
+        statements = []
+        while True:
+            keyword = self.current.value
+            if keyword == 'let':
+                statements.append(self.parse_let())
+            elif keyword == 'do':
+                statements.append(self.parse_do())
+            elif keyword == 'if':
+                statements.append(self.parse_if())
+            elif keyword == 'while':
+                statements.append(self.parse_while())
+            elif keyword == 'return':
+                statements.append(self.parse_return())
+            else:
+                return statements
+
+    def parse_let(self):
         self.eat('let')
-        var_name = self.eat()
-        symbol = self.lookup(var_name)
+        name = self.eat()
+        index = None
+        if self.current.value == '[': # varName[expression]
+            self.eat('[')
+            index = self.parse_expression()
+            self.eat(']')
+        self.eat('=')
+        value = self.parse_expression()
+        self.eat(';')
+        return Let(name, index, value)
+
+    def parse_do(self):
+        self.eat('do')
+        call = self.parse_subroutine_call()
+        self.eat(';')
+        return Do(call)
+
+    def parse_if(self):
+        self.eat('if')
+        self.eat('(')
+        condition = self.parse_expression()
+        self.eat(')')
+        self.eat('{')
+        statements = self.parse_statements()
+        self.eat('}')
+        else_statements = None
+        if self.current.value == 'else':
+            self.eat('else')
+            self.eat('{')
+            else_statements = self.parse_statements()
+            self.eat('}')
+        return If(condition, statements, else_statements)
+
+    def parse_while(self):
+        self.eat('while')
+        self.eat('(')
+        condition = self.parse_expression()
+        self.eat(')')
+        self.eat('{')
+        statements = self.parse_statements()
+        self.eat('}')
+        return While(condition, statements)
+
+    def parse_return(self):
+        self.eat('return')
+        value = None
+        if self.current.value != ';':
+            value = self.parse_expression()
+        self.eat(';')
+        return Return(value)
 
-        if self.current.value == '[': # handle varName[expression] (expr1)
-            self.write('push {} {}'.format(symbol.kind, symbol.index))
+    def parse_expression_list(self):
+        expressions = []
+        while self.current.value != ')':
+            expressions.append(self.parse_expression())
+            if self.current.value == ',':
+                self.eat(',')
+        return expressions
+
+    def parse_expression(self):
+        node = self.parse_term()
+
+        while self.current.value in self.OPERATORS:
+            op = self.eat()
+            node = Operation(op, (node, self.parse_term()))
+        return node
+
+    def parse_term(self):
+        # varName[expression]
+        if self.next.value == '[':
+            name = self.eat() # varName
             self.eat('[')
-            self.compile_expression()
+            index = self.parse_expression()
             self.eat(']')
-            self.eat('=')
+            return Index(name, index)
+
+        # expression 
+        elif self.current.value == '(':
+            self.eat('(')
+            node = self.parse_expression()
+            self.eat(')')
+            return node
+
+        # unaryOp term
+        elif self.current.value in self.UNARY_OPERATORS:
+            op = self.UNARY_OPERATORS[self.eat()]
+            return Operation(op, (self.parse_term(),))
+
+        # Handle the following grammars:
+        # - subroutineCall ( subroutineName '(' expressionList ')' 
+        # - subroutineCall ( className | varNAme ) '.' subroutineName
+        elif self.next.value in ('(', '.'):
+            return self.parse_subroutine_call()
+
+        # Constants and varName
+        value = self.eat()
+        if value.isdigit():
+            return Constant(int(value))
+        elif value in self.KEYWORD_CONSTANTS:
+            return Constant(self.KEYWORD_CONSTANTS[value])
+        elif value.startswith('"') and value.endswith('"'):
+            return String(value[1:-1])
+        return Name(value)
+
+    def parse_subroutine_call(self):
+        # subroutineName '(' expressionList ')'
+        if self.next.value == '(':
+            target = None
+            name = self.eat() # subroutineName
+
+        # ( className | varName ) '.' subroutineName
+        else:
+            target = self.eat() # className/varName
+            self.eat('.')
+            name = self.eat() # subroutineName
+
+        self.eat('(')
+        arguments = self.parse_expression_list()
+        self.eat(')')
+        return Call(target, name, arguments)
+
+
+class CodeGenerator:
+    """
+    Writes the VM code of a class AST to `out`
+    """
+    OPERATORS = {
+        '+': 'add',
+        '-': 'sub',
+        '*': 'call Math.multiply 2',
+        '/': 'call Math.divide 2',
+        '&': 'and',
+        '|': 'or',
+        '<': 'lt',
+        '>': 'gt',
+        '=': 'eq',
+    }
+
+    def __init__(self, out, fold=False):
+        self.out = out if isinstance(out, Emitter) else Emitter(out)
+        self.fold = fold
+        self.statements = {
+            Let: self.compile_let,
+            Do: self.compile_do,
+            If: self.compile_if,
+            While: self.compile_while,
+            Return: self.compile_return,
+        }
+        self.terms = {
+            Constant: self.compile_constant,
+            String: self.compile_string,
+            Name: self.compile_name,
+            Index: self.compile_index,
+            Call: self.compile_subroutine_call,
+            Operation: self.compile_operation,
+        }
+
+    def generate(self, tree):
+        self.compile_class(tree)
+        self.out.flush()
+
+    def write(self, s):
+        self.out.write(s)
+
+    def lookup(self, name):
+        return self.symbols.lookup(name) or self.class_symbols.lookup(name)
+
+    def write_push(self, name):
+        symbol = self.lookup(name)
+        if symbol is None:
+            raise SyntaxError(name)
+        self.write('push {} {}'.format(symbol.kind, symbol.index))
+        return symbol
+
+    def compile_class(self, node):
+        self.class_name = node.name
+        self.class_symbols = SymbolTable()
+        self.if_index = 0
+        self.while_index = 0
+        for variable in node.variables:
+            self.class_symbols.define(variable.name, variable.type, variable.kind)
+        for subroutine in node.subroutines:
+            self.compile_subroutine(subroutine)
+
+    def compile_subroutine(self, node):
+        self.symbols = SymbolTable()
+        self.return_type = node.return_type
+
+        if node.kind == 'method':
+            self.symbols.define('this', self.class_name, 'argument')
+        for variable in node.parameters + node.variables:
+            self.symbols.define(variable.name, variable.type, variable.kind)
+
+        self.write('function {}.{} {}'.format(
+            self.class_name, 
+            node.name, 
+            self.symbols.count('local')) 
+        )
+
+        if node.kind == 'method':
+            self.write('push argument 0')  
+            self.write('pop pointer 0')  # THIS = argument 0
+
+        elif node.kind == 'constructor':
+            nvars = self.class_symbols.count('this')
+            self.write('push constant {}'.format(nvars))
+            self.write('call Memory.alloc 1')
+            self.write('pop pointer 0') # Anchor THIS at base address
+
+        self.compile_statements(node.statements)
+
+    def compile_statements(self, statements):
+        for statement in statements:
+            self.statements[type(statement)](statement)
+
+    def compile_let(self, node):
+        if node.index is not None: # handle varName[expression] (expr1)
+            self.write_push(node.name)
+            self.compile_expression(node.index)
 
             # keep expr1 on the stack for now to avoid being clobbered by expr2
             self.write('add') 
-            self.compile_expression() # compute expr2
+            self.compile_expression(node.value) # compute expr2
 
             # store value of expr2 in temp 0
             self.write('pop temp 0') 
@@ -257,185 +581,313 @@ class CompilationEngine:
 
             # set value of pointer1 (expr1) to expr2
             self.write('pop that 0') 
-            self.eat(';')
         else:
-            self.eat('=')
-            self.compile_expression() 
+            symbol = self.lookup(node.name)
+            if symbol is None:
+                raise SyntaxError(node.name)
+            self.compile_expression(node.value) 
             self.write('pop {} {}'.format(symbol.kind, symbol.index))
-            self.eat(';')
 
-    def compile_do(self):
-        self.eat('do')
-        self.compile_subroutine_call()
-        self.eat(';')
+    def compile_do(self, node):
+        self.compile_subroutine_call(node.call)
 
         # Discard the result (void method)
         self.write('pop temp 0')
 
-
-    def compile_statements(self):
-        while self.current.value in ('if', 'while', 'let', 'do', 'return'):
-            if self.current.value == 'if':
-                self.if_index += 1
-                self.compile_if()
-            elif self.current.value == 'while':
-                self.while_index += 1
-                self.compile_while()
-            elif self.current.value == 'let':
-                self.compile_let()
-            elif self.current.value == 'do':
-                self.compile_do()
-            elif self.current.value == 'return':
-                self.compile_return()
-                
-    def compile_if(self):
+    def compile_if(self, node):
+        self.if_index += 1
         index = self.if_index
-        self.eat('if')
-        self.eat('(')
-        self.compile_expression()
+        self.compile_expression(node.condition)
         self.write('not')
-        self.eat(')')
 
-        self.eat('{')
         self.write('if-goto {}.IFFALSE{}'.format(self.class_name, index))
-        self.compile_statements()
+        self.compile_statements(node.statements)
         self.write('goto {}.ENDIF{}'.format(self.class_name, index))
-        self.eat('}')
         self.write('label {}.IFFALSE{}'.format(self.class_name, index))
 
-        if self.current.value == 'else':
-            self.eat('else')
-            self.eat('{')
-            self.compile_statements()
-            self.eat('}')
+        if node.else_statements is not None:
+            self.compile_statements(node.else_statements)
         self.write('label {}.ENDIF{}'.format(self.class_name, index))
 
-    def compile_while(self):
+    def compile_while(self, node):
+        self.while_index += 1
         index = self.while_index
-        self.eat('while')
-        self.eat('(')
         self.write('label {}.WHILE{}'.format(self.class_name, index))
-        self.compile_expression()
+        self.compile_expression(node.condition)
         self.write('not')
         self.write('if-goto {}.ENDWHILE{}'.format(self.class_name, index))
-        self.eat(')')
-        self.eat('{')
-        self.compile_statements()
+        self.compile_statements(node.statements)
         self.write('goto {}.WHILE{}'.format(self.class_name, index))
         self.write('label {}.ENDWHILE{}'.format(self.class_name, index))
-        self.eat('}')
         
-    def compile_return(self):
-        self.eat('return')
-
+    def compile_return(self, node):
         # void method must push 0, caller will discard
         if self.return_type == 'void':
             self.write('push constant 0')
 
-        if self.current.value != ';':
-            self.compile_expression()
+        if node.value is not None:
+            self.compile_expression(node.value)
 
         self.write('return')
-        self.eat(';')
-        
-    def compile_expression_list(self):
-        nargs = 0
-        while self.current.value != ')':
-            nargs += 1
-            self.compile_expression()
-            if self.current.value == ',':
-                self.eat(',')
-        return nargs 
-
-    def compile_expression(self):
-        self.compile_term()
 
-        while self.current.value in self.OPERATORS:
-            op = self.eat()
-            self.compile_term()
-            self.code_write(op)
-
-    def compile_term(self):
-        # varName[expression]
-        if self.next.value == '[':
-            symbol = self.lookup(self.eat()) # varName
-            self.write('push {} {}'.format(symbol.kind, symbol.index))
-            self.eat('[')
-            self.compile_expression()
-            self.eat(']')
-            self.write('add')
-            self.write('pop pointer 1')
-            self.write('push that 0')
+    def compile_expression(self, node):
+        if self.fold:
+            node = simplify(node)
+        self.terms[type(node)](node)
 
-        # expression 
-        elif self.current.value == '(':
-            self.eat('(')
-            self.compile_expression()
-            self.eat(')')
+    def compile_term(self, node):
+        self.terms[type(node)](node)
 
-        # unaryOp term
-        elif self.current.value in ('-', '~'):
-            op = self.eat()
-            negate = None
-            if op == '-':
-                negate = 'neg'
-            elif op == '~':
-                negate = 'not'
-         
-            self.compile_term()
-            self.write(negate)
+    def compile_constant(self, node):
+        # push constant only takes 0..32767
+        if node.value in (WORD, 0x8000):
+            self.write('push constant {}'.format(~node.value & WORD))
+            self.write('not')
+        elif node.value & 0x8000:
+            self.write('push constant {}'.format(-node.value & WORD))
+            self.write('neg')
+        else:
+            self.write('push constant {}'.format(node.value))
 
-        # Handle the following grammars:
-        # - subroutineCall ( subroutineName '(' expressionList ')' 
-        # - subroutineCall ( className | varNAme ) '.' subroutineName
-        elif self.next.value in ('(', '.'):
-            self.compile_subroutine_call()
+    def compile_string(self, node):
+        self.write('push constant {}'.format(len(node.value)))
+        self.write("call String.new 1")
+        for char in node.value:
+            self.write('push constant {}'.format(ord(char)))
+            self.write('call String.appendChar 2')
 
-        # varName
+    def compile_name(self, node):
+        if node.name == 'this':
+            self.write('push pointer 0')
+        elif node.name == 'that':
+            self.write('push pointer 1')
+        else:
+            self.write_push(node.name)
+
+    def compile_index(self, node):
+        self.write_push(node.name)
+        self.compile_expression(node.index)
+        self.write('add')
+        self.write('pop pointer 1')
+        self.write('push that 0')
+
+    def compile_operation(self, node):
+        if node.op == '<<':
+            # x * 2^n as n doublings
+            operand, shift = node.operands
+            self.compile_term(operand)
+            for i in range(shift.value):
+                if i == 0 and isinstance(operand, Name):
+                    self.compile_term(operand)
+                else:
+                    self.write('pop temp 0')
+                    self.write('push temp 0')
+                    self.write('push temp 0')
+                self.write('add')
         else:
-            var_name = self.eat() # varName
-            self.code_write(var_name)
+            for operand in node.operands:
+                self.compile_term(operand)
+            self.write(self.OPERATORS.get(node.op, node.op))
 
-    def compile_subroutine_call(self):
+    def compile_subroutine_call(self, node):
         # subroutineName '(' expressionList ')'
-        if self.next.value == '(': 
+        if node.target is None:
             obj = self.class_name
-            sub_name = self.eat() # subroutineName
-            self.eat('(')
             self.write('push pointer 0') # Push this object
-            nargs = self.compile_expression_list() + 1
-            self.eat(')')
+            nargs = 1
 
-        # ( className | varName ) '.' subroutineName
-        elif self.next.value == '.': 
-            var_name = self.eat() # className/varName
-            self.eat('.')
-            sub_name = self.eat() # subroutineName
-            self.eat('(')
+        # Check if obj.foo() call
+        elif self.lookup(node.target):
+            obj = self.write_push(node.target).type
+            nargs = 1 # Include "this" in nargs
 
-            # Check if obj.foo() call
-            if self.lookup(var_name):
-                symbol = self.lookup(var_name)
-                self.write('push {} {}'.format(symbol.kind, symbol.index))
-                obj = symbol.type
-                nargs = 1 # Include "this" in nargs
+        # Class.foo() call
+        else:
+            obj = node.target
+            nargs = 0 # Doesn't pass "this"
 
-            # Class.foo() call
-            else:
-                nargs = 0 # Doesn't pass "this"
-                obj = var_name 
+        for argument in node.arguments:
+            self.compile_expression(argument)
+        nargs += len(node.arguments)
 
-            nargs += self.compile_expression_list()
-            self.eat(')')
+        self.write('call {}.{} {}'.format(obj, node.name, nargs))
 
-        self.write('call {}.{} {}'.format(obj, sub_name, nargs))
+
+class CompilationEngine(CodeGenerator):
+    """
+    Parses a class from `tokenizer` and writes its VM code to `out`
+    """
+    def __init__(self, tokenizer, out, fold=False):
+        super().__init__(out, fold)
+        self.tokenizer = tokenizer
 
     def compile(self):
-        self.compile_class()
+        self.generate(Parser(self.tokenizer).parse_class())
+
+
+class BuildCache:
+    """
+    Manifest of source hashes for the .jack files compiled into outdir, so
+    unchanged files keep their existing .vm output on the next build
+    """
+    MANIFEST = '.jackcache.json'
+
+    def __init__(self, outdir, fold=False):
+        self.path = Path(outdir, self.MANIFEST)
+        self.version = self.compiler_version(fold)
+        self.files = {}
+        try:
+            with open(str(self.path)) as f:
+                manifest = json.load(f)
+            # A different compiler may generate different code
+            if manifest.get('compiler') == self.version:
+                self.files = manifest['files']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def hash_file(fn, digest=None):
+        digest = digest or hashlib.sha1()
+        with open(str(fn), 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+        return digest
+
+    @classmethod
+    def compiler_version(cls, fold=False):
+        here = Path(__file__).resolve().parent
+        digest = hashlib.sha1()
+        for name in ('compiler.py', 'tokenizer.py', 'nodes.py', '../08/vmtranslator.py'):
+            cls.hash_file(here / name, digest)
+        if fold:
+            digest.update(b'fold')
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(fn):
+        return str(Path(fn).resolve())
+
+    def source_hash(self, fn):
+        return self.hash_file(fn).hexdigest()
+
+    def is_fresh(self, fn, outfn, source_hash):
+        entry = self.files.get(self.key(fn))
+        return (
+            entry is not None and
+            entry['hash'] == source_hash and
+            entry['output'] == self.key(outfn) and
+            Path(outfn).exists()
+        )
+
+    def update(self, fn, outfn, source_hash):
+        self.files[self.key(fn)] = {
+            'hash': source_hash,
+            'output': self.key(outfn),
+        }
+
+    def discard(self, fn, outfn):
+        """
+        Forget a source file that failed to compile, and remove its old .vm
+        file, which would no longer be tracked for eviction
+        """
+        self.files.pop(self.key(fn), None)
+        if Path(outfn).exists():
+            Path(outfn).unlink()
+
+    def evict_deleted(self):
+        """
+        Forget deleted source files and remove the .vm files built from them
+        """
+        for fn in list(self.files):
+            if not Path(fn).exists():
+                output = Path(self.files.pop(fn)['output'])
+                if output.exists():
+                    output.unlink()
+
+    def save(self):
+        tmp = self.path.with_suffix('.tmp')
+        with open(str(tmp), 'w') as f:
+            json.dump({'compiler': self.version, 'files': self.files}, f,
+                      indent=1, sort_keys=True)
+        os.replace(str(tmp), str(self.path))
+
+
+def compile_file(fn, outfn, fold=False):
+    """
+    Compiles one .jack file to outfn. Returns an error message or None, so
+    that a worker process never has to pickle an exception. The output is
+    written to a temporary file first, so a failed compile never leaves a
+    partial .vm file behind.
+    """
+    tmp = outfn + '.tmp'
+    try:
+        with open(str(fn), 'r') as f:
+            with open(tmp, 'w') as vmfile:
+                comp = CompilationEngine(StreamTokenizer(f), out=vmfile, fold=fold)
+                comp.compile()
+        os.replace(tmp, outfn)
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return '{}: {}'.format(type(e).__name__, e)
+
+
+def compile_all(jackfiles, outdir, jobs=1, cache=True, fold=False):
+    """
+    Compiles each .jack file into outdir, using a pool of `jobs` processes.
+    Files whose source hash matches the build cache are skipped unless
+    cache is False. Returns a {filename: error} dict for the files that failed.
+    """
+    tasks = [
+        (str(fn), str(Path(outdir, fn.with_suffix('.vm').name)))
+        for fn in sorted(jackfiles)
+    ]
+
+    if cache:
+        cache = BuildCache(outdir, fold)
+        cache.evict_deleted()
+        hashes = {fn: cache.source_hash(fn) for fn, outfn in tasks}
+        stale = []
+        for fn, outfn in tasks:
+            if cache.is_fresh(fn, outfn, hashes[fn]):
+                print('Unchanged {}'.format(outfn))
+            else:
+                stale.append((fn, outfn))
+        tasks = stale
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(compile_file, *zip(*tasks), [fold] * len(tasks)))
+    else:
+        results = [compile_file(fn, outfn, fold) for fn, outfn in tasks]
+
+    errors = {}
+    for (fn, outfn), error in zip(tasks, results):
+        if error:
+            errors[fn] = error
+            if cache:
+                cache.discard(fn, outfn)
+            continue
+        print('Writing to {}'.format(outfn))
+        if cache:
+            cache.update(fn, outfn, hashes[fn])
+
+    if cache:
+        cache.save()
+    return errors
 
 
 def main():
-    path = Path(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Compile .jack files to .vm')
+    parser.add_argument('path', help='.jack file or directory of .jack files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files to compile in parallel')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='recompile every file, ignoring the build cache')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='fold constants and simplify expressions')
+    args = parser.parse_args()
+    path = Path(args.path)
 
     # If argument is a directory, get all *.jack files
     jackfiles = path.glob('**/*.jack') if path.is_dir() else [path]
@@ -445,15 +897,13 @@ def main():
     else:
         outdir = path.resolve().parent
 
-    for fn in jackfiles:
-        with open(str(fn), 'r') as f:
-            outfn = str(Path(outdir, fn.with_suffix('.vm').name))
-            print('Writing to {}'.format(outfn))
-            with open(outfn, 'w') as vmfile:
-                comp = CompilationEngine(Tokenizer(f.read()), out=vmfile)
-                comp.compile()
+    errors = compile_all(jackfiles, outdir, jobs=args.jobs, cache=not args.no_cache,
+                         fold=args.optimize)
+    for fn, error in errors.items():
+        log.error('{}: {}'.format(fn, error))
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
     main()
-
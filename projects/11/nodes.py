@@ -0,0 +1,142 @@
+"""
+Abstract syntax tree of a Jack class
+
+The parser in compiler.py builds these and the code generator walks them.
+Nodes keep only what code generation needs and are never changed once
+built, so a tree can be generated more than once, with different options.
+"""
+
+
+class Node:
+    __slots__ = ()
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            repr(getattr(self, name)) for name in self.__slots__))
+
+
+class Class(Node):
+    __slots__ = ('name', 'variables', 'subroutines')
+
+    def __init__(self, name, variables, subroutines):
+        self.name = name
+        self.variables = variables # static and field Variables
+        self.subroutines = subroutines
+
+
+class Variable(Node):
+    __slots__ = ('name', 'type', 'kind')
+
+    def __init__(self, name, type_, kind):
+        self.name = name
+        self.type = type_
+        self.kind = kind # Symbol table kind: static, this, argument or local
+
+
+class Subroutine(Node):
+    __slots__ = ('kind', 'return_type', 'name', 'parameters', 'variables', 'statements')
+
+    def __init__(self, kind, return_type, name, parameters, variables, statements):
+        self.kind = kind # constructor, function or method
+        self.return_type = return_type
+        self.name = name
+        self.parameters = parameters
+        self.variables = variables
+        self.statements = statements
+
+
+# Statements
+
+class Let(Node):
+    __slots__ = ('name', 'index', 'value')
+
+    def __init__(self, name, index, value):
+        self.name = name
+        self.index = index # None unless name[index]
+        self.value = value
+
+
+class If(Node):
+    __slots__ = ('condition', 'statements', 'else_statements')
+
+    def __init__(self, condition, statements, else_statements):
+        self.condition = condition
+        self.statements = statements
+        self.else_statements = else_statements
+
+
+class While(Node):
+    __slots__ = ('condition', 'statements')
+
+    def __init__(self, condition, statements):
+        self.condition = condition
+        self.statements = statements
+
+
+class Do(Node):
+    __slots__ = ('call',)
+
+    def __init__(self, call):
+        self.call = call
+
+
+class Return(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value # None for a bare return
+
+
+# Expressions. Values are 16-bit words, as on the Hack computer.
+
+class Constant(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class String(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Name(Node):
+    """
+    A variable, or this
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Index(Node):
+    __slots__ = ('name', 'index')
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+
+
+class Call(Node):
+    __slots__ = ('target', 'name', 'arguments')
+
+    def __init__(self, target, name, arguments):
+        self.target = target # Class or variable name, None for this
+        self.name = name
+        self.arguments = arguments
+
+
+class Operation(Node):
+    """
+    A Jack operator, 'neg' or 'not', or '<<' for doubling operands[0]
+    operands[1].value times
+    """
+    __slots__ = ('op', 'operands')
+
+    def __init__(self, op, operands):
+        self.op = op
+        self.operands = operands
@@ -4,9 +4,9 @@ Jack language tokenizer
 from xml.dom.minidom import Document
 
 import sys
-import string
+import re
 
-KEYWORDS = [
+KEYWORDS = frozenset([
     'class', 
     'constructor', 
     'function',
@@ -27,14 +27,31 @@ KEYWORDS = [
     'else', 
     'while', 
     'return'
-]
+])
 
 SYMBOLS = '{}()\[\].,;+-*/&|<>=~'
 MAXINTEGER = 32767
-IDENTIFIERS = string.ascii_letters + string.digits + '_'
+
+# Skips leading whitespace, then matches exactly one token
+RE_TOKEN = re.compile(r'''\s*(?:
+    (?P<symbol>[{}]) |
+    (?P<string>"[^"]*") |
+    (?P<word>[A-Za-z0-9_]+)
+)'''.format(re.escape(SYMBOLS)), re.VERBOSE)
+
+# Comments, plus string literals so that comment markers inside them are skipped
+RE_COMMENT = re.compile(r'''
+    (?P<string>"[^"\n]*") |
+    //[^\n]* |
+    /\*.*?(?:\*/|\Z)
+''', re.VERBOSE | re.DOTALL)
+RE_NOT_NEWLINE = re.compile(r'[^\n]')
+RE_WHITESPACE = re.compile(r'\s*')
 
 
 class Token:
+    __slots__ = ('name', 'value')
+
     def __init__(self, name, value=''):
         self.name = name or ''
         self.value = value or ''
@@ -48,98 +65,86 @@ class Tokenizer:
         self.pos = 0
         self.data = self.strip_comments(data)
         self.endpos = len(self.data) - 1
-        self.line = 1
         self.current = None
         self.next = None
 
     def strip_comments(self, data):
         """
-        Remove comments prior to parsing
+        Blank out comments prior to parsing. Newlines are kept and every
+        other comment character becomes a space, so offsets into the
+        stripped data still match the original source.
         """
-        out = ''
-        end = len(data) - 1
-        pos = 0
-        
-        while pos <= end:
-            # Line comment
-            if data[pos:].startswith('//'):
-                while pos <= end and data[pos] != '\n':
-                    pos += 1
-                pos += 1
-
-            # Block comment
-            elif data[pos:].startswith('/*'):
-                while pos <= end and data[pos:pos + 2] != '*/':
-                    pos += 1
-                pos += 2
-            else:
-                char = data[pos]
-                out += char
-                pos += 1
-        return out
+        return RE_COMMENT.sub(self.blank_comment, data)
 
-    def get_token(self):
-        token = None
-        chunk = ''
+    @staticmethod
+    def blank_comment(match):
+        # String literals are matched too, so '//' inside them survives
+        if match.lastgroup == 'string':
+            return match.group()
+        return RE_NOT_NEWLINE.sub(' ', match.group())
 
-        while self.pos <= self.endpos:
-            if self.data[self.pos].isspace():
-                self.pos += 1
-                continue
+    def location(self, pos=None):
+        """
+        Returns (line, column) of pos in the original source, both 1-based
+        """
+        pos = self.pos if pos is None else pos
+        line = self.data.count('\n', 0, pos) + 1
+        column = pos - self.data.rfind('\n', 0, pos)
+        return (line, column)
 
-            char = self.data[self.pos]
+    def error(self, message, pos):
+        return SyntaxError('{} (line {}, column {})'.format(
+            message, *self.location(pos)))
 
-            # Symbol handling
-            if char in SYMBOLS:
-                self.pos += 1
-                return Token('symbol', char)
-            
-            # String literal handling
-            elif char == '"':
-                self.pos += 1
-                while self.data[self.pos] != '"':
-                    char += self.data[self.pos]
-                    self.pos += 1
-                char += self.data[self.pos]
-                self.pos += 1
-                return Token('stringConstant', char)
-
-            # Other token handling
+    def get_token(self):
+        return self.make_token(RE_TOKEN.match(self.data, self.pos))
+
+    def make_token(self, match):
+        if match is None:
+            # Anything other than trailing whitespace is an error
+            pos = RE_WHITESPACE.match(self.data, self.pos).end()
+            if pos <= self.endpos:
+                raise self.error("Invalid character: {}".format(self.data[pos]), pos)
+            return None
+
+        self.pos = match.end()
+        kind = match.lastgroup
+        chunk = match.group(kind)
+
+        # Symbol handling
+        if kind == 'symbol':
+            return Token('symbol', chunk)
+
+        # String literal handling
+        elif kind == 'string':
+            return Token('stringConstant', chunk)
+
+        # Integer token handling
+        elif chunk.isdigit():
+            value = int(chunk)
+            if value >= 0 and value <= MAXINTEGER:
+                return Token('integerConstant', chunk)
             else:
-                # Consume remaining characters
-                chunk = ''
-                while self.data[self.pos] in IDENTIFIERS:
-                    chunk += self.data[self.pos]
-                    self.pos += 1
-
-                # Integer token handling
-                if chunk.isdigit():
-                    value = int(chunk)
-                    if value >= 0 and value <= MAXINTEGER:
-                        return Token('integerConstant', chunk)
-                    else:
-                        raise SyntaxError("Integer {} is out of range 0..{}".format(value, MAXINTEGER))
-
-                # Keyword token handling
-                elif chunk in KEYWORDS:
-                    return Token('keyword', chunk)
-
-                # Identifier token handling
-                else:
-                    if chunk[0].isdigit():
-                        raise SyntaxError("Identifiers can't start with a number: {}".format(chunk))
-                    for char in chunk:
-                        if char not in IDENTIFIERS:
-                            break
-                    else:
-                        return Token('identifier', chunk)
-        
+                raise self.error("Integer {} is out of range 0..{}".format(
+                    value, MAXINTEGER), match.start(kind))
+
+        # Keyword token handling
+        elif chunk in KEYWORDS:
+            return Token('keyword', chunk)
+
+        # Identifier token handling
+        elif chunk[0].isdigit():
+            raise self.error("Identifiers can't start with a number: {}".format(
+                chunk), match.start(kind))
+        else:
+            return Token('identifier', chunk)
+
     def get_tokens(self):
         self.pos = 0
         while True:
             token = self.get_token()
             if not token:
-                raise StopIteration
+                return
             yield token
             
     def to_xml(self):
@@ -154,6 +159,78 @@ class Tokenizer:
             root.appendChild(elem)
         return root.toprettyxml(indent='')
 
+
+class StreamTokenizer(Tokenizer):
+    """
+    Reads the source file incrementally, a chunk of complete lines at a
+    time, so only the unconsumed part of the current chunk is kept in memory
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, f, chunk_size=None):
+        self.file = f
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.pending = '' # partial last line of the previous chunk
+        self.in_comment = False # block comment still open at end of chunk
+        self.eof = False
+        self.lines = 0 # lines already dropped from the front of self.data
+        super().__init__('')
+
+    def fill(self):
+        """
+        Drop consumed lines and append the next chunk of complete lines
+        """
+        cut = self.data.rfind('\n', 0, self.pos) + 1
+        self.lines += self.data.count('\n', 0, cut)
+        self.data = self.data[cut:]
+        self.pos -= cut
+
+        chunk = self.file.read(self.chunk_size)
+        self.eof = not chunk
+        text = self.pending + chunk
+        end = len(text) if self.eof else text.rfind('\n') + 1
+        self.pending = text[end:]
+        self.data += self.strip_comments(text[:end])
+        self.endpos = len(self.data) - 1
+
+    def strip_comments(self, data):
+        # Finish a block comment left open by the previous chunk
+        if self.in_comment:
+            end = data.find('*/')
+            if end < 0:
+                return RE_NOT_NEWLINE.sub(' ', data)
+            self.in_comment = False
+            return (RE_NOT_NEWLINE.sub(' ', data[:end + 2]) +
+                    self.strip_comments(data[end + 2:]))
+        return RE_COMMENT.sub(self.blank_comment, data)
+
+    def blank_comment(self, match):
+        comment = match.group()
+        if comment.startswith('/*') and (len(comment) < 4 or not comment.endswith('*/')):
+            self.in_comment = True
+        return super().blank_comment(match)
+
+    def location(self, pos=None):
+        line, column = super().location(pos)
+        return (line + self.lines, column)
+
+    def needs_more(self, match):
+        """
+        True if the token at self.pos might continue past the buffered data
+        """
+        if match is not None:
+            return match.end() == len(self.data)
+        pos = RE_WHITESPACE.match(self.data, self.pos).end()
+        return pos == len(self.data) or self.data[pos] == '"'
+
+    def get_token(self):
+        match = RE_TOKEN.match(self.data, self.pos)
+        while not self.eof and self.needs_more(match):
+            self.fill()
+            match = RE_TOKEN.match(self.data, self.pos)
+        return self.make_token(match)
+
+
 if __name__ == '__main__':
     with open(sys.argv[1]) as f:
         data = f.read()